@@ -0,0 +1,163 @@
+import json
+import logging
+import secrets
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Optional
+
+logger = logging.getLogger("udemy-downloader")
+
+# the daemon listens on localhost, it must not be reached through HTTP_PROXY and friends
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class Aria2RPCError(Exception):
+    pass
+
+
+class Aria2RPC(object):
+    """
+    A single long-lived aria2c process driven over its local JSON-RPC interface.
+
+    Downloads are queued with addUri and tracked by their GID, so connections are reused
+    between files and aria2c's own queue takes care of concurrency instead of a new
+    process being started for every file.
+    """
+
+    def __init__(
+        self, max_concurrent_downloads: int = 16, extra_args: Optional[list] = None
+    ):
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.extra_args = extra_args or []
+        self.port = None
+        self.process = None
+        self._secret = secrets.token_hex(16)
+        self._id = 0
+        self._id_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/jsonrpc"
+
+    @staticmethod
+    def _free_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def start(self, timeout: float = 10):
+        self.port = self._free_port()
+        args = [
+            "aria2c",
+            "--enable-rpc",
+            "--rpc-listen-all=false",
+            f"--rpc-listen-port={self.port}",
+            f"--rpc-secret={self._secret}",
+            f"--max-concurrent-downloads={self.max_concurrent_downloads}",
+            "--continue",
+            "--auto-file-renaming=false",
+            "--summary-interval=0",
+            "--disable-ipv6",
+            "--follow-torrent=false",
+            "--quiet",
+            *self.extra_args,
+        ]
+        self.process = subprocess.Popen(
+            args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                version = self.call("getVersion")
+                logger.info(
+                    f"> Started aria2c {version.get('version')} RPC daemon on port {self.port}"
+                )
+                return
+            except (OSError, Aria2RPCError):
+                if self.process.poll() is not None:
+                    raise Aria2RPCError(
+                        f"aria2c exited with code {self.process.returncode} while starting"
+                    )
+                if time.monotonic() > deadline:
+                    self.shutdown()
+                    raise Aria2RPCError("Timed out waiting for the aria2c RPC daemon")
+                time.sleep(0.1)
+
+    def call(self, method: str, *params):
+        with self._id_lock:
+            self._id += 1
+            request_id = self._id
+        payload = json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "method": f"aria2.{method}",
+                "params": [f"token:{self._secret}", *params],
+            }
+        ).encode("utf-8")
+        request = urllib.request.Request(
+            self.url, data=payload, headers={"Content-Type": "application/json"}
+        )
+        try:
+            with _opener.open(request, timeout=30) as resp:
+                data = json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            # aria2 answers RPC errors with a 400 and the error in the body
+            data = json.loads(e.read() or b"{}")
+        if "error" in data:
+            raise Aria2RPCError(data["error"].get("message"))
+        return data.get("result")
+
+    def add_uri(
+        self, url: str, file_dir: str, filename: str, options: Optional[dict] = None
+    ) -> str:
+        opts = {"dir": file_dir, "out": filename}
+        if options:
+            opts.update({k: str(v) for k, v in options.items()})
+        return self.call("addUri", [url], opts)
+
+    def wait(self, gid: str, poll_interval: float = 0.25) -> dict:
+        """
+        Blocks until the download is no longer active and returns its final status
+        """
+        while True:
+            status = self.call(
+                "tellStatus",
+                gid,
+                [
+                    "status",
+                    "errorCode",
+                    "errorMessage",
+                    "completedLength",
+                    "totalLength",
+                ],
+            )
+            state = status.get("status")
+            if state == "complete":
+                return status
+            if state in ("error", "removed"):
+                raise Aria2RPCError(
+                    f"Download {gid} failed ({status.get('errorCode')}): {status.get('errorMessage')}"
+                )
+            time.sleep(poll_interval)
+
+    def download(
+        self, url: str, file_dir: str, filename: str, options: Optional[dict] = None
+    ) -> dict:
+        gid = self.add_uri(url, file_dir, filename, options)
+        logger.debug(f"[ARIA2-RPC]: queued {filename} as {gid}")
+        return self.wait(gid)
+
+    def shutdown(self):
+        if not self.process or self.process.poll() is not None:
+            return
+        try:
+            self.call("shutdown")
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
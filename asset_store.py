@@ -0,0 +1,189 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+logger = logging.getLogger("udemy-downloader")
+
+# ioctl number of FICLONE on linux, clones a whole file on btrfs, xfs and friends
+FICLONE = 0x40049409
+HASH_CHUNK = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(src: str, dst: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def _clone(src: str, dst: str) -> str:
+    """
+    Copies a file as a reflink where the filesystem supports it, a plain copy otherwise.
+    Either way the copy is independent, writing to one doesn't change the other
+
+    Returns:
+        str: How it was copied
+    """
+    if _reflink(src, dst):
+        return "reflink"
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class AssetStore(object):
+    """
+    Content addressed store of downloaded assets, so a file attached to several lectures
+    or courses is only downloaded once.
+
+    Files are kept under `objects/` by the sha256 of their content, and `ids/` maps every
+    asset id seen to the hash of its file. Objects and the files in the course directories
+    never share an inode: both are copies, reflinks where the filesystem supports it (sharing
+    the same blocks until one is written to) and plain copies otherwise, so editing a
+    downloaded file can't change the store or the other courses. An object is checked
+    against its hash every time it is reused.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.objects = Path(directory, "objects")
+        self.ids = Path(directory, "ids")
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.ids.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.saved_bytes = 0
+
+    def _object_path(self, digest: str) -> Path:
+        return Path(self.objects, digest[:2], digest)
+
+    def _lookup(self, asset_id) -> Optional[str]:
+        try:
+            return Path(self.ids, str(asset_id)).read_text().strip()
+        except OSError:
+            return None
+
+    def materialize(self, asset_id, path: str) -> bool:
+        """
+        Puts the file of an asset that is already in the store at `path`
+
+        Returns:
+            bool: Whether it was in the store, False means it has to be downloaded
+        """
+        if asset_id is None:
+            return False
+        digest = self._lookup(asset_id)
+        if digest is None:
+            return False
+        src = self._object_path(digest)
+        if not src.is_file():
+            return False
+
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            method = _clone(src, tmp_path)
+            # the copy is checked rather than the object, it is what ends up at `path`
+            if file_sha256(tmp_path) != digest:
+                logger.warning(
+                    f"> Asset {asset_id} no longer matches its hash in the store, downloading it again"
+                )
+                os.remove(tmp_path)
+                src.unlink()
+                return False
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"> Failed to reuse asset {asset_id} from the store: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self.reused += 1
+            self.saved_bytes += size
+        logger.info(
+            f"      > Reused '{os.path.basename(path)}' from the asset store ({method}, {size / 1024**2:.1f} MiB)"
+        )
+        return True
+
+    def add(self, asset_id, path: str):
+        """
+        Adds a copy of a downloaded asset to the store, the downloaded file is left as it
+        is
+        """
+        if asset_id is None:
+            return
+        digest = file_sha256(path)
+        obj = self._object_path(digest)
+        if not obj.is_file():
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            tmp_obj = obj.with_suffix(f".{threading.get_ident()}.tmp")
+            try:
+                _clone(path, str(tmp_obj))
+                # another worker may have stored the same content in the meantime
+                os.replace(tmp_obj, obj)
+            except OSError as e:
+                logger.debug(f"Failed to add {path} to the asset store: {e}")
+                if tmp_obj.exists():
+                    tmp_obj.unlink()
+                return
+
+        id_path = Path(self.ids, str(asset_id))
+        tmp_id_path = id_path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_id_path.write_text(digest)
+        os.replace(tmp_id_path, id_path)
+
+    def prune(self):
+        """
+        Removes the objects no asset id maps to anymore, and gives objects that are still
+        hard links to a downloaded file (stores written by older versions linked them) an
+        inode of their own
+        """
+        referenced = set()
+        for id_path in self.ids.iterdir():
+            try:
+                referenced.add(id_path.read_text().strip())
+            except OSError:
+                continue
+
+        removed = detached = 0
+        for obj in self.objects.glob("*/*"):
+            try:
+                if obj.name not in referenced:
+                    obj.unlink()
+                    removed += 1
+                elif obj.stat().st_nlink > 1:
+                    tmp_obj = obj.with_suffix(".detach.tmp")
+                    _clone(str(obj), str(tmp_obj))
+                    os.replace(tmp_obj, obj)
+                    detached += 1
+            except OSError:
+                continue
+        if removed or detached:
+            logger.debug(
+                f"Pruned {removed} unused object(s) from the asset store, detached {detached} from downloaded files"
+            )
@@ -0,0 +1,106 @@
+"""
+Times finding the key id of an encrypted track, the pause after every DRM lecture
+download, on tracks of several sizes.
+
+The header only walk of `utils.extract_kid` is compared with the original extraction, which
+parsed every box of the file with the bitstring parser (`--baseline` is the revision to
+take it from, the last one built on bitstring by default). The tracks are sparse files, so
+the multi gigabyte ones take no disk space.
+
+Tracks are timed with the pssh in their init segment, and without one (the key id is
+only in the manifest), where the original extraction went through the whole file. The original parser copies each mdat into
+memory, it is skipped for tracks over `--baseline-limit`. It needs bitstring<5.
+
+    python benchmarks/bench_extract_kid.py --sizes 64M,1G,4G,8G
+"""
+
+import argparse
+import base64
+import codecs
+import os
+import tempfile
+
+from common import (
+    KID,
+    best_of,
+    format_size,
+    load_bitstring_parser,
+    parse_size,
+    write_track,
+)
+
+import utils  # noqa: E402
+import widevine_pssh_data_pb2  # noqa: E402
+
+
+def baseline_extract_kid(parser, mp4_file):
+    """
+    utils.extract_kid as it was before the header only walk
+    """
+    for box in parser.F4VParser.parse(filename=mp4_file):
+        if box.header.box_type == "moov" and box.pssh:
+            pssh_box = next(
+                x for x in box.pssh if x.system_id == "edef8ba979d64acea3c827dcd51d21ed"
+            )
+            pssh = widevine_pssh_data_pb2.WidevinePsshData()
+            pssh.ParseFromString(codecs.decode(pssh_box.payload, "hex"))
+            return base64.b16encode(pssh.key_id[0]).lower().decode("utf-8")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="64M,1G,4G,8G")
+    parser.add_argument(
+        "--fragments",
+        type=int,
+        default=1,
+        help="moof and mdat pairs per track, 1 for a single mdat",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="revision to take the original parser from")
+    parser.add_argument("--baseline-limit", default="1G")
+    parser.add_argument("--no-baseline", action="store_true")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.no_baseline:
+        baseline = load_bitstring_parser(args.baseline)
+    limit = parse_size(args.baseline_limit)
+
+    work_dir = tempfile.mkdtemp(prefix="bench-extract-kid-")
+    print(
+        f"{'size':>8} {'pssh':>5} {'header walk':>14} {'full parse':>14} {'speedup':>9}"
+    )
+    for size in map(parse_size, args.sizes.split(",")):
+        for pssh in (True, False):
+            path = write_track(
+                os.path.join(work_dir, f"{size}.encrypted.mp4"),
+                size,
+                args.fragments,
+                pssh=pssh,
+            )
+            kid = KID if pssh else None
+            try:
+                assert utils.extract_kid(path) == kid
+                new = best_of(args.repeat, utils.extract_kid, path)
+                old = None
+                if baseline and size <= limit:
+                    assert baseline_extract_kid(baseline, path) == kid
+                    old = best_of(args.repeat, baseline_extract_kid, baseline, path)
+            finally:
+                os.remove(path)
+            print(
+                f"{format_size(size):>8} {'yes' if pssh else 'no':>5} "
+                f"{new * 1000:11.3f} ms "
+                + (
+                    f"{old * 1000:11.3f} ms {old / new:8.0f}x"
+                    if old is not None
+                    else f"{'skipped':>14} {'':>9}"
+                )
+            )
+    os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Times reading the box tree of large fragmented MP4s with the mmap box reader and with the
+bitstring parser it replaced.
+
+Every track is read three ways, each listing the type of every top-level box:
+`F4VParser.parse` of the bitstring parser (`--baseline` is the revision to take it from,
+the last one built on bitstring by default), `F4VParser.parse` of the compatibility shim,
+and iterating a `BoxReader`, which doesn't decode the boxes. The speedup is of the shim
+over the bitstring parser, the same API. The tracks are sparse files; the bitstring
+parser copies each mdat into memory, it is skipped for tracks over `--baseline-limit`.
+It needs bitstring<5.
+
+    python benchmarks/bench_mp4parse.py --sizes 256M,1G,4G --fragments 2000
+"""
+
+import argparse
+import os
+import tempfile
+
+from common import best_of, format_size, load_bitstring_parser, parse_size, write_track
+
+import mp4parse  # noqa: E402
+
+
+def parse_box_types(parser, path: str) -> list:
+    return [box.header.box_type for box in parser.F4VParser.parse(filename=path)]
+
+
+def read_box_types(path: str) -> list:
+    with mp4parse.BoxReader(path) as reader:
+        return [box.type for box in reader]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="64M,256M,1G,4G")
+    parser.add_argument("--fragments", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="revision to take the bitstring parser from")
+    parser.add_argument("--baseline-limit", default="1G")
+    parser.add_argument("--no-baseline", action="store_true")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.no_baseline:
+        baseline = load_bitstring_parser(args.baseline)
+    limit = parse_size(args.baseline_limit)
+
+    work_dir = tempfile.mkdtemp(prefix="bench-mp4parse-")
+    expected = ["ftyp", "moov"] + ["moof", "mdat"] * args.fragments
+    print(f"{args.fragments} fragments per track")
+    print(
+        f"{'size':>8} {'bitstring':>12} {'parse shim':>12} {'BoxReader':>12} {'speedup':>9}"
+    )
+    for size in map(parse_size, args.sizes.split(",")):
+        path = write_track(os.path.join(work_dir, f"{size}.mp4"), size, args.fragments)
+        try:
+            assert parse_box_types(mp4parse, path) == expected
+            assert read_box_types(path) == expected
+            shim = best_of(args.repeat, parse_box_types, mp4parse, path)
+            lazy = best_of(args.repeat, read_box_types, path)
+            old = None
+            if baseline and size <= limit:
+                assert parse_box_types(baseline, path) == expected
+                old = best_of(args.repeat, parse_box_types, baseline, path)
+        finally:
+            os.remove(path)
+        print(
+            f"{format_size(size):>8} "
+            + (f"{old * 1000:9.1f} ms " if old is not None else f"{'skipped':>12} ")
+            + f"{shim * 1000:9.1f} ms {lazy * 1000:9.1f} ms "
+            + (f"{old / shim:8.0f}x" if old is not None else "")
+        )
+    os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Times resolving the DASH sources of lectures with the mpegdash resolver and with yt-dlp,
+over a corpus of saved MPDs served from a local HTTP server.
+
+Every manifest is resolved the way a lecture is on a cold run, with the manifest cache off
+and nothing remembered between lectures: the key check, then `Udemy._extract_mpd`, which
+reuses the manifest the key check parsed, for the resolver; the key ids read on their own,
+then `Udemy._extract_mpd_ytdlp` (a YoutubeDL per lecture, fetching the manifest again) for
+yt-dlp. Both have to come up with the same formats. `--corpus` is a directory of .mpd
+files, by default Udemy-like DRM manifests are generated. The import times are of a fresh
+interpreter importing the modules each one needs.
+
+    python benchmarks/bench_mpd_resolver.py --corpus saved/mpds --latency 0.02
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import uuid
+
+import requests
+from common import ROOT, best_of, serve
+
+import main  # noqa: E402
+from utils import extract_mpd_kids  # noqa: E402
+
+MPD = """<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" type="static" mediaPresentationDuration="PT{duration}S" maxSegmentDuration="PT6S" minBufferTime="PT10S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+<Period id="1" start="PT0S">
+<AdaptationSet group="2" contentType="audio" lang="en" segmentAlignment="true" audioSamplingRate="48000" mimeType="audio/mp4" codecs="mp4a.40.2" startWithSAP="1">
+{audio_protection}<SegmentTemplate timescale="1000" initialization="a-$RepresentationID$.dash" media="a-$RepresentationID$-$Time$.dash">{audio_timeline}</SegmentTemplate>
+<Representation id="audio_eng=128000" bandwidth="128000"><AudioChannelConfiguration schemeIdUri="urn:mpeg:dash:23003:3:audio_channel_configuration:2011" value="2"/></Representation>
+</AdaptationSet>
+<AdaptationSet group="1" contentType="video" par="16:9" segmentAlignment="true" mimeType="video/mp4" startWithSAP="1">
+{video_protection}<SegmentTemplate timescale="1000" initialization="v-$RepresentationID$.dash" media="v-$RepresentationID$-$Time$.dash">{video_timeline}</SegmentTemplate>
+{representations}
+</AdaptationSet>
+</Period>
+</MPD>
+"""
+PROTECTION = (
+    '<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="{kid}"/>'
+    '<ContentProtection schemeIdUri="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed"><cenc:pssh>AAAAOHBzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAABgSEBRMt0oAAAAAAAAAAAAAAAA=</cenc:pssh></ContentProtection>'
+)
+RENDITIONS = [
+    (360, 640, 400000),
+    (480, 854, 800000),
+    (720, 1280, 1500000),
+    (720, 1280, 2500000),
+    (1080, 1920, 3500000),
+    (1080, 1920, 4000000),
+]
+
+# what each resolver imports on top of main's own imports
+IMPORTS = {
+    "mpegdash": "import mpd_resolver, mpegdash.parser",
+    "yt-dlp": "import yt_dlp",
+}
+
+
+def write_corpus(directory: str, count: int):
+    """
+    Writes DRM manifests like Udemy's: a SegmentTimeline per track, cenc and Widevine
+    protection, 3 to 6 video renditions
+    """
+    rng = random.Random(1)
+    for number in range(count):
+        segments = rng.randint(50, 400)
+        video_timeline = f'<SegmentTimeline><S t="0" d="6006" r="{segments - 2}"/><S d="3003"/></SegmentTimeline>'
+        audio_timeline = (
+            "<SegmentTimeline>"
+            + "".join(f'<S d="{6016 if i % 2 else 5995}"/>' for i in range(segments))
+            + "</SegmentTimeline>"
+        )
+        representations = "".join(
+            f'<Representation id="video={bandwidth}-{height}" bandwidth="{bandwidth}" width="{width}" height="{height}" codecs="avc1.64001f" scanType="progressive"/>'
+            for height, width, bandwidth in rng.sample(RENDITIONS, k=rng.randint(3, 6))
+        )
+        with open(os.path.join(directory, f"{number}.mpd"), "w") as f:
+            f.write(
+                MPD.format(
+                    duration=segments * 6,
+                    audio_protection=PROTECTION.format(
+                        kid=uuid.UUID(int=rng.getrandbits(128))
+                    ),
+                    audio_timeline=audio_timeline,
+                    video_protection=PROTECTION.format(
+                        kid=uuid.UUID(int=rng.getrandbits(128))
+                    ),
+                    video_timeline=video_timeline,
+                    representations=representations,
+                )
+            )
+
+
+class Session(object):
+    """
+    Stands in for the authenticated session
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+
+    def _get(self, url):
+        return self._session.get(url)
+
+
+def resolve(udemy: main.Udemy, url: str, asset_id: int, native: bool) -> list:
+    """
+    A lecture on a cold run: the key check before anything is downloaded, then its
+    sources
+    """
+    # nothing carried over from the previous lecture
+    udemy._mpd_kids.clear()
+    udemy._mpd_sources.clear()
+    if native:
+        udemy._extract_mpd_kids(url, asset_id)
+        return udemy._extract_mpd(url, asset_id)
+    # the key check read the key ids on their own, yt-dlp fetched the manifest again
+    r = udemy.session._get(url)
+    r.raise_for_status()
+    udemy._mpd_kids[asset_id] = extract_mpd_kids(r.text)
+    return udemy._extract_mpd_ytdlp(url, asset_id)
+
+
+def signature(sources: list) -> list:
+    return sorted((s["height"], s["format_id"], tuple(s["kids"])) for s in sources)
+
+
+def import_time(statement: str) -> float:
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"{statement}; print(time.perf_counter() - started)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, check=True
+    )
+    return float(output.stdout)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", help="directory of .mpd files to resolve")
+    parser.add_argument("--count", type=int, default=40, help="manifests to generate")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds before each response"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    main.logger = logging.getLogger("udemy-downloader")
+    main.manifest_cache = None
+
+    work_dir = None
+    corpus = args.corpus
+    if corpus is None:
+        work_dir = tempfile.mkdtemp(prefix="bench-mpd-resolver-")
+        corpus = work_dir
+        write_corpus(corpus, args.count)
+    names = sorted(name for name in os.listdir(corpus) if name.endswith(".mpd"))
+    print(
+        f"{len(names)} manifests, {args.latency * 1000:g} ms latency, best of {args.repeat}"
+    )
+
+    udemy = main.Udemy(None)
+    udemy.session = Session()
+    modes = [("mpegdash", True), ("yt-dlp", False)]
+    latencies = {name: [] for name, _ in modes}
+    try:
+        with serve(corpus, args.latency) as port:
+            for asset_id, name in enumerate(names):
+                url = f"http://127.0.0.1:{port}/{name}"
+                # checked once, outside the timings
+                expected = signature(resolve(udemy, url, asset_id, False))
+                assert signature(resolve(udemy, url, asset_id, True)) == expected, name
+                for mode, native in modes:
+                    latencies[mode].append(
+                        best_of(args.repeat, resolve, udemy, url, asset_id, native)
+                    )
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'':>9} {'mean':>10} {'median':>10} {'max':>10} {'import':>10}")
+    for mode, _ in modes:
+        times = latencies[mode]
+        imported = min(import_time(IMPORTS[mode]) for _ in range(args.repeat))
+        print(
+            f"{mode:>9} {statistics.mean(times) * 1000:7.1f} ms {statistics.median(times) * 1000:7.1f} ms "
+            f"{max(times) * 1000:7.1f} ms {imported * 1000:7.1f} ms"
+        )
+    speedup = statistics.mean(latencies["yt-dlp"]) / statistics.mean(
+        latencies["mpegdash"]
+    )
+    print(f"mpegdash resolves a lecture {speedup:.1f}x faster")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,154 @@
+"""
+Times the download of the tracks of a DRM lecture with the native fragment downloader and
+with yt-dlp, from a local HTTP server serving a DASH manifest and its segments.
+
+Both go through `main.download_segments` like a real lecture, so the yt-dlp times include
+starting the process. `--latency` holds back every response to stand in for the round trip
+to the CDN, which is where fetching fragments in parallel pays off.
+
+    python benchmarks/bench_segment_download.py --segments 300 --latency 0.02
+"""
+
+import argparse
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from common import best_of, format_size, parse_size, serve
+
+import main  # noqa: E402
+
+MPD = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{duration}S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+<Period>
+<AdaptationSet mimeType="video/mp4" contentType="video"><SegmentTemplate timescale="1000" initialization="$RepresentationID$-init.mp4" media="$RepresentationID$-$Number%05d$.m4s" startNumber="1">{timeline}</SegmentTemplate>
+<Representation id="video" bandwidth="2000000" width="1280" height="720" codecs="avc1.4d401f"/></AdaptationSet>
+<AdaptationSet mimeType="audio/mp4" contentType="audio"><SegmentTemplate timescale="1000" initialization="$RepresentationID$-init.mp4" media="$RepresentationID$-$Number%05d$.m4s" startNumber="1">{timeline}</SegmentTemplate>
+<Representation id="audio" bandwidth="128000" codecs="mp4a.40.2"/></AdaptationSet>
+</Period>
+</MPD>
+"""
+
+
+def write_stream(directory: str, segments: int, video_size: int, audio_size: int):
+    """
+    Writes the manifest and segments of a lecture, returns the sha256 of each track
+    """
+    digests = {}
+    for rep_id, size in (("video", video_size), ("audio", audio_size)):
+        digest = hashlib.sha256()
+        init = rep_id.encode("utf-8") * 100
+        with open(os.path.join(directory, f"{rep_id}-init.mp4"), "wb") as f:
+            f.write(init)
+        digest.update(init)
+        for number in range(1, segments + 1):
+            data = os.urandom(size)
+            with open(os.path.join(directory, f"{rep_id}-{number:05d}.m4s"), "wb") as f:
+                f.write(data)
+            digest.update(data)
+        digests[rep_id] = digest.hexdigest()
+
+    timeline = (
+        f'<SegmentTimeline><S t="0" d="4000" r="{segments - 1}"/></SegmentTimeline>'
+    )
+    with open(os.path.join(directory, "index.mpd"), "w", encoding="utf-8") as f:
+        f.write(MPD.format(duration=segments * 4, timeline=timeline))
+    return digests
+
+
+def sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Hides the progress bars of the downloaders, yt-dlp writes them to the inherited stdout
+    """
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, "wb") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+    try:
+        yield
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+
+def download(url: str, out_dir: str, native: bool, digests: dict):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    main.use_native_downloader = native
+    job = main.SegmentJob(
+        url, "video,audio", "1", "lecture", os.path.join(out_dir, "1.mp4"), out_dir
+    )
+    with quiet():
+        ok = main.download_segments(job)
+    if not ok:
+        raise RuntimeError(f"the {'native' if native else 'yt-dlp'} download failed")
+    assert sha256(job.video_filepath_enc) == digests["video"]
+    assert sha256(job.audio_filepath_enc) == digests["audio"]
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--segments", type=int, default=300)
+    parser.add_argument("--video-size", default="256K", help="size of a video segment")
+    parser.add_argument("--audio-size", default="32K", help="size of an audio segment")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds before each response"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-ytdlp", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    main.logger = logging.getLogger("udemy-downloader")
+    main.concurrent_downloads = args.concurrency
+    main.segment_retries = 0
+
+    work_dir = tempfile.mkdtemp(prefix="bench-segment-download-")
+    stream_dir = os.path.join(work_dir, "stream")
+    os.makedirs(stream_dir)
+    video_size, audio_size = parse_size(args.video_size), parse_size(args.audio_size)
+    digests = write_stream(stream_dir, args.segments, video_size, audio_size)
+    total = (video_size + audio_size) * args.segments
+
+    modes = [("native", True)]
+    if not args.no_ytdlp:
+        modes.append(("yt-dlp", False))
+    print(
+        f"{args.segments} segments per track, {format_size(total)} in total, "
+        f"{args.concurrency} connections, {args.latency * 1000:g} ms latency",
+        flush=True,
+    )
+    try:
+        with serve(stream_dir, args.latency) as port:
+            url = f"http://127.0.0.1:{port}/index.mpd"
+            for name, native in modes:
+                out_dir = os.path.join(work_dir, name)
+                started = time.perf_counter()
+                seconds = best_of(args.repeat, download, url, out_dir, native, digests)
+                print(
+                    f"{name:>8} {seconds:8.2f} s {total / seconds / 1024**2:8.1f} MiB/s"
+                    f"  (all {args.repeat} runs: {time.perf_counter() - started:.1f} s)",
+                    flush=True,
+                )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,209 @@
+"""
+Helpers shared by the benchmark scripts: synthetic fragmented MP4 tracks, a local HTTP
+server, the parser of an older revision to compare against, and timing
+"""
+
+import contextlib
+import functools
+import importlib.util
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mp4parse  # noqa: E402
+import widevine_pssh_data_pb2  # noqa: E402
+
+KID = "0123456789abcdef0123456789abcdef"
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value: str) -> int:
+    """
+    A size like `512M` or `4G` in bytes
+    """
+    value = value.strip().upper()
+    if value[-1:] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def format_size(size: int) -> str:
+    for suffix in ("G", "M", "K"):
+        if size >= SIZE_SUFFIXES[suffix]:
+            return f"{size / SIZE_SUFFIXES[suffix]:g}{suffix}"
+    return str(size)
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", version << 24) + payload)
+
+
+def widevine_pssh(kid: str = KID) -> bytes:
+    data = widevine_pssh_data_pb2.WidevinePsshData()
+    data.key_id.append(bytes.fromhex(kid))
+    data = data.SerializeToString()
+    system_id = bytes.fromhex(mp4parse.WIDEVINE_SYSTEM_ID)
+    return full_box(b"pssh", 0, system_id + struct.pack(">I", len(data)) + data)
+
+
+def init_segment(kid: str = KID, pssh: bool = True) -> bytes:
+    tenc = full_box(b"tenc", 0, b"\0\0\1\x08" + bytes.fromhex(kid))
+    sinf = box(b"sinf", box(b"frma", b"avc1") + box(b"schi", tenc))
+    stsd = full_box(b"stsd", 0, struct.pack(">I", 1) + box(b"encv", bytes(78) + sinf))
+    stbl = box(b"stbl", stsd)
+    trak = box(b"trak", box(b"tkhd", bytes(84)) + box(b"mdia", box(b"minf", stbl)))
+    moov = box(
+        b"moov", box(b"mvhd", bytes(100)) + trak + (widevine_pssh(kid) if pssh else b"")
+    )
+    return box(b"ftyp", b"iso6\0\0\0\0") + moov
+
+
+def moof(sequence: int) -> bytes:
+    tfhd = full_box(b"tfhd", 0, struct.pack(">I", 1))
+    return box(
+        b"moof", full_box(b"mfhd", 0, struct.pack(">I", sequence)) + box(b"traf", tfhd)
+    )
+
+
+def write_track(
+    path: str, size: int, fragments: int = 1, kid: str = KID, pssh: bool = True
+) -> str:
+    """
+    Writes an encrypted looking track of about `size` bytes: an init segment, with the
+    Widevine pssh unless `pssh` is False, then `fragments` moof and mdat pairs. The media data is left sparse, so
+    multi gigabyte tracks are quick to create and take no disk space
+    """
+    fragment_size = max(size // fragments, 1)
+    with open(path, "wb") as f:
+        f.write(init_segment(kid, pssh))
+        for sequence in range(1, fragments + 1):
+            f.write(moof(sequence))
+            # 64 bit box size, mdats of a large track don't fit in 32 bits
+            f.write(struct.pack(">I4sQ", 1, b"mdat", fragment_size + 16))
+            f.seek(fragment_size, os.SEEK_CUR)
+        f.truncate()
+    return path
+
+
+def bitstring_revision() -> str:
+    """
+    The last revision of mp4parse built on bitstring, the parser the benchmarks compare
+    against
+    """
+    removed = subprocess.run(
+        ["git", "log", "-1", "--format=%H", "-Simport bitstring", "--", "mp4parse.py"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    return f"{removed}^"
+
+
+def load_baseline(module: str, revision: str):
+    """
+    Imports a module as it was at an older revision of the repository
+    """
+    source = subprocess.run(
+        ["git", "show", f"{revision}:{module}.py"],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+    ).stdout
+    path = os.path.join(tempfile.mkdtemp(prefix="benchmark-"), f"{module}.py")
+    with open(path, "wb") as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location(f"baseline_{module}", path)
+    baseline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(baseline)
+    return baseline
+
+
+def load_bitstring_parser(revision: str = None):
+    """
+    The bitstring based mp4parse, None (with the reason printed) when it can't run here.
+    It needs bitstring 4, `ConstBitStream` is gone from bitstring 5
+    """
+    try:
+        parser = load_baseline("mp4parse", revision or bitstring_revision())
+    except ImportError as e:
+        print(f"Not comparing with the bitstring parser: {e}")
+        return None
+    if not hasattr(parser.bitstring, "ConstBitStream"):
+        print(
+            "Not comparing with the bitstring parser, it needs bitstring<5 "
+            f"(bitstring {parser.bitstring.__version__} is installed)"
+        )
+        return None
+    return parser
+
+
+def best_of(repeat: int, function, *args) -> float:
+    """
+    The fastest of `repeat` runs of a function, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    # keeps connections open like a CDN does
+    protocol_version = "HTTP/1.1"
+    # seconds every response is held back, to stand in for the round trip to a CDN
+    latency = 0
+
+    def end_headers(self):
+        if self.latency:
+            time.sleep(self.latency)
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections opened in a burst
+    request_queue_size = 128
+
+
+def _serve_forever(directory: str, latency: float, ports):
+    handler = type("Handler", (_QuietHandler,), {"latency": latency})
+    server = _Server(("127.0.0.1", 0), functools.partial(handler, directory=directory))
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def serve(directory: str, latency: float = 0):
+    """
+    Serves a directory over HTTP on a free local port, yields the port. The server runs
+    in its own process so it doesn't compete for the GIL with the downloader being timed
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve_forever, args=(directory, latency, ports), daemon=True
+    )
+    process.start()
+    try:
+        yield ports.get(timeout=10)
+    finally:
+        process.terminate()
+        process.join()
@@ -0,0 +1,86 @@
+import logging
+import threading
+
+logger = logging.getLogger("udemy-downloader")
+
+
+class AIMDController(object):
+    """
+    Picks the fragment concurrency of the next download from how the previous ones went.
+
+    Every finished download reports how many bytes it fetched, how long it took and how
+    many errors and rate limit responses it ran into. Clean downloads raise the
+    concurrency by a fixed step (additive increase), errors or rate limiting cut it by a
+    factor (multiplicative decrease) and a clear drop in throughput after a raise undoes
+    that raise.
+    """
+
+    # downloads smaller than this are over before the connections ramp up, so their
+    # throughput says little about the concurrency they ran at
+    MIN_SAMPLE_BYTES = 8 * 1024**2
+    # a sample this much slower than the running average counts as congestion
+    THROUGHPUT_DROP = 0.75
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = 30,
+        increase: int = 2,
+        decrease: float = 0.5,
+        smoothing: float = 0.3,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self._value = self._clamp(initial)
+        # moving average of the throughput in bytes per second
+        self._throughput = None
+        self._lock = threading.Lock()
+
+    def _clamp(self, value: int) -> int:
+        return max(self.minimum, min(self.maximum, int(value)))
+
+    @property
+    def value(self) -> int:
+        with self._lock:
+            return self._value
+
+    def record(
+        self, nbytes: int, elapsed: float, errors: int = 0, throttled: int = 0
+    ) -> int:
+        """
+        Records the outcome of a download and returns the concurrency for the next one
+        """
+        throughput = nbytes / elapsed if elapsed > 0 else 0
+        with self._lock:
+            old = self._value
+            if throttled or errors:
+                # retries skew the throughput, so it is left out of the average
+                self._value = self._clamp(old * self.decrease)
+                reason = "rate limited" if throttled else "errors"
+            elif nbytes < self.MIN_SAMPLE_BYTES:
+                reason = "sample too small"
+            elif (
+                self._throughput
+                and throughput < self._throughput * self.THROUGHPUT_DROP
+            ):
+                self._value = self._clamp(old - self.increase)
+                # start over from the new level instead of backing off again and again
+                self._throughput = throughput
+                reason = "throughput dropped"
+            else:
+                self._value = self._clamp(old + self.increase)
+                if self._throughput is None:
+                    self._throughput = throughput
+                else:
+                    self._throughput += self.smoothing * (throughput - self._throughput)
+                reason = "clean download"
+            new = self._value
+
+        logger.info(
+            f"> Fragment concurrency {old} -> {new} ({reason}, {throughput / 1024**2:.1f} MiB/s, {errors} error(s), {throttled} rate limited)"
+        )
+        return new
@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger("udemy-downloader")
+
+# files a download leaves behind while it is still running
+PARTIAL_SUFFIXES = (".tmp", ".part", ".aria2", ".ytdl")
+
+
+class CourseSync(object):
+    """
+    Keeps a snapshot of a course's curriculum next to the downloaded files and diffs
+    every new curriculum against it.
+
+    Each snapshot entry holds the lecture's signature (asset id and version, supplementary
+    assets), where its files were written and the options they were downloaded with.
+    Lectures with the same signature whose files are still there don't need to be processed
+    again; lectures that were renumbered or moved to another chapter get their files
+    renamed in place, and lectures whose content changed are downloaded again.
+
+    The files of a changed lecture are moved aside rather than removed, and only deleted
+    once the new version is complete. The entry of a lecture is only updated when it
+    completes, so an interrupted run leaves the snapshot describing the files on disk: the
+    next run puts back the files that were moved aside and picks up where it stopped.
+    """
+
+    SNAPSHOT_FILE = ".sync.json"
+    # where the files of changed lectures wait for their replacement to complete
+    SUPERSEDED_DIR = ".sync-superseded"
+
+    def __init__(self, course_dir: str, options: dict):
+        self.course_dir = course_dir
+        self.options = options
+        self.path = os.path.join(course_dir, self.SNAPSHOT_FILE)
+        self.superseded_dir = os.path.join(course_dir, self.SUPERSEDED_DIR)
+        self.previous = {"lectures": {}}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, encoding="utf8", mode="r") as f:
+                    self.previous = json.load(f)
+            except (OSError, ValueError):
+                logger.warning("> Sync snapshot is unreadable, starting a new one")
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._planned = {}
+
+    @staticmethod
+    def _prefix_index(name: str, prefixes: list):
+        """
+        The index of the prefix a lecture file or caption (`<prefix>.<ext>`,
+        `<prefix>_<lang>.<ext>`) is named after, None for other files
+        """
+        return next(
+            (i for i, p in enumerate(prefixes) if name.startswith((f"{p}.", f"{p}_"))),
+            None,
+        )
+
+    def _lecture_files(
+        self, directory: str, prefixes: list, asset_prefix: str = None
+    ) -> list:
+        """
+        The files belonging to a lecture: the lecture itself (`<prefix>.<ext>`), its
+        captions (`<prefix>_<lang>.<ext>`) and its assets (`<asset_prefix><filename>`,
+        the lecture number)
+        """
+        if not os.path.isdir(directory):
+            return []
+        return [
+            name
+            for name in os.listdir(directory)
+            if self._prefix_index(name, prefixes) is not None
+            or (asset_prefix and name.startswith(asset_prefix))
+        ]
+
+    def _is_complete(self, directory: str, prefixes: list) -> bool:
+        return any(
+            name.startswith(tuple(f"{p}." for p in prefixes))
+            and not name.endswith(PARTIAL_SUFFIXES)
+            for name in self._lecture_files(directory, prefixes)
+        )
+
+    def plan(self, items: list) -> set:
+        """
+        Diffs the curriculum against the previous snapshot, renames the files of moved
+        lectures and moves the files of changed ones aside
+
+        Args:
+            items (list): One dict per lecture with its `id`, `signature`, the `dir` its
+                files go to (relative to the course directory), the file name `prefixes`
+                of its files and the `asset_prefix` of its assets
+
+        Returns:
+            set: The ids of the lectures that are up to date and can be skipped
+        """
+        self._restore_superseded()
+        previous = self.previous.get("lectures", {})
+        skip = set()
+        renames = []
+        superseded = {}
+        kept = []
+        counts = {"new": 0, "changed": 0, "renamed": 0, "unchanged": 0}
+
+        for item in items:
+            old = previous.get(str(item["id"]))
+            if not old:
+                counts["new"] += 1
+                continue
+
+            old_dir = os.path.join(self.course_dir, old["dir"])
+            old_files = self._lecture_files(
+                old_dir, old["prefixes"], old.get("asset_prefix")
+            )
+            if old["signature"] != item["signature"]:
+                counts["changed"] += 1
+                # the old entry stays until the new version is complete
+                self._entries[str(item["id"])] = old
+                superseded[str(item["id"])] = [
+                    os.path.join(old_dir, name) for name in old_files
+                ]
+                continue
+
+            # snapshots written before options were kept per lecture have them at the top
+            options = old.get("options", self.previous.get("options"))
+            kept.append((item, options))
+            # the files are renamed now, the entry has to say where they are
+            self._entries[str(item["id"])] = self._entry(item, options)
+            if (old["dir"], old["prefixes"]) == (item["dir"], item["prefixes"]):
+                continue
+            counts["renamed"] += 1
+            new_dir = os.path.join(self.course_dir, item["dir"])
+            for name in old_files:
+                index = self._prefix_index(name, old["prefixes"])
+                if index is not None:
+                    # prefixes are listed in the same order in both entries
+                    old_prefix, new_prefix = (
+                        old["prefixes"][index],
+                        item["prefixes"][index],
+                    )
+                elif old.get("asset_prefix") and item.get("asset_prefix"):
+                    old_prefix, new_prefix = old["asset_prefix"], item["asset_prefix"]
+                else:
+                    old_prefix = new_prefix = ""
+                new_name = new_prefix + name[len(old_prefix) :]
+                renames.append(
+                    (os.path.join(old_dir, name), os.path.join(new_dir, new_name))
+                )
+
+        # before the renames, lectures may move onto the names of changed ones
+        self._supersede(superseded)
+        self._rename(renames)
+
+        options_changed = False
+        for item, options in kept:
+            if options != self.options:
+                options_changed = True
+                continue
+            item_dir = os.path.join(self.course_dir, item["dir"])
+            if self._is_complete(item_dir, item["prefixes"]):
+                counts["unchanged"] += 1
+                skip.add(item["id"])
+
+        current_ids = {str(item["id"]) for item in items}
+        removed = len([i for i in previous if i not in current_ids])
+        logger.info(
+            f"> Sync: {counts['new']} new, {counts['changed']} changed, {counts['renamed']} renamed, {counts['unchanged']} up to date, {removed} removed from the course"
+        )
+        if options_changed:
+            logger.info(
+                "> Sync: download options changed since the last run, every lecture will be checked"
+            )
+
+        self._planned = {str(item["id"]): item for item in items}
+        with self._lock:
+            self._save()
+        return skip
+
+    def complete(self, item_id):
+        """
+        Records a lecture as downloaded: the files of its previous version are deleted and
+        its snapshot entry is brought up to date
+        """
+        item = self._planned.get(str(item_id))
+        if item is None:
+            return
+        shutil.rmtree(self._superseded_path(item_id), ignore_errors=True)
+        self._remove_superseded_dir()
+        with self._lock:
+            self._entries[str(item_id)] = self._entry(item, self.options)
+            self._save()
+
+    def abandon(self, item_id):
+        """
+        The download of a lecture failed, the files of its previous version are put back
+        and its snapshot entry is left as it was
+        """
+        self._restore(self._superseded_path(item_id))
+        self._remove_superseded_dir()
+
+    def _remove_superseded_dir(self):
+        # once no other lecture has files waiting in it
+        try:
+            os.rmdir(self.superseded_dir)
+        except OSError:
+            pass
+
+    def _entry(self, item: dict, options: dict) -> dict:
+        return {
+            "signature": item["signature"],
+            "dir": item["dir"],
+            "prefixes": item["prefixes"],
+            "asset_prefix": item.get("asset_prefix"),
+            "options": options,
+        }
+
+    def _superseded_path(self, item_id) -> str:
+        # ids are `<class>:<id>`, which isn't a valid file name everywhere
+        return os.path.join(self.superseded_dir, str(item_id).replace(":", "-"))
+
+    def _supersede(self, superseded: dict):
+        """
+        Moves the files of changed lectures aside, keeping their path relative to the
+        course directory
+        """
+        for item_id, paths in superseded.items():
+            target_dir = self._superseded_path(item_id)
+            for path in paths:
+                target = os.path.join(
+                    target_dir, os.path.relpath(path, self.course_dir)
+                )
+                try:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(path, target)
+                except OSError as e:
+                    logger.warning(f"> Sync: failed to move {path} aside: {e}")
+
+    def _restore(self, target_dir: str):
+        """
+        Moves files that were set aside back to where they were, over anything a failed
+        download left there
+        """
+        if not os.path.isdir(target_dir):
+            return
+        for root, _, names in os.walk(target_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                original = os.path.join(
+                    self.course_dir, os.path.relpath(path, target_dir)
+                )
+                try:
+                    os.makedirs(os.path.dirname(original), exist_ok=True)
+                    os.replace(path, original)
+                except OSError as e:
+                    logger.warning(f"> Sync: failed to restore {original}: {e}")
+                    continue
+                logger.info(
+                    f"    > Restored {os.path.relpath(original, self.course_dir)}"
+                )
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    def _restore_superseded(self):
+        """
+        Puts back the files a previous, interrupted run moved aside, the snapshot still
+        has the entries of their lectures
+        """
+        if not os.path.isdir(self.superseded_dir):
+            return
+        for name in os.listdir(self.superseded_dir):
+            self._restore(os.path.join(self.superseded_dir, name))
+        shutil.rmtree(self.superseded_dir, ignore_errors=True)
+
+    def _rename(self, renames: list):
+        """
+        Moves files in two steps through temporary names, so lectures that swapped
+        numbers don't overwrite each other
+        """
+        staged = []
+        for index, (src, dst) in enumerate(renames):
+            tmp = os.path.join(os.path.dirname(src), f".sync-{index}.tmp")
+            try:
+                os.replace(src, tmp)
+            except OSError as e:
+                logger.warning(f"> Sync: failed to rename {src}: {e}")
+                continue
+            staged.append((tmp, src, dst))
+
+        for tmp, src, dst in staged:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst):
+                logger.warning(f"> Sync: {dst} already exists, keeping {src}")
+                os.replace(tmp, src)
+                continue
+            os.replace(tmp, dst)
+            logger.info(
+                f"    > Renamed {os.path.relpath(src, self.course_dir)} -> {os.path.relpath(dst, self.course_dir)}"
+            )
+
+    def _save(self):
+        snapshot = {"lectures": self._entries}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, encoding="utf8", mode="w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+RATE_RE = re.compile(r"^\s*(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>[KMG]?)i?B?\s*$", re.I)
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(rate_str: str) -> int:
+    """
+    Parses a rate like "500K", "20M" or "1.5G" into bytes per second
+    """
+    match = RATE_RE.match(rate_str)
+    if not match:
+        raise ValueError(f"Invalid rate: {rate_str}")
+    value = float(match.group("value"))
+    return int(value * RATE_UNITS[match.group("unit").upper()])
+
+
+class RateLimiter(object):
+    """
+    Keeps the fragments of a download under a byte rate, shared by its workers
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes: int):
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + nbytes / self.rate
+            delay = self._next - now - nbytes / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Lease(object):
+    def __init__(
+        self,
+        connections: int,
+        rate: Optional[int],
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.connections = connections
+        # bytes per second, None when there is no bandwidth limit
+        self.rate = rate
+        # the limiter shared by every in-process download, None without a bandwidth limit
+        self.limiter = limiter
+
+
+class DownloadBudget(object):
+    """
+    Process wide budget of connections and bandwidth shared by every downloader invocation.
+
+    Each invocation leases a number of connections before it starts and gives them back
+    when it exits, blocking while the budget is exhausted.
+
+    When a bandwidth limit is set, the in-process downloaders all draw from one limiter,
+    so the bandwidth a download doesn't use goes to the others. External downloaders
+    (yt-dlp, aria2c) take a fixed rate when they start: the limit divided among the
+    running leases in proportion to their connections, all of it for a download running
+    alone.
+    """
+
+    # used to split the bandwidth when only a rate limit was given
+    DEFAULT_MAX_CONNECTIONS = 32
+
+    def __init__(
+        self, max_connections: Optional[int] = None, max_rate: Optional[int] = None
+    ):
+        if max_rate and not max_connections:
+            max_connections = self.DEFAULT_MAX_CONNECTIONS
+        self.max_connections = max_connections
+        self.max_rate = max_rate
+        self._available = max_connections
+        self._active = 0
+        self._cond = threading.Condition()
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+
+    @property
+    def limited(self) -> bool:
+        return self.max_connections is not None
+
+    def acquire(self, connections: int) -> Lease:
+        if not self.limited:
+            return Lease(connections, None)
+
+        connections = max(1, min(connections, self.max_connections))
+        with self._cond:
+            while self._available < connections:
+                self._cond.wait()
+            self._available -= connections
+            self._active += connections
+            active = self._active
+
+        rate = None
+        if self.max_rate:
+            rate = max(1, self.max_rate * connections // active)
+        return Lease(connections, rate, self.limiter)
+
+    def release(self, lease: Lease):
+        if not self.limited:
+            return
+        with self._cond:
+            self._available += lease.connections
+            self._active -= lease.connections
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self, connections: int):
+        lease = self.acquire(connections)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
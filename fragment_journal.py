@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger("udemy-downloader")
+
+JOURNAL_FILE = "fragments.json"
+# the journal is written at most this often while fragments complete, and always on save()
+SAVE_INTERVAL = 1.0
+
+
+def _to_ranges(indexes) -> list:
+    """
+    Packs fragment indexes into [start, end) ranges, a long lecture has thousands of them
+    """
+    ranges = []
+    for index in sorted(indexes):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+def _from_ranges(ranges) -> set:
+    return {index for start, end in ranges for index in range(start, end)}
+
+
+class FragmentJournal(object):
+    """
+    Record of the fragments of each representation of a DRM lecture that have been
+    downloaded, kept in the lecture's working directory next to the partial tracks so a
+    retry or a later run only fetches what is missing.
+
+    A journal belongs to one format id, the video and audio representations picked for the
+    lecture. When the lecture is downloaded again with another format (the quality setting
+    or the manifest changed), the partial tracks on disk are of no use and `matches` is
+    False.
+    """
+
+    def __init__(self, work_dir: str, format_id: str):
+        self.path = os.path.join(work_dir, JOURNAL_FILE)
+        self.format_id = format_id
+        self.matches = False
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self._saved_at = 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("format_id") != format_id:
+            return
+        self.matches = True
+        for rep_id, track in data.get("tracks", {}).items():
+            self._tracks[rep_id] = {
+                "total": track.get("total"),
+                "done": _from_ranges(track.get("done", [])),
+                "complete": track.get("complete", False),
+                "bytes": track.get("bytes"),
+            }
+
+    def _track(self, rep_id: str) -> dict:
+        if rep_id not in self._tracks:
+            self._tracks[rep_id] = {
+                "total": None,
+                "done": set(),
+                "complete": False,
+                "bytes": None,
+            }
+        return self._tracks[rep_id]
+
+    def reset(self):
+        with self._lock:
+            self._tracks = {}
+        self.matches = True
+        self.save()
+
+    def reset_track(self, rep_id: str):
+        with self._lock:
+            self._tracks.pop(rep_id, None)
+
+    def set_total(self, rep_id: str, total: int):
+        with self._lock:
+            self._track(rep_id)["total"] = total
+
+    def mark_done(self, rep_id: str, *indexes: int, size: Optional[int] = None):
+        """
+        Records downloaded fragments. `size` is the length of the partial track once they
+        are written, None when the downloader doesn't say
+        """
+        with self._lock:
+            track = self._track(rep_id)
+            track["done"].update(indexes)
+            # keep the length a previous call recorded, resuming depends on it
+            if size is not None:
+                track["bytes"] = size
+            if track["total"] is not None and len(track["done"]) >= track["total"]:
+                track["complete"] = True
+        self.save(force=False)
+
+    def mark_complete(self, rep_id: str):
+        with self._lock:
+            self._track(rep_id)["complete"] = True
+
+    def is_complete(self, rep_id: str) -> bool:
+        with self._lock:
+            return self._track(rep_id)["complete"]
+
+    def done(self, rep_id: str) -> set:
+        with self._lock:
+            return set(self._track(rep_id)["done"])
+
+    def size(self, rep_id: str) -> Optional[int]:
+        with self._lock:
+            return self._track(rep_id)["bytes"]
+
+    def missing(self, rep_id: str, total: Optional[int] = None) -> Optional[list]:
+        """
+        The indexes of the fragments of a representation that still have to be fetched,
+        or None if the number of fragments isn't known
+        """
+        with self._lock:
+            track = self._track(rep_id)
+            if track["complete"]:
+                return []
+            total = total if total is not None else track["total"]
+            if total is None:
+                return None
+            return [i for i in range(total) if i not in track["done"]]
+
+    def describe(self) -> str:
+        with self._lock:
+            parts = []
+            for rep_id, track in self._tracks.items():
+                if track["complete"]:
+                    parts.append(f"{rep_id} complete")
+                elif track["total"]:
+                    parts.append(
+                        f"{rep_id} {len(track['done'])}/{track['total']} fragment(s)"
+                    )
+                else:
+                    parts.append(f"{rep_id} {len(track['done'])} fragment(s)")
+        return ", ".join(parts) or "nothing downloaded yet"
+
+    def save(self, force: bool = True):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._saved_at < SAVE_INTERVAL:
+                return
+            self._saved_at = now
+            data = {
+                "format_id": self.format_id,
+                "tracks": {
+                    rep_id: {
+                        "total": track["total"],
+                        "done": _to_ranges(track["done"]),
+                        "complete": track["complete"],
+                        "bytes": track["bytes"],
+                    }
+                    for rep_id, track in self._tracks.items()
+                },
+            }
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.debug(f"Failed to save the fragment journal: {e}")
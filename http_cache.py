@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+logger = logging.getLogger("udemy-downloader")
+
+# (url pattern, seconds to keep the response), the first match wins. Responses of urls
+# that match none of them are never cached
+DEFAULT_TTLS = [
+    # lectures carry signed media urls that expire after a while
+    (re.compile(r"/api-2\.0/courses/\d+/subscriber-curriculum-items/"), 30 * 60),
+    (re.compile(r"/api-2\.0/quizzes/\d+/assessments/"), 7 * 24 * 60 * 60),
+    (re.compile(r"/api-2\.0/courses/\d+/(?:\?|$)"), 24 * 60 * 60),
+    (re.compile(r"/api-2\.0/users/me/subscribed-courses"), 60 * 60),
+    (re.compile(r"/api-2\.0/users/me/subscription-course-enrollments"), 60 * 60),
+]
+
+
+def credentials_identity(headers, cookies) -> str:
+    """
+    Identifies the account a session is logged in as, to key its cached responses on.
+
+    That is the bearer token, or the access_token cookie when logged in with browser
+    cookies. Only a hash of it is kept, it ends up in the cache keys
+    """
+    token = headers.get("X-Udemy-Authorization")
+    if not token:
+        # the jar can hold the cookie for several domains, which get() refuses
+        jar = getattr(cookies, "jar", cookies)
+        token = next(
+            (cookie.value for cookie in jar if cookie.name == "access_token"), None
+        )
+    if not token:
+        return ""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class CachedResponse(object):
+    """
+    The parts of a response the API helpers use, rebuilt from a cache entry
+    """
+
+    from_cache = True
+
+    def __init__(self, entry: dict):
+        self.url = entry["url"]
+        self.status_code = entry["status_code"]
+        self.headers = entry["headers"]
+        self.text = entry["body"]
+        self.content = self.text.encode("utf-8")
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise ValueError(f"HTTP {self.status_code} for {self.url}")
+
+
+class HttpCache(object):
+    """
+    On-disk cache of API responses, keyed by url, query parameters and the credentials
+    they were fetched with.
+
+    Every endpoint gets its own lifetime from the ttl rules. Stale entries that came with
+    an ETag or Last-Modified header are revalidated with a conditional request instead of
+    being fetched again. Once the cache grows past `max_size` bytes, the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int = 256 * 1024**2, ttls=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def ttl_for(self, url: str) -> Optional[int]:
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def _key(self, url: str, params: Optional[dict], identity: str) -> str:
+        if params:
+            url = (
+                f"{url}{'&' if '?' in url else '?'}{urlencode(sorted(params.items()))}"
+            )
+        return hashlib.sha256(f"{identity}\n{url}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        """
+        Yields the path, size and last use time of every entry
+        """
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, url: str, params: Optional[dict], identity: str) -> Optional[dict]:
+        """
+        Returns the cache entry for a request, fresh or not, or None if there is none
+        """
+        if self.ttl_for(url) is None:
+            return None
+        path = self._path(self._key(url, params, identity))
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # the modification time is the last use, for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        entry["fresh"] = time.time() < entry["expires"]
+        return entry
+
+    def conditional_headers(self, entry: dict) -> dict:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, entry: dict) -> CachedResponse:
+        with self._lock:
+            self.hits += 1
+        return CachedResponse(entry)
+
+    def update(
+        self,
+        url: str,
+        params: Optional[dict],
+        identity: str,
+        entry: Optional[dict],
+        response,
+    ):
+        """
+        Handles the response to a request that missed the cache or revalidated a stale
+        entry. A 304 Not Modified extends the life of the entry, successful responses of
+        cacheable endpoints are stored
+
+        Returns:
+            The response to hand to the caller
+        """
+        key = self._key(url, params, identity)
+        ttl = self.ttl_for(url)
+        if entry and response.status_code == 304:
+            entry["expires"] = time.time() + ttl
+            self._write(key, entry)
+            return self.hit(entry)
+
+        if ttl is None:
+            return response
+        with self._lock:
+            self.misses += 1
+        if response.status_code != 200:
+            return response
+        entry = {
+            "url": url,
+            "status_code": response.status_code,
+            "headers": dict(response.headers.items()),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "expires": time.time() + ttl,
+            "body": response.text,
+        }
+        self._write(key, entry)
+        return response
+
+    def _write(self, key: str, entry: dict):
+        entry = {k: v for k, v in entry.items() if k != "fresh"}
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            new_size = os.path.getsize(tmp_path)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.debug(f"Failed to write the http cache entry {key}: {e}")
+            return
+        with self._lock:
+            self._size += new_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache is down to 90% of its cap
+        """
+        target = self.max_size * 0.9
+        for path, size, _ in sorted(self._entries(), key=lambda e: e[2]):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
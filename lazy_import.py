@@ -0,0 +1,54 @@
+import importlib
+import threading
+import time
+
+# seconds each lazily imported module took to import, in the order they were first used
+IMPORT_TIMES = {}
+_lock = threading.Lock()
+
+
+class LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, then imports it.
+
+    The heavy dependencies (yt-dlp, browser_cookie3, curl_cffi, protobuf...) are only
+    needed by some stages of a run, a captions only or --info run shouldn't pay for
+    importing all of them at startup.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    IMPORT_TIMES[self._name] = time.perf_counter() - started
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not imported yet"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def import_report() -> list:
+    """
+    The lazily imported modules and their import times, slowest first
+    """
+    with _lock:
+        times = list(IMPORT_TIMES.items())
+    return [
+        f"{seconds * 1000:8.1f} ms  {name}"
+        for name, seconds in sorted(times, key=lambda item: item[1], reverse=True)
+    ]
@@ -1,34 +1,71 @@
 # -*- coding: utf-8 -*-
 import argparse
+import copy
 import json
 import logging
 import math
 import os
+import queue
 import re
+import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
 from typing import IO, Union
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+# the imports below are timed for --startup-report
+imports_started = time.perf_counter()
 
-import browser_cookie3
-import demoji
-import m3u8
 import requests
-from curl_cffi import requests as requests2
-import yt_dlp
-from bs4 import BeautifulSoup
 from coloredlogs import ColoredFormatter
 from dotenv import load_dotenv
 from pathvalidate import sanitize_filename
 from requests.exceptions import ConnectionError as conn_error
 from tqdm import tqdm
 
+from aria2_rpc import Aria2RPC, Aria2RPCError
+from asset_store import AssetStore
 from constants import *
+from concurrency_controller import AIMDController
+from course_sync import CourseSync
+from download_budget import DownloadBudget, parse_rate
+from fragment_journal import FragmentJournal
+from http_cache import HttpCache, credentials_identity
+from lazy_import import import_report, lazy_import
+from manifest_cache import MPD_CACHE_TTL, ManifestCache
+from mpd_resolver import dash_sources, parse_mpd_formats
+from range_downloader import RangeDownloader
+from segment_downloader import (
+    DownloadStats,
+    FragmentDownloader,
+    FragmentError,
+    UnsupportedManifest,
+    dash_fragments,
+    get_session,
+    hls_fragments,
+    read_manifest,
+)
+from state_db import StateDB
+from template_renderer import TemplateSet
 from tls import SSLCiphers
-from utils import extract_kid
-from vtt_to_srt import convert
+from tool_probe import ToolProbe
+from utils import extract_kid, extract_mpd_kids
+
+# only imported by the stages that use them
+asyncio = lazy_import("asyncio")
+browser_cookie3 = lazy_import("browser_cookie3")
+demoji = lazy_import("demoji")
+m3u8 = lazy_import("m3u8")
+requests2 = lazy_import("curl_cffi.requests")
+vtt_to_srt = lazy_import("vtt_to_srt")
+yt_dlp = lazy_import("yt_dlp")
+
+imports_done = time.perf_counter()
 
 DOWNLOAD_DIR = os.path.join(os.getcwd(), "out_dir")
 MAIN_SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -63,6 +100,58 @@ browser = None
 cj = None
 use_continuous_lecture_numbers = False
 chapter_filter = None
+parallel_lectures = 1
+use_pipeline = False
+download_workers = 1
+mux_workers = 1
+finalize_workers = 1
+segment_pipeline = None
+download_budget = DownloadBudget()
+fragment_controller: AIMDController = None
+http_cache: HttpCache = None
+use_aria2_daemon = False
+# fetch hls and dash fragments in process instead of through yt-dlp
+use_native_downloader = False
+# pipe drm tracks into ffmpeg as they download instead of writing them to disk first
+stream_mux = False
+startup_report = False
+tool_probe: ToolProbe = None
+# when the tools were found and the run could start, for --startup-report
+startup_ready = None
+aria2_daemon: Aria2RPC = None
+prefetch_lectures = 0
+page_concurrency = 4
+page_retries = 5
+# times a failed drm track download is resumed before the lecture is given up on
+segment_retries = 2
+use_async_api = False
+api_concurrency = 8
+batch_file = None
+all_enrolled = False
+parallel_courses = 1
+use_sync = False
+retry_failed = False
+state_db: StateDB = None
+manifest_cache: ManifestCache = None
+html_templates: TemplateSet = None
+asset_store: AssetStore = None
+
+
+def prune_temp_playlists(max_age: int = 24 * 60 * 60):
+    """
+    Removes hls playlists older than a day from the temp folder, their signed urls have
+    expired by then
+    """
+    temp_path = Path(HOME_DIR, "temp")
+    if not temp_path.is_dir():
+        return
+    cutoff = time.time() - max_age
+    for path in temp_path.glob("index_*.m3u8"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
 
 
 def deEmojify(inputStr: str):
@@ -77,6 +166,36 @@ def log_subprocess_output(prefix: str, pipe: IO[bytes]):
         pipe.flush()
 
 
+class OrderedLogBuffer(logging.Filter):
+    """
+    Holds back records logged by lecture worker threads so that each lecture's output
+    can be flushed as a single block, in curriculum order
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(self._local, "records", None)
+        if records is None or getattr(record, "unbuffered", False):
+            return True
+        records.append(record)
+        return False
+
+    def capture(self):
+        self._local.records = []
+
+    def release(self) -> list:
+        records = getattr(self._local, "records", None) or []
+        self._local.records = None
+        return records
+
+
+log_buffer = OrderedLogBuffer()
+_external_links_lock = threading.Lock()
+
+
 def parse_chapter_filter(chapter_str: str):
     """
     Given a string like "1,3-5,7,9-11", return a set of chapter numbers.
@@ -101,7 +220,7 @@ def parse_chapter_filter(chapter_str: str):
 
 # this is the first function that is called, we parse the arguments, setup the logger, and ensure that required directories exist
 def pre_run():
-    global dl_assets, dl_captions, dl_quizzes, skip_lectures, caption_locale, quality, bearer_token, course_name, keep_vtt, skip_hls, concurrent_downloads, load_from_file, save_to_file, bearer_token, course_url, info, logger, keys, id_as_course_name, LOG_LEVEL, use_h265, h265_crf, h265_preset, use_nvenc, browser, is_subscription_course, DOWNLOAD_DIR, use_continuous_lecture_numbers, chapter_filter
+    global dl_assets, dl_captions, dl_quizzes, skip_lectures, caption_locale, quality, bearer_token, course_name, keep_vtt, skip_hls, concurrent_downloads, load_from_file, save_to_file, bearer_token, course_url, info, logger, keys, id_as_course_name, LOG_LEVEL, use_h265, h265_crf, h265_preset, use_nvenc, browser, is_subscription_course, DOWNLOAD_DIR, use_continuous_lecture_numbers, chapter_filter, parallel_lectures, use_pipeline, download_workers, mux_workers, finalize_workers, download_budget, use_aria2_daemon, prefetch_lectures, page_concurrency, use_async_api, api_concurrency, batch_file, all_enrolled, parallel_courses, fragment_controller, http_cache, use_sync, retry_failed, state_db, manifest_cache, html_templates, asset_store, use_native_downloader, stream_mux, startup_report, tool_probe
 
     # make sure the logs directory exists
     if not os.path.exists(LOG_DIR_PATH):
@@ -114,7 +233,24 @@ def pre_run():
         dest="course_url",
         type=str,
         help="The URL of the course to download",
-        required=True,
+    )
+    parser.add_argument(
+        "--batch-file",
+        dest="batch_file",
+        type=str,
+        help="A file with the URLs of the courses to download, one per line",
+    )
+    parser.add_argument(
+        "--all-enrolled",
+        dest="all_enrolled",
+        action="store_true",
+        help="Download every course you are enrolled in, including archived courses",
+    )
+    parser.add_argument(
+        "--parallel-courses",
+        dest="parallel_courses",
+        type=int,
+        help="The number of courses to process at the same time in batch mode (Default is 1)",
     )
     parser.add_argument(
         "-b",
@@ -144,6 +280,147 @@ def pre_run():
         type=int,
         help="The number of maximum concurrent downloads for segments (HLS and DASH, must be a number 1-30)",
     )
+    parser.add_argument(
+        "--adaptive-concurrency",
+        dest="adaptive_concurrency",
+        action="store_true",
+        help="If specified, the number of concurrent segment downloads is adjusted after every lecture based on the measured throughput and errors, starting from --concurrent-downloads",
+    )
+    parser.add_argument(
+        "--sync",
+        dest="use_sync",
+        action="store_true",
+        help="If specified, only lectures that are new or changed since the last run are processed, and renumbered lectures are renamed in place",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        dest="retry_failed",
+        action="store_true",
+        help="If specified, only lectures that failed to download in a previous run are processed",
+    )
+    parser.add_argument(
+        "--no-state-db",
+        dest="no_state_db",
+        action="store_true",
+        help="If specified, download progress is not tracked in .udemy-downloader.db in the output directory (files left incomplete by a crash can't be told apart from finished ones, --retry-failed has nothing to retry)",
+    )
+    parser.add_argument(
+        "--parallel-lectures",
+        dest="parallel_lectures",
+        type=int,
+        help="The number of lectures to process at the same time (Default is 1)",
+    )
+    parser.add_argument(
+        "--prefetch-lectures",
+        dest="prefetch_lectures",
+        type=int,
+        help="The number of lectures ahead of the current one to resolve media sources for in the background (Default is 0, disabled)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="use_pipeline",
+        action="store_true",
+        help="If specified, DRM lectures are downloaded, muxed and finalized in separate stages that run at the same time",
+    )
+    parser.add_argument(
+        "--download-workers",
+        dest="download_workers",
+        type=int,
+        help="The number of DRM lectures downloading at the same time when using --pipeline (Default is 1)",
+    )
+    parser.add_argument(
+        "--mux-workers",
+        dest="mux_workers",
+        type=int,
+        help="The number of ffmpeg mux processes running at the same time when using --pipeline (Default is 1)",
+    )
+    parser.add_argument(
+        "--finalize-workers",
+        dest="finalize_workers",
+        type=int,
+        help="The number of workers renaming and cleaning up muxed lectures when using --pipeline (Default is 1)",
+    )
+    parser.add_argument(
+        "--max-connections",
+        dest="max_connections",
+        type=int,
+        help="The maximum number of connections shared by all running downloads (yt-dlp and aria2c)",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        dest="max_bandwidth",
+        type=str,
+        help="The maximum download rate shared by all running downloads, in bytes per second (e.g. 500K, 20M)",
+    )
+    parser.add_argument(
+        "--downloader",
+        dest="downloader",
+        type=str,
+        choices=["yt-dlp", "native"],
+        default="yt-dlp",
+        help="The downloader used for segments and files, native fetches them in process without starting yt-dlp and aria2c (Default is yt-dlp)",
+    )
+    parser.add_argument(
+        "--stream-mux",
+        dest="stream_mux",
+        action="store_true",
+        help="If specified, DRM tracks are downloaded straight into ffmpeg instead of being written to disk first, so the muxed lecture is the only full size file (uses the native downloader, not available on Windows)",
+    )
+    parser.add_argument(
+        "--startup-report",
+        dest="startup_report",
+        action="store_true",
+        help="If specified, the time spent importing modules and looking for external tools is logged at the end of the run",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="If specified, API responses and lecture manifests are not cached on disk",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        dest="no_dedup",
+        action="store_true",
+        help="If specified, assets that were already downloaded for another lecture or course are downloaded again instead of being copied from the asset store",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        dest="clear_cache",
+        action="store_true",
+        help="If specified, the API response and manifest caches are emptied before starting",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=256,
+        help="The maximum size of the API response cache in MiB, the least recently used responses are removed first (Default is 256)",
+    )
+    parser.add_argument(
+        "--aria2-daemon",
+        dest="use_aria2_daemon",
+        action="store_true",
+        help="If specified, a single aria2c process is kept running and files are queued on it over RPC instead of starting aria2c for every file",
+    )
+    parser.add_argument(
+        "--page-concurrency",
+        dest="page_concurrency",
+        type=int,
+        help="The number of API result pages (curriculum, course lists) to fetch at the same time (Default is 4)",
+    )
+    parser.add_argument(
+        "--async-api",
+        dest="use_async_api",
+        action="store_true",
+        help="If specified, course information, curriculum and quizzes are fetched with an async client that keeps many requests in flight",
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        dest="api_concurrency",
+        type=int,
+        help="The maximum number of API requests in flight when using --async-api (Default is 8)",
+    )
     parser.add_argument(
         "--skip-lectures",
         dest="skip_lectures",
@@ -282,6 +559,10 @@ def pre_run():
     # parser.add_argument("-v", "--version", action="version", version="You are running version {version}".format(version=__version__))
 
     args = parser.parse_args()
+    if not (args.course_url or args.batch_file or args.all_enrolled):
+        parser.error(
+            "one of the arguments -c/--course-url, --batch-file or --all-enrolled is required"
+        )
     if args.download_assets:
         dl_assets = True
     if args.lang:
@@ -307,6 +588,24 @@ def pre_run():
         elif concurrent_downloads > 30:
             # if the user gave a number thats greater than 30, set cc to the max of 30
             concurrent_downloads = 30
+    if args.page_concurrency:
+        page_concurrency = max(1, args.page_concurrency)
+    if args.use_async_api:
+        use_async_api = True
+    if args.api_concurrency:
+        api_concurrency = max(1, args.api_concurrency)
+    if args.parallel_lectures:
+        parallel_lectures = max(1, args.parallel_lectures)
+    if args.prefetch_lectures:
+        prefetch_lectures = max(0, args.prefetch_lectures)
+    if args.use_pipeline:
+        use_pipeline = True
+    if args.download_workers:
+        download_workers = max(1, args.download_workers)
+    if args.mux_workers:
+        mux_workers = max(1, args.mux_workers)
+    if args.finalize_workers:
+        finalize_workers = max(1, args.finalize_workers)
     if args.load_from_file:
         load_from_file = args.load_from_file
     if args.save_to_file:
@@ -315,6 +614,16 @@ def pre_run():
         bearer_token = args.bearer_token
     if args.course_url:
         course_url = args.course_url
+    if args.batch_file:
+        batch_file = args.batch_file
+    if args.all_enrolled:
+        all_enrolled = True
+    if args.parallel_courses:
+        parallel_courses = max(1, args.parallel_courses)
+    if args.use_sync:
+        use_sync = True
+    if args.retry_failed:
+        retry_failed = True
     if args.info:
         info = args.info
     if args.use_h265:
@@ -350,6 +659,30 @@ def pre_run():
     if args.use_continuous_lecture_numbers:
         use_continuous_lecture_numbers = args.use_continuous_lecture_numbers
 
+    max_rate = None
+    if args.max_bandwidth:
+        try:
+            max_rate = parse_rate(args.max_bandwidth)
+        except ValueError:
+            print(f"Invalid bandwidth limit: {args.max_bandwidth}; Ignoring it")
+    if args.use_aria2_daemon:
+        use_aria2_daemon = True
+    if args.downloader == "native":
+        use_native_downloader = True
+    if args.stream_mux:
+        if os.name == "nt":
+            print("Streaming into ffmpeg isn't supported on Windows; Ignoring it")
+        else:
+            stream_mux = True
+    if args.startup_report:
+        startup_report = True
+    if args.max_connections or max_rate:
+        download_budget = DownloadBudget(
+            max(1, args.max_connections) if args.max_connections else None, max_rate
+        )
+    if args.adaptive_concurrency:
+        fragment_controller = AIMDController(concurrent_downloads, 1, 30)
+
     # setup a logger
     logger = logging.getLogger(__name__)
     logging.root.setLevel(LOG_LEVEL)
@@ -373,11 +706,36 @@ def pre_run():
     logger.setLevel(LOG_LEVEL)
     logger.addHandler(stream)
     logger.addHandler(file_handler)
+    logger.addFilter(log_buffer)
 
     logger.info(f"Output directory set to {DOWNLOAD_DIR}")
 
     Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
     Path(SAVED_DIR).mkdir(parents=True, exist_ok=True)
+    tool_probe = ToolProbe(os.path.join(SAVED_DIR, "tools.json"))
+    if args.no_state_db:
+        if retry_failed:
+            logger.warning("> --retry-failed has no effect with --no-state-db")
+        state_db = StateDB(None)
+    else:
+        state_db = StateDB(os.path.join(DOWNLOAD_DIR, ".udemy-downloader.db"))
+
+    if not args.no_cache:
+        http_cache = HttpCache(
+            os.path.join(SAVED_DIR, "http_cache"), max(1, args.cache_size) * 1024**2
+        )
+        manifest_cache = ManifestCache(os.path.join(SAVED_DIR, "manifests"))
+        if args.clear_cache:
+            http_cache.clear()
+            manifest_cache.clear()
+            logger.info("> Cleared the API response and manifest caches")
+        else:
+            manifest_cache.prune()
+    prune_temp_playlists()
+    if not args.no_dedup:
+        asset_store = AssetStore(os.path.join(DOWNLOAD_DIR, ".udemy-downloader-store"))
+        asset_store.prune()
+    html_templates = TemplateSet(os.path.join(MAIN_SCRIPT_PATH, "templates"))
 
     # Get the keys
     if os.path.exists(KEY_FILE_PATH):
@@ -394,11 +752,46 @@ def pre_run():
         logger.info("Chapter filter applied: %s", sorted(chapter_filter))
 
 
+class PaginationError(Exception):
+    """
+    A page of a paginated endpoint failed after every retry. The pages fetched before it
+    are kept, so paginating the same endpoint again only fetches the missing ones
+    """
+
+    def __init__(self, url, page, error):
+        super().__init__(f"Failed to fetch page {page} of {url}: {error}")
+        self.url = url
+        self.page = page
+
+
 class Udemy:
     def __init__(self, bearer_token):
         self.session = None
+        self.async_session = None
         self.bearer_token = bearer_token
         self.auth = UdemyAuth(cache_session=False)
+        self._quiz_cache = {}
+        # enrolled and archived course lists, keyed by portal
+        self._courses_cache = {}
+        self._courses_lock = threading.Lock()
+        # key ids of the representations of dash manifests, keyed by asset id
+        self._mpd_kids = {}
+        # the sources of the manifests parsed by the key check, for _extract_mpd
+        self._mpd_sources = {}
+        self._mpd_kids_lock = threading.Lock()
+        # pages of a pagination that hasn't completed yet, keyed by url and parameters
+        self._pages = {}
+
+    def fork(self):
+        """
+        Returns a new Udemy object sharing this one's authenticated session and course
+        lists, so several courses can be processed at once without logging in again
+        """
+        udemy = copy.copy(self)
+        udemy.async_session = None
+        udemy._quiz_cache = {}
+        udemy._pages = {}
+        return udemy
 
     def authenticate(self, portal_name):
         if not self.session:
@@ -450,9 +843,15 @@ class Udemy:
         #         ),
         #     }
         # )
+        if quiz_id in self._quiz_cache:
+            return self._quiz_cache.pop(quiz_id)
         url = URLS.QUIZ.format(portal_name=portal_name, quiz_id=quiz_id)
         return self._handle_pagination(url, None).get("results")
 
+    async def _get_quiz_async(self, quiz_id):
+        url = URLS.QUIZ.format(portal_name=portal_name, quiz_id=quiz_id)
+        return (await self._handle_pagination_async(url, None)).get("results")
+
     def _get_elem_value_or_none(self, elem, key):
         return elem[key] if elem and key in elem else "(None)"
 
@@ -675,7 +1074,7 @@ class Udemy:
                     )
         return _temp
 
-    def _extract_media_sources(self, sources):
+    def _extract_media_sources(self, sources, asset_id=None):
         _temp = []
         if sources and isinstance(sources, list):
             for source in sources:
@@ -683,7 +1082,7 @@ class Udemy:
                 src = source.get("src")
 
                 if _type == "application/dash+xml":
-                    out = self._extract_mpd(src)
+                    out = self._extract_mpd(src, asset_id)
                     if out:
                         _temp.extend(out)
         return _temp
@@ -721,16 +1120,24 @@ class Udemy:
         asset_id_re = re.compile(r"assets/(?P<id>\d+)/")
         _temp = []
 
-        # get temp folder
-        temp_path = Path(Path.cwd(), "temp")
-
-        # ensure the folder exists
-        temp_path.mkdir(parents=True, exist_ok=True)
-
         # # extract the asset id from the url
         asset_id = asset_id_re.search(url).group("id")
+        cache_key = f"hls-{asset_id}"
+        if manifest_cache:
+            cached = manifest_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            temp_path = manifest_cache.entry_dir(cache_key)
+        else:
+            # get temp folder
+            temp_path = Path(HOME_DIR, "temp")
+
+            # ensure the folder exists
+            temp_path.mkdir(parents=True, exist_ok=True)
 
         m3u8_path = Path(temp_path, f"index_{asset_id}.m3u8")
+        # the urls the playlists depend on, their tokens decide how long they can be cached
+        signed_urls = [url]
 
         try:
             r = self.session._get(url)
@@ -767,6 +1174,11 @@ class Udemy:
                     r.raise_for_status()
                     f.write(r.text)
 
+                signed_urls.append(pl.uri)
+                segments = m3u8.loads(r.text, uri=pl.uri).segments
+                if segments:
+                    signed_urls.append(segments[0].absolute_uri)
+
                 seen.add(height)
                 _temp.append(
                     {
@@ -779,12 +1191,64 @@ class Udemy:
                 )
         except Exception as error:
             logger.error(f"Udemy Says : '{error}' while fetching hls streams..")
+            return _temp
+
+        if manifest_cache and _temp:
+            manifest_cache.put(cache_key, _temp, signed_urls)
         return _temp
 
-    def _extract_mpd(self, url):
+    def _extract_mpd(self, url, asset_id=None):
         """extracts mpd streams"""
-        _temp = {}
+        # the format ids are the representation ids of the manifest, they don't depend on
+        # the signed url so the cached formats are used with the current url
+        cache_key = f"dash-{asset_id}" if manifest_cache and asset_id else None
+        if cache_key:
+            cached = manifest_cache.get(cache_key)
+            if cached is not None:
+                return [{**source, "download_url": url} for source in cached]
+        with self._mpd_kids_lock:
+            parsed = self._mpd_sources.get(asset_id or url)
+        if parsed is not None:
+            return [{**source, "download_url": url} for source in parsed]
+
+        try:
+            r = self.session._get(url)
+            r.raise_for_status()
+            _temp, _ = self._parse_mpd(r.text, url, asset_id)
+        except Exception as e:
+            logger.warning(f"> Failed to parse the MPD ({e}), trying with yt-dlp")
+            _temp = self._extract_mpd_ytdlp(url, asset_id)
+            if cache_key and _temp:
+                manifest_cache.put(cache_key, _temp, ttl=MPD_CACHE_TTL)
+
+        # We don't delete the mpd file yet because we can use it to download later
+        return _temp
+
+    def _parse_mpd(self, mpd, url, asset_id=None):
+        """Reads the sources and key ids of a DASH manifest and remembers both by asset,
+        so the key check and _extract_mpd share a single fetch and parse
+
+        Args:
+            mpd (str): The manifest
+            url (str): The URL it was fetched from
+            asset_id (int, optional): The asset the manifest belongs to. Defaults to None.
 
+        Returns:
+            tuple: The sources (see dash_sources) and the key id of every representation
+        """
+        formats = parse_mpd_formats(mpd)
+        sources = dash_sources(formats, url)
+        kids = {f["format_id"]: f["kid"] for f in formats if f["kid"]}
+        with self._mpd_kids_lock:
+            self._mpd_kids[asset_id or url] = kids
+            self._mpd_sources[asset_id or url] = sources
+        if manifest_cache and asset_id and sources:
+            manifest_cache.put(f"dash-{asset_id}", sources, ttl=MPD_CACHE_TTL)
+        return sources, kids
+
+    def _extract_mpd_ytdlp(self, url, asset_id=None):
+        """extracts mpd streams with yt-dlp, for manifests the native parser can't read"""
+        _temp = {}
         try:
             ytdl = yt_dlp.YoutubeDL(
                 {
@@ -807,6 +1271,8 @@ class Udemy:
             if not best_audio:
                 raise ValueError("No suitable audio format found in MPD")
             audio_format_id = best_audio.get("format_id")
+            # the format ids of a generic dash extraction are the representation ids
+            kids = self._extract_mpd_kids(url, asset_id)
 
             for format in formats:
                 video_format_id = format.get("format_id")
@@ -828,6 +1294,13 @@ class Udemy:
                         "extension": extension,
                         "download_url": url,
                         "tbr": round(tbr),
+                        "kids": sorted(
+                            {
+                                kids[rep_id]
+                                for rep_id in (video_format_id, audio_format_id)
+                                if rep_id in kids
+                            }
+                        ),
                     }
                 )
             # for each resolution, use only the highest bitrate
@@ -843,10 +1316,44 @@ class Udemy:
             _temp = _temp2
         except Exception:
             logger.exception(f"Error fetching MPD streams")
-
-        # We don't delete the mpd file yet because we can use it to download later
+            return []
         return _temp
 
+    def _extract_mpd_kids(self, url, asset_id=None):
+        """Reads the key ids of a DASH manifest from its cenc:default_KID attributes
+
+        Args:
+            url (str): The URL of the manifest
+            asset_id (int, optional): The asset the manifest belongs to, the key ids are
+                remembered by asset. Defaults to None.
+
+        Returns:
+            dict: The key id of every representation by representation id, empty if the
+                manifest doesn't list them or couldn't be read
+        """
+        key = asset_id or url
+        with self._mpd_kids_lock:
+            if key in self._mpd_kids:
+                return self._mpd_kids[key]
+
+        try:
+            r = self.session._get(url)
+            r.raise_for_status()
+        except Exception as e:
+            logger.warning(f"> Failed to read the key ids from the MPD: {e}")
+            kids = {}
+        else:
+            try:
+                # parsed in full, _extract_mpd uses the sources without fetching it again
+                _, kids = self._parse_mpd(r.text, url, asset_id)
+            except Exception:
+                # _extract_mpd falls back to yt-dlp for this manifest
+                kids = extract_mpd_kids(r.text)
+
+        with self._mpd_kids_lock:
+            self._mpd_kids[key] = kids
+        return kids
+
     def extract_course_name(self, url):
         """
         @author r0oth3x49
@@ -863,54 +1370,270 @@ class Udemy:
         if obj:
             return obj.group("portal_name")
 
+    def _fetch_page(self, url, params=None, page=1):
+        """Fetches a single page of a paginated endpoint, retrying it on failure
+
+        Args:
+            url (str): The URL of the page
+            params (dict, optional): Query parameters for the request. Defaults to None.
+            page (int, optional): The page number, only used for logging. Defaults to 1.
+
+        Returns:
+            dict: The decoded page
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                resp = self.session._get(url, params)
+                if resp.ok:
+                    return resp.json()
+                error = f"HTTP {resp.status_code}"
+                retry_after = resp.headers.get("Retry-After")
+            except (conn_error, requests2.RequestsError, ValueError) as e:
+                error = e
+                retry_after = None
+
+            time.sleep(self._page_retry_delay(url, page, attempt, error, retry_after))
+
+    async def _fetch_page_async(self, url, params=None, page=1):
+        """Async version of _fetch_page, going through the async session"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                resp = await self.async_session._get(url, params)
+                if resp.ok:
+                    return resp.json()
+                error = f"HTTP {resp.status_code}"
+                retry_after = resp.headers.get("Retry-After")
+            except (requests2.RequestsError, ValueError) as e:
+                error = e
+                retry_after = None
+
+            await asyncio.sleep(
+                self._page_retry_delay(url, page, attempt, error, retry_after)
+            )
+
+    @staticmethod
+    def _page_retry_delay(url, page, attempt, error, retry_after=None):
+        """Returns how long to wait before retrying a page, raises once out of retries"""
+        if attempt >= page_retries:
+            raise PaginationError(url, page, f"{error} after {attempt} attempts")
+
+        delay = 0.8 * 2 ** (attempt - 1)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        logger.warning(
+            f"Failed to fetch page {page} ({error}), retrying in {delay:.1f}s..."
+        )
+        return delay
+
+    @staticmethod
+    def _page_key(url, params):
+        return url, json.dumps(params, sort_keys=True)
+
+    def _cached_page(self, url, params=None, page=1):
+        """_fetch_page, returning the page from an earlier attempt at the pagination if it
+        has it"""
+        key = self._page_key(url, params)
+        if key not in self._pages:
+            self._pages[key] = self._fetch_page(url, params, page)
+        return self._pages[key]
+
+    async def _cached_page_async(self, url, params=None, page=1):
+        key = self._page_key(url, params)
+        if key not in self._pages:
+            self._pages[key] = await self._fetch_page_async(url, params, page)
+        return self._pages[key]
+
+    def _forget_pages(self, initial_url, initial_params, urls):
+        self._pages.pop(self._page_key(initial_url, initial_params), None)
+        for url in urls:
+            self._pages.pop(self._page_key(url, None), None)
+
+    @staticmethod
+    def _page_url(url, page):
+        """Returns the given paginated URL pointed at another page number"""
+        parts = urlsplit(url)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        query["page"] = [str(page)]
+        return urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+
     def _handle_pagination(self, initial_url, initial_params=None):
         """Helper function to handle paginated requests and return all results
 
+        Once the first page is in, the remaining pages are fetched concurrently and
+        merged back in page order. Each page is retried on its own. When a page runs out
+        of retries, the pagination starts over `retry` times, keeping the pages it already
+        has, so only the missing ones are fetched again.
+
         Args:
             initial_url (str): The initial URL to fetch from
             initial_params (dict, optional): Query parameters for the initial request. Defaults to None.
 
         Returns:
             dict: Combined results from all pages
+
+        Raises:
+            PaginationError: A page still failed after every retry
         """
+        for attempt in range(1, retry + 1):
+            try:
+                return self._paginate(initial_url, initial_params)
+            except PaginationError as error:
+                if attempt == retry:
+                    raise
+                logger.warning(
+                    f"{error}, resuming with the {len(self._pages)} page(s) already fetched"
+                )
+                time.sleep(0.8)
+
+    def _paginate(self, initial_url, initial_params=None):
+        first = self._cached_page(initial_url, initial_params)
+        # the pages stay cached until the pagination completes, merge into a copy
+        data = dict(first)
+        if isinstance(first.get("results"), list):
+            data["results"] = list(first["results"])
+
+        _next = data.get("next")
+        _count = data.get("count")
+        urls = []
+
+        if _count is None:
+            logger.warning(f"API Response missing 'count'. Data: {data}")
+            self._forget_pages(initial_url, initial_params, urls)
+            return data.get("results", []) if "results" in data else []
+
+        results = data.get("results")
+        if not _next or not results:
+            self._forget_pages(initial_url, initial_params, urls)
+            return data
+
+        page_size = len(results)
+        est_page_count = math.ceil(_count / page_size)
+
         page = 1
-        try:
-            data = self.session._get(initial_url, initial_params).json()
-        except conn_error as error:
-            logger.fatal(f"Connection error: {error}")
-            time.sleep(0.8)
-            sys.exit(1)
-        else:
-            _next = data.get("next")
-            _count = data.get("count")
+        if "page" in parse_qs(urlsplit(_next).query) and est_page_count > 2:
+            pages = {}
+            urls = [self._page_url(_next, n) for n in range(2, est_page_count + 1)]
+            with ThreadPoolExecutor(
+                max_workers=page_concurrency, thread_name_prefix="page-fetch"
+            ) as executor:
+                futures = {
+                    executor.submit(self._cached_page, url, None, number): number
+                    for number, url in enumerate(urls, start=2)
+                }
+                for future in as_completed(futures):
+                    number = futures[future]
+                    try:
+                        pages[number] = future.result()
+                    except PaginationError:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    logger.info(
+                        f"> Downloading data page {len(pages) + 1}/{est_page_count}"
+                    )
 
-            if _count is None:
-                logger.warning(f"API Response missing 'count'. Data: {data}")
-                return data.get("results", []) if "results" in data else []
+            for number in sorted(pages):
+                data["results"].extend(pages[number].get("results") or [])
+            page = est_page_count
+            # the page count is an estimate, anything added while paging is picked up below
+            _next = pages[page].get("next") if page in pages else None
+
+        while _next:
+            logger.info(f"> Downloading data page {page + 1}/{est_page_count}")
+            resp = self._cached_page(_next, None, page + 1)
+            urls.append(_next)
+            _next = resp.get("next")
+            results = resp.get("results")
+            if results and isinstance(results, list):
+                data["results"].extend(results)
+            page = page + 1
+        self._forget_pages(initial_url, initial_params, urls)
+        return data
 
-            est_page_count = math.ceil(_count / 100)  # 100 is the max results per page
+    async def _handle_pagination_async(self, initial_url, initial_params=None):
+        """Async version of _handle_pagination
 
-            while _next:
-                logger.info(f"> Downloading data page {page + 1}/{est_page_count}")
-                try:
-                    resp = self.session._get(_next)
-                    if not resp.ok:
-                        logger.error(f"Failed to fetch page {page + 1}, retrying...")
-                        continue
-                    resp = resp.json()
-                except conn_error as error:
-                    logger.fatal(f"Connection error: {error}")
-                    time.sleep(0.8)
-                    sys.exit(1)
-                else:
-                    _next = resp.get("next")
-                    results = resp.get("results")
-                    if results and isinstance(results, list):
-                        for item in resp["results"]:
-                            data["results"].append(item)
-                        page = page + 1
+        All the remaining pages are requested at once, the async session limits how many
+        are actually in flight.
+
+        Args:
+            initial_url (str): The initial URL to fetch from
+            initial_params (dict, optional): Query parameters for the initial request. Defaults to None.
+
+        Returns:
+            dict: Combined results from all pages
+
+        Raises:
+            PaginationError: A page still failed after every retry
+        """
+        for attempt in range(1, retry + 1):
+            try:
+                return await self._paginate_async(initial_url, initial_params)
+            except PaginationError as error:
+                if attempt == retry:
+                    raise
+                logger.warning(
+                    f"{error}, resuming with the {len(self._pages)} page(s) already fetched"
+                )
+                await asyncio.sleep(0.8)
+
+    async def _paginate_async(self, initial_url, initial_params=None):
+        first = await self._cached_page_async(initial_url, initial_params)
+        data = dict(first)
+        if isinstance(first.get("results"), list):
+            data["results"] = list(first["results"])
+
+        _next = data.get("next")
+        _count = data.get("count")
+        urls = []
+
+        if _count is None:
+            logger.warning(f"API Response missing 'count'. Data: {data}")
+            self._forget_pages(initial_url, initial_params, urls)
+            return data.get("results", []) if "results" in data else []
+
+        results = data.get("results")
+        if not _next or not results:
+            self._forget_pages(initial_url, initial_params, urls)
             return data
 
+        est_page_count = math.ceil(_count / len(results))
+
+        page = 1
+        if "page" in parse_qs(urlsplit(_next).query) and est_page_count > 2:
+            urls = [self._page_url(_next, n) for n in range(2, est_page_count + 1)]
+            # every page is awaited to the end, so the ones that succeed are kept even
+            # when another fails
+            pages = await asyncio.gather(
+                *[
+                    self._cached_page_async(url, None, number)
+                    for number, url in enumerate(urls, start=2)
+                ],
+                return_exceptions=True,
+            )
+            for resp in pages:
+                if isinstance(resp, BaseException):
+                    raise resp
+            for resp in pages:
+                data["results"].extend(resp.get("results") or [])
+            page = est_page_count
+            _next = pages[-1].get("next")
+
+        while _next:
+            logger.info(f"> Downloading data page {page + 1}/{est_page_count}")
+            resp = await self._cached_page_async(_next, None, page + 1)
+            urls.append(_next)
+            _next = resp.get("next")
+            results = resp.get("results")
+            if results and isinstance(results, list):
+                data["results"].extend(results)
+            page = page + 1
+        self._forget_pages(initial_url, initial_params, urls)
+        return data
+
     def _get_subscribed_courses(self, portal_name):
         """
         Fetches the list of courses the user is subscribed to.
@@ -928,9 +1651,25 @@ class Udemy:
         return res["results"] if res and isinstance(res, dict) else []
 
     def _get_courses(self, portal_name):
-        a = self._get_subscribed_courses(portal_name)
-        b = self._get_subscription_course_enrollments(portal_name)
-        return a + b
+        with self._courses_lock:
+            if ("enrolled", portal_name) not in self._courses_cache:
+                a = self._get_subscribed_courses(portal_name)
+                b = self._get_subscription_course_enrollments(portal_name)
+                self._courses_cache[("enrolled", portal_name)] = a + b
+            return self._courses_cache[("enrolled", portal_name)]
+
+    async def _get_courses_async(self, portal_name):
+        urls = [
+            URLS.MY_COURSES.format(portal_name=portal_name),
+            URLS.SUBSCRIPTION_COURSES.format(portal_name=portal_name),
+        ]
+        responses = await asyncio.gather(
+            *[self._handle_pagination_async(url) for url in urls]
+        )
+        courses = []
+        for res in responses:
+            courses.extend(res["results"] if res and isinstance(res, dict) else [])
+        return courses
 
     def _extract_course_info_json(self, url, course_id):
         # self.session._headers.update({"Referer": url})
@@ -984,6 +1723,14 @@ class Udemy:
         return courses_lists
 
     def _archived_courses(self, portal_name):
+        with self._courses_lock:
+            if ("archived", portal_name) not in self._courses_cache:
+                self._courses_cache[("archived", portal_name)] = (
+                    self._fetch_archived_courses(portal_name)
+                )
+            return self._courses_cache[("archived", portal_name)]
+
+    def _fetch_archived_courses(self, portal_name):
         results = []
         try:
             url = URLS.MY_COURSES.format(portal_name=portal_name)
@@ -1001,6 +1748,28 @@ class Udemy:
             results = webpage.get("results", [])
         return results
 
+    def _enrolled_course_urls(self, portal_name):
+        """
+        Returns the URL of every course the user owns: enrolled, in a subscription
+        collection or archived
+        """
+        courses = (
+            self._get_courses(portal_name)
+            + self._subscribed_collection_courses(portal_name)
+            + self._archived_courses(portal_name)
+        )
+        urls = {}
+        for course in courses:
+            course_id = course.get("id")
+            published_title = course.get("published_title")
+            if course_id in urls or not published_title:
+                continue
+            urls[course_id] = (
+                f"https://{portal_name}.udemy.com/course/{published_title}/"
+            )
+        logger.info(f"> Found {len(urls)} enrolled course(s)")
+        return list(urls.values())
+
     # def _extract_subscription_course_info(self, url):
     #     course_html = self.session._get(url).text
     #     soup = BeautifulSoup(course_html, "lxml")
@@ -1042,6 +1811,64 @@ class Udemy:
 
             sys.exit(1)
 
+    async def _extract_course_info_async(self, url):
+        global portal_name
+        portal_name, course_name = self.extract_course_name(url)
+
+        results = self._courses_cache.get(("enrolled", portal_name))
+        if results is None:
+            results = await self._get_courses_async(portal_name=portal_name)
+        course = self._extract_course(response=results, course_name=course_name)
+        if not course:
+            # try archived courses
+            archived_url = URLS.MY_COURSES.format(portal_name=portal_name)
+            resp = await self.async_session._get(f"{archived_url}&is_archived=true")
+            results = resp.json().get("results", [])
+            course = self._extract_course(response=results, course_name=course_name)
+
+        if course:
+            return course.get("id"), course
+        logger.fatal("Failed to find the course, are you enrolled?")
+        sys.exit(1)
+
+    async def _fetch_course_metadata_async(self, url):
+        """
+        Fetches the course info, the curriculum and (if quizzes are being downloaded) every
+        quiz over an async session, with many requests in flight at once.
+
+        Returns:
+            tuple: The course id, the course info and the curriculum
+        """
+        self.async_session = AsyncSession.from_session(self.session, api_concurrency)
+        try:
+            course_id, course_info = await self._extract_course_info_async(url)
+            logger.info("> Course information retrieved!")
+            logger.info("> Fetching course curriculum, this may take a minute...")
+            curriculum = await self._handle_pagination_async(
+                URLS.CURRICULUM_ITEMS.format(
+                    portal_name=portal_name, course_id=course_id
+                ),
+                CURRICULUM_ITEMS_PARAMS,
+            )
+
+            if dl_quizzes:
+                quiz_ids = [
+                    entry.get("id")
+                    for entry in curriculum.get("results") or []
+                    if entry.get("_class") == "quiz" and entry.get("id")
+                ]
+                if quiz_ids:
+                    logger.info(f"> Fetching {len(quiz_ids)} quiz(zes)...")
+                    quizzes = await asyncio.gather(
+                        *[self._get_quiz_async(quiz_id) for quiz_id in quiz_ids]
+                    )
+                    self._quiz_cache.update(zip(quiz_ids, quizzes))
+
+            return course_id, course_info, curriculum
+        finally:
+            await self.async_session.terminate()
+            self.async_session = None
+
     def _parse_lecture(self, lecture: dict):
         retVal = []
 
@@ -1115,7 +1942,9 @@ class Udemy:
                 # encrypted
                 media_sources = asset.get("media_sources")
                 if media_sources and isinstance(media_sources, list):
-                    sources = self._extract_media_sources(media_sources)
+                    sources = self._extract_media_sources(
+                        media_sources, asset.get("id")
+                    )
                     tracks = asset.get("captions")
                     # duration = asset.get("time_estimation")
                     subtitles = self._extract_subtitles(tracks)
@@ -1169,6 +1998,23 @@ class Session(object):
         if "User-Agent" in headers:
             del headers["User-Agent"]
         self._session.headers.update(headers)
+        self._owner_thread = threading.get_ident()
+        self._local = threading.local()
+
+    def _thread_session(self):
+        """
+        curl handles can't be shared between threads, so worker threads get their own
+        session seeded with the headers and cookies of the main one
+        """
+        if threading.get_ident() == self._owner_thread:
+            return self._session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests2.Session(impersonate="chrome120")
+            session.headers.update(self._session.headers)
+            session.cookies.update(self._session.cookies)
+            self._local.session = session
+        return session
 
     def visit(self, portal_name: str) -> bool:
         """
@@ -1211,23 +2057,127 @@ class Session(object):
         if "timeout" not in kwargs:
             kwargs["timeout"] = 120
 
-        return self._session.get(url, **kwargs)
+        if not http_cache:
+            return self._thread_session().get(url, **kwargs)
+
+        cache_key = (url, kwargs.get("params"), self._cache_identity())
+        entry = http_cache.get(*cache_key)
+        if entry and entry["fresh"]:
+            return http_cache.hit(entry)
+        if entry:
+            kwargs["headers"] = {
+                **kwargs.get("headers", {}),
+                **http_cache.conditional_headers(entry),
+            }
+        resp = self._thread_session().get(url, **kwargs)
+        return http_cache.update(*cache_key, entry, resp)
+
+    def _cache_identity(self):
+        """
+        Cached responses are tied to the credentials they were fetched with
+        """
+        return credentials_identity(self._session.headers, self._session.cookies)
 
     def _post(self, url, data=None, **kwargs):
         if data:
             kwargs["data"] = data
-        return self._session.post(url, **kwargs)
+        return self._thread_session().post(url, **kwargs)
 
     def terminate(self):
         self._session.close()
 
 
-class UdemyAuth(object):
-    def __init__(self, username="", password="", cache_session=False):
-        self.username = username
-        self.password = password
-        self._cache = cache_session
-        self._session = Session()
+class AsyncSession(object):
+    """
+    asyncio counterpart of Session, with the same impersonation and headers.
+
+    Connections are pooled by the underlying curl_cffi AsyncSession and a semaphore caps
+    how many requests are in flight at once.
+    """
+
+    def __init__(self, max_in_flight=8):
+        self._session = requests2.AsyncSession(
+            impersonate="chrome120", max_clients=max_in_flight
+        )
+        headers = HEADERS.copy()
+        if "User-Agent" in headers:
+            del headers["User-Agent"]
+        self._session.headers.update(headers)
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    @classmethod
+    def from_session(cls, session: Session, max_in_flight=8):
+        """
+        Creates an async session carrying the headers and cookies of an already
+        authenticated session
+        """
+        async_session = cls(max_in_flight)
+        async_session._session.headers.clear()
+        async_session._session.headers.update(session._session.headers)
+        async_session._session.cookies.update(session._session.cookies)
+        return async_session
+
+    def _set_auth_headers(self, bearer_token=""):
+        self._session.headers["Authorization"] = "Bearer {}".format(bearer_token)
+        self._session.headers["X-Udemy-Authorization"] = "Bearer {}".format(
+            bearer_token
+        )
+
+    async def _get(self, url, data=None, **kwargs):
+        if data:
+            kwargs["params"] = data
+
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = 120
+
+        if not http_cache:
+            async with self._semaphore:
+                return await self._session.get(url, **kwargs)
+
+        cache_key = (url, kwargs.get("params"), self._cache_identity())
+        entry = http_cache.get(*cache_key)
+        if entry and entry["fresh"]:
+            return http_cache.hit(entry)
+        if entry:
+            kwargs["headers"] = {
+                **kwargs.get("headers", {}),
+                **http_cache.conditional_headers(entry),
+            }
+        async with self._semaphore:
+            resp = await self._session.get(url, **kwargs)
+        return http_cache.update(*cache_key, entry, resp)
+
+    def _cache_identity(self):
+        return credentials_identity(self._session.headers, self._session.cookies)
+
+    async def _post(self, url, data=None, **kwargs):
+        if data:
+            kwargs["data"] = data
+        async with self._semaphore:
+            return await self._session.post(url, **kwargs)
+
+    async def terminate(self):
+        await self._session.close()
+
+
+class UdemyAuth(object):
+    def __init__(self, username="", password="", cache_session=False):
+        self.username = username
+        self.password = password
+        self._cache = cache_session
+        self._session = Session()
+
+    def authenticate(self, bearer_token=None):
+        if bearer_token:
+            self._session._set_auth_headers(bearer_token)
+            return self._session
+        else:
+            return None
+
+
+class AsyncUdemyAuth(object):
+    def __init__(self, max_in_flight=8):
+        self._session = AsyncSession(max_in_flight)
 
     def authenticate(self, bearer_token=None):
         if bearer_token:
@@ -1268,14 +2218,14 @@ def durationtoseconds(period):
         return None
 
 
-def mux_process(
+def mux_command(
     video_filepath: str,
     audio_filepath: str,
     video_title: str,
     output_path: str,
     audio_key: Union[str | None] = None,
     video_key: Union[str | None] = None,
-):
+) -> str:
     codec = "hevc_nvenc" if use_nvenc else "libx265"
     transcode = "-hwaccel cuda -hwaccel_output_format cuda" if use_nvenc else ""
     audio_decryption_arg = (
@@ -1295,7 +2245,20 @@ def mux_process(
             command = f'nice -n 7 ffmpeg {transcode} -y {video_decryption_arg} -i "{video_filepath}" {audio_decryption_arg} -i "{audio_filepath}" -c:v {codec} -vtag hvc1 -crf {h265_crf} -preset {h265_preset} -c:a copy -fflags +bitexact -shortest -map_metadata -1 -metadata title="{video_title}" -metadata comment="Downloaded with Udemy-Downloader by Puyodead1 (https://github.com/Puyodead1/udemy-downloader)" "{output_path}"'
         else:
             command = f'nice -n 7 ffmpeg -y {video_decryption_arg} -i "{video_filepath}" {audio_decryption_arg} -i "{audio_filepath}" -c copy -fflags +bitexact -shortest -map_metadata -1 -metadata title="{video_title}" -metadata comment="Downloaded with Udemy-Downloader by Puyodead1 (https://github.com/Puyodead1/udemy-downloader)" "{output_path}"'
+    return command
+
 
+def mux_process(
+    video_filepath: str,
+    audio_filepath: str,
+    video_title: str,
+    output_path: str,
+    audio_key: Union[str | None] = None,
+    video_key: Union[str | None] = None,
+):
+    command = mux_command(
+        video_filepath, audio_filepath, video_title, output_path, audio_key, video_key
+    )
     process = subprocess.Popen(command, shell=True)
     log_subprocess_output("FFMPEG-STDOUT", process.stdout)
     log_subprocess_output("FFMPEG-STDERR", process.stderr)
@@ -1306,223 +2269,644 @@ def mux_process(
     return ret_code
 
 
-def handle_segments(url, format_id, lecture_id, video_title, output_path, chapter_dir):
-    os.chdir(os.path.join(chapter_dir))
+# yt-dlp and aria2c stderr lines that point at a rate limited or failed fragment
+DOWNLOADER_THROTTLED_RE = re.compile(r"\b429\b|Too Many Requests", re.I)
+DOWNLOADER_ERROR_RE = re.compile(r"ERROR|Retrying|Got error|errorCode=")
 
-    video_filepath_enc = lecture_id + ".encrypted.mp4"
-    audio_filepath_enc = lecture_id + ".encrypted.m4a"
-    temp_output_path = os.path.join(chapter_dir, lecture_id + ".mp4")
 
-    logger.info("> Downloading Lecture Tracks...")
-    args = [
-        "yt-dlp",
-        "--force-generic-extractor",
-        "--allow-unplayable-formats",
-        "--concurrent-fragments",
-        f"{concurrent_downloads}",
+def fragment_concurrency() -> int:
+    """
+    The number of fragments the next segment download should fetch at the same time
+    """
+    if fragment_controller:
+        return fragment_controller.value
+    return concurrent_downloads
+
+
+def run_fragment_downloader(cmd: list, output_paths: list, **kwargs) -> int:
+    """
+    Runs a yt-dlp segment download. With adaptive concurrency, its stderr is passed
+    through while errors and rate limit responses are counted, and the outcome is
+    reported to the controller
+
+    Returns:
+        int: The return code of yt-dlp
+    """
+    if not fragment_controller:
+        process = subprocess.Popen(cmd, **kwargs)
+        log_subprocess_output("YTDLP-STDOUT", process.stdout)
+        log_subprocess_output("YTDLP-STDERR", process.stderr)
+        return process.wait()
+
+    started = time.monotonic()
+    process = subprocess.Popen(cmd, stderr=subprocess.PIPE, **kwargs)
+    errors = throttled = 0
+    for line in iter(process.stderr.readline, b""):
+        sys.stderr.buffer.write(line)
+        sys.stderr.flush()
+        line = line.decode("utf8", errors="replace")
+        if DOWNLOADER_THROTTLED_RE.search(line):
+            throttled += 1
+        elif DOWNLOADER_ERROR_RE.search(line):
+            errors += 1
+    ret_code = process.wait()
+    elapsed = time.monotonic() - started
+
+    if ret_code != 0 and not errors:
+        errors = 1
+    nbytes = sum(os.path.getsize(path) for path in output_paths if os.path.isfile(path))
+    fragment_controller.record(nbytes, elapsed, errors, throttled)
+    return ret_code
+
+
+def ytdlp_downloader_args(lease) -> list:
+    """
+    yt-dlp arguments that keep it within a download budget lease
+    """
+    # yt-dlp only hands http(s) and ftp downloads to aria2c, dash fragments always go
+    # through its own fragment downloader, which these options limit
+    args = ["--concurrent-fragments", f"{lease.connections}"]
+    if lease.rate:
+        args += ["--limit-rate", f"{lease.rate}"]
+    return [
+        *args,
         "--downloader",
         "aria2c",
         "--downloader-args",
         'aria2c:"--disable-ipv6"',
+    ]
+
+
+class SegmentJob(object):
+    """
+    State for a single DRM lecture as it moves through the download, mux and finalize stages
+    """
+
+    def __init__(
+        self, url, format_id, lecture_id, video_title, output_path, chapter_dir
+    ):
+        self.url = url
+        self.format_id = format_id
+        self.lecture_id = lecture_id
+        self.video_title = video_title
+        self.output_path = output_path
+        self.chapter_dir = chapter_dir
+        # every intermediate file of the lecture lives in its own working directory,
+        # nothing depends on the process working directory so lectures can run concurrently
+        self.work_dir = os.path.join(chapter_dir, f".{lecture_id}.work")
+        self.video_filepath_enc = os.path.join(
+            self.work_dir, lecture_id + ".encrypted.mp4"
+        )
+        self.audio_filepath_enc = os.path.join(
+            self.work_dir, lecture_id + ".encrypted.m4a"
+        )
+        self.temp_output_path = os.path.join(self.work_dir, lecture_id + ".mp4")
+        self.video_key = None
+        self.audio_key = None
+        # set when the tracks were streamed into ffmpeg, there is nothing left to mux
+        self.muxed = False
+
+    @property
+    def tracks(self) -> list:
+        """
+        The encrypted track files and the representation ids they are downloaded from,
+        the format id is `<video representation>,<audio representation>`
+        """
+        return list(
+            zip(
+                (self.video_filepath_enc, self.audio_filepath_enc),
+                self.format_id.split(","),
+            )
+        )
+
+    def cleanup(self):
+        # if the url is a file url, we need to remove the file after we're done with it
+        if self.url.startswith("file://"):
+            try:
+                os.unlink(self.url[7:])
+            except:
+                pass
+
+
+def open_fragment_journal(job: SegmentJob) -> FragmentJournal:
+    """
+    Opens the fragment journal of a lecture, throwing away partial tracks left behind by
+    a download of another format since they can't be resumed
+    """
+    journal = FragmentJournal(job.work_dir, job.format_id)
+    partials = [
+        name
+        for name in os.listdir(job.work_dir)
+        if name.startswith(f"{job.lecture_id}.encrypted.")
+    ]
+    if partials and not journal.matches:
+        logger.info(
+            "> Partial tracks on disk are of another quality or manifest, starting over"
+        )
+        for name in partials:
+            os.remove(os.path.join(job.work_dir, name))
+        journal.reset()
+    elif partials:
+        logger.info(f"> Resuming the download: {journal.describe()}")
+    elif not journal.matches:
+        journal.reset()
+    return journal
+
+
+def record_ytdlp_progress(job: SegmentJob, journal: FragmentJournal):
+    """
+    Copies how far yt-dlp got with each track into the fragment journal
+    """
+    for path, rep_id in job.tracks:
+        if os.path.isfile(path):
+            journal.mark_complete(rep_id)
+            continue
+        try:
+            with open(f"{path}.ytdl", encoding="utf-8") as f:
+                index = json.load(f)["downloader"]["current_fragment"]["index"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        # yt-dlp appends fragments to the .part file in order and keeps the index of
+        # the first one it doesn't have, which is where it resumes from
+        journal.mark_done(rep_id, *range(index))
+    journal.save()
+
+
+def fetch_tracks_ytdlp(job: SegmentJob, journal: FragmentJournal, lease) -> bool:
+    args = [
+        "yt-dlp",
+        "--force-generic-extractor",
+        "--allow-unplayable-formats",
+        *ytdlp_downloader_args(lease),
+        # a skipped fragment would leave a hole in the track, failing keeps the
+        # .part and .ytdl files so the download resumes at that fragment
+        "--abort-on-unavailable-fragments",
         "--fixup",
         "never",
         "-k",
+        "-P",
+        job.work_dir,
         "-o",
-        f"{lecture_id}.encrypted.%(ext)s",
+        f"{job.lecture_id}.encrypted.%(ext)s",
         "-f",
-        format_id,
-        f"{url}",
+        job.format_id,
+        f"{job.url}",
     ]
-    process = subprocess.Popen(args)
-    log_subprocess_output("YTDLP-STDOUT", process.stdout)
-    log_subprocess_output("YTDLP-STDERR", process.stderr)
+    ret_code = run_fragment_downloader(
+        args,
+        [job.video_filepath_enc, job.audio_filepath_enc],
+        cwd=job.work_dir,
+    )
+    record_ytdlp_progress(job, journal)
+    return ret_code == 0
+
+
+def fetch_tracks_native(job: SegmentJob, journal: FragmentJournal, lease) -> bool:
+    """
+    Downloads the tracks of a DRM lecture with the native fragment downloader
+
+    Raises:
+        UnsupportedManifest: The manifest has to be downloaded with yt-dlp
+    """
+    session = get_session()
+    downloader = FragmentDownloader(session, lease.connections, limiter=lease.limiter)
+    started = time.monotonic()
+    failed = False
+    try:
+        mpd = read_manifest(job.url, session)
+        for path, rep_id in job.tracks:
+            if os.path.isfile(path):
+                continue
+            fragments = dash_fragments(mpd, job.url, rep_id)
+            downloader.download(
+                fragments, path, journal, rep_id, desc=os.path.basename(path)
+            )
+    except (FragmentError, requests.RequestException, OSError) as e:
+        logger.warning(f"> Track download failed: {e}")
+        failed = True
+    finally:
+        if fragment_controller:
+            stats = downloader.stats
+            fragment_controller.record(
+                stats.bytes,
+                time.monotonic() - started,
+                stats.errors + failed,
+                stats.throttled,
+            )
+    return not failed
+
+
+def pipe_tracks_to_ffmpeg(job: SegmentJob, tracks: list, lease, session) -> bool:
+    """
+    Downloads the tracks of a lecture into the inputs of an ffmpeg mux through pipes,
+    each track on its own thread since ffmpeg reads them interleaved
+    """
+    stats = DownloadStats()
+    connections = max(1, lease.connections // len(tracks))
+    # the tracks share the limiter of the budget
+    downloaders = [
+        FragmentDownloader(session, connections, stats=stats, limiter=lease.limiter)
+        for _ in tracks
+    ]
+
+    pipes = [os.pipe() for _ in tracks]
+    read_fds = [r for r, _ in pipes]
+    command = mux_command(
+        *(f"pipe:{fd}" for fd in read_fds),
+        job.video_title,
+        job.temp_output_path,
+        job.audio_key,
+        job.video_key,
+    )
+    try:
+        process = subprocess.Popen(command, shell=True, pass_fds=read_fds)
+    except OSError:
+        for _, w in pipes:
+            os.close(w)
+        raise
+    finally:
+        # only ffmpeg holds the read ends, so the feeders see a broken pipe if it exits
+        for fd in read_fds:
+            os.close(fd)
+
+    errors = []
+
+    def feed(downloader, fragments, fd, path):
+        try:
+            with open(fd, "wb") as f:
+                downloader.stream(fragments, f, desc=os.path.basename(path))
+        except Exception as e:
+            errors.append(e)
+            # a track ended early, don't let ffmpeg finish a truncated lecture
+            process.terminate()
+
+    started = time.monotonic()
+    feeders = [
+        threading.Thread(
+            target=feed,
+            args=(downloader, fragments, w, path),
+            name=f"stream-{rep_id}",
+            daemon=True,
+        )
+        for downloader, fragments, (_, w), (path, rep_id) in zip(
+            downloaders, tracks, pipes, job.tracks
+        )
+    ]
+    for feeder in feeders:
+        feeder.start()
+    for feeder in feeders:
+        feeder.join()
     ret_code = process.wait()
+    if fragment_controller:
+        fragment_controller.record(
+            stats.bytes,
+            time.monotonic() - started,
+            stats.errors + len(errors),
+            stats.throttled,
+        )
+
+    if errors or ret_code != 0:
+        reason = errors[0] if errors else f"ffmpeg returned {ret_code}"
+        logger.warning(f"> Streaming the tracks failed: {reason}")
+        if os.path.exists(job.temp_output_path):
+            os.remove(job.temp_output_path)
+        return False
+    return True
+
+
+def stream_segments(job: SegmentJob):
+    """
+    Downloads the tracks of a DRM lecture straight into ffmpeg, the keys are looked up
+    from the key ids in the manifest instead of the downloaded tracks
+
+    Returns:
+        bool: Whether the lecture was muxed, None if it can't be streamed and has to be
+            downloaded to encrypted track files first
+    """
+    if any(
+        name.startswith(f"{job.lecture_id}.encrypted.")
+        for name in os.listdir(job.work_dir)
+    ):
+        logger.info("> Partial tracks are on disk, resuming them instead of streaming")
+        return None
+
+    session = get_session()
+    rep_ids = [rep_id for _, rep_id in job.tracks]
+    try:
+        mpd = read_manifest(job.url, session)
+        kids = extract_mpd_kids(mpd)
+        tracks = [dash_fragments(mpd, job.url, rep_id) for rep_id in rep_ids]
+    except Exception as e:
+        logger.info(f"> Can't stream the tracks ({e}), downloading them first")
+        return None
+    if not all(rep_id in kids for rep_id in rep_ids):
+        logger.info("> The manifest has no key ids to stream with, downloading first")
+        return None
+    missing = [kids[rep_id] for rep_id in rep_ids if kids[rep_id] not in keys]
+    if missing:
+        logger.error(f"> No key for {', '.join(missing)} in the key file")
+        return False
+    job.video_key, job.audio_key = (keys[kids[rep_id]] for rep_id in rep_ids)
+
+    logger.info("> Streaming Lecture Tracks into ffmpeg...")
+    for attempt in range(segment_retries + 1):
+        if attempt:
+            logger.warning(
+                f"> Streaming the tracks again, attempt {attempt + 1} of {segment_retries + 1}"
+            )
+        with download_budget.lease(fragment_concurrency()) as lease:
+            if pipe_tracks_to_ffmpeg(job, tracks, lease, session):
+                job.muxed = True
+                logger.info("> Lecture Tracks Streamed and Muxed")
+                return True
+    return False
+
+
+def download_segments(job: SegmentJob) -> bool:
+    Path(job.work_dir).mkdir(parents=True, exist_ok=True)
+    if stream_mux:
+        streamed = stream_segments(job)
+        if streamed is not None:
+            return streamed
+
+    logger.info("> Downloading Lecture Tracks...")
+    journal = open_fragment_journal(job)
+    native = use_native_downloader
+    for attempt in range(segment_retries + 1):
+        if attempt:
+            logger.warning(
+                f"> Resuming the track download ({journal.describe()}), attempt {attempt + 1} of {segment_retries + 1}"
+            )
+        with download_budget.lease(fragment_concurrency()) as lease:
+            if native:
+                try:
+                    success = fetch_tracks_native(job, journal, lease)
+                except UnsupportedManifest as e:
+                    # the native downloader keeps yt-dlp compatible partial files
+                    logger.info(f"> Manifest not supported ({e}), using yt-dlp")
+                    native = False
+            if not native:
+                success = fetch_tracks_ytdlp(job, journal, lease)
+        if success:
+            break
+
+    if not success:
+        logger.warning(
+            "The track download failed, skipping! The downloaded fragments are kept for the next run"
+        )
+        return False
     logger.info("> Lecture Tracks Downloaded")
+    return True
+
+
+def missing_keys(source: dict) -> list:
+    """
+    The key ids a DRM source needs that aren't in the key file, as far as its manifest
+    tells. Sources whose manifest doesn't list key ids are checked after the download
+    """
+    return [kid for kid in source.get("kids") or [] if kid not in keys]
 
-    if ret_code != 0:
-        logger.warning("Return code from the downloader was non-0 (error), skipping!")
-        return
 
+def mux_segments(job: SegmentJob) -> bool:
+    if job.muxed:
+        return True
     audio_kid = None
     video_kid = None
 
     try:
-        video_kid = extract_kid(video_filepath_enc)
+        video_kid = extract_kid(job.video_filepath_enc)
         logger.info("KID for video file is: " + video_kid)
     except Exception:
         logger.exception(f"Error extracting video kid")
-        return
+        return False
 
     try:
-        audio_kid = extract_kid(audio_filepath_enc)
+        audio_kid = extract_kid(job.audio_filepath_enc)
         logger.info("KID for audio file is: " + audio_kid)
     except Exception:
         logger.exception(f"Error extracting audio kid")
-        return
+        return False
 
     if audio_kid is not None:
         try:
-            audio_key = keys[audio_kid]
+            job.audio_key = keys[audio_kid]
         except KeyError:
             logger.error(
                 f"Audio key not found for {audio_kid}, if you have the key then you probably didn't add them to the key file correctly."
             )
-            return
+            return False
 
     if video_kid is not None:
         try:
-            video_key = keys[video_kid]
+            job.video_key = keys[video_kid]
         except KeyError:
             logger.error(
-                f"Video key not found for {audio_kid}, if you have the key then you probably didn't add them to the key file correctly."
+                f"Video key not found for {video_kid}, if you have the key then you probably didn't add them to the key file correctly."
             )
-            return
+            return False
 
     try:
-        # logger.info("> Decrypting video, this might take a minute...")
-        # ret_code = decrypt(video_kid, video_filepath_enc, video_filepath_dec)
-        # if ret_code != 0:
-        #     logger.error("> Return code from the decrypter was non-0 (error), skipping!")
-        #     return
-        # logger.info("> Decryption complete")
-        # logger.info("> Decrypting audio, this might take a minute...")
-        # decrypt(audio_kid, audio_filepath_enc, audio_filepath_dec)
-        # if ret_code != 0:
-        #     logger.error("> Return code from the decrypter was non-0 (error), skipping!")
-        #     return
-        # logger.info("> Decryption complete")
         logger.info("> Merging video and audio, this might take a minute...")
         mux_process(
-            video_filepath_enc,
-            audio_filepath_enc,
-            video_title,
-            temp_output_path,
-            audio_key,
-            video_key,
+            job.video_filepath_enc,
+            job.audio_filepath_enc,
+            job.video_title,
+            job.temp_output_path,
+            job.audio_key,
+            job.video_key,
         )
-        if ret_code != 0:
-            logger.error("> Return code from ffmpeg was non-0 (error), skipping!")
-            return
+    except Exception as e:
+        logger.exception(f"Muxing error: {e}")
+        return False
+    return True
+
+
+def finalize_segments(job: SegmentJob) -> bool:
+    try:
         logger.info("> Merging complete, renaming final file...")
-        os.rename(temp_output_path, output_path)
+        os.rename(job.temp_output_path, job.output_path)
+        state_db.finish(job.output_path)
         logger.info("> Cleaning up temporary files...")
-        os.remove(video_filepath_enc)
-        os.remove(audio_filepath_enc)
+        shutil.rmtree(job.work_dir, ignore_errors=True)
     except Exception as e:
-        logger.exception(f"Muxing error: {e}")
-    finally:
-        os.chdir(HOME_DIR)
-        # if the url is a file url, we need to remove the file after we're done with it
-        if url.startswith("file://"):
+        logger.exception(f"Finalizing error: {e}")
+        return False
+    return True
+
+
+SEGMENT_STAGES = (download_segments, mux_segments, finalize_segments)
+
+
+class SegmentPipeline(object):
+    """
+    Runs the segment stages on their own worker threads, connected by bounded queues,
+    so that muxing one lecture overlaps the download of the next one.
+
+    A full queue blocks the stage feeding it, which keeps at most a couple of lectures
+    worth of encrypted tracks waiting on disk at any time.
+    """
+
+    def __init__(self, download_workers=1, mux_workers=1, finalize_workers=1):
+        self._stages = []
+        for stage, workers in zip(
+            SEGMENT_STAGES, (download_workers, mux_workers, finalize_workers)
+        ):
+            inbox = queue.Queue(maxsize=workers * 2)
+            self._stages.append((stage, inbox, workers, []))
+
+        for index, (stage, inbox, workers, threads) in enumerate(self._stages):
+            outbox = (
+                self._stages[index + 1][1] if index + 1 < len(self._stages) else None
+            )
+            for i in range(workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, inbox, outbox),
+                    name=f"{stage.__name__}-{i}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+    def _worker(self, stage, inbox: queue.Queue, outbox: queue.Queue):
+        while True:
+            job = inbox.get()
+            if job is None:
+                break
             try:
-                os.unlink(url[7:])
-            except:
-                pass
+                ok = stage(job)
+            except Exception:
+                logger.exception(f"> Unexpected error in {stage.__name__}")
+                ok = False
+            if ok and outbox is not None:
+                outbox.put(job)
+            else:
+                if not ok:
+                    state_db.fail(job.output_path, f"{stage.__name__} failed")
+                job.cleanup()
+                synced_lectures.settle(f"lecture:{job.lecture_id}")
 
+    def submit(self, job: SegmentJob):
+        self._stages[0][1].put(job)
+
+    def join(self):
+        # drain the stages in order, each one only stops after everything upstream has been handed over
+        for stage, inbox, workers, threads in self._stages:
+            for _ in range(workers):
+                inbox.put(None)
+            for thread in threads:
+                thread.join()
+
+
+def handle_segments(url, format_id, lecture_id, video_title, output_path, chapter_dir):
+    job = SegmentJob(url, format_id, lecture_id, video_title, output_path, chapter_dir)
+    if segment_pipeline:
+        segment_pipeline.submit(job)
+        return
 
-def check_for_aria():
     try:
-        subprocess.Popen(
-            ["aria2c", "-v"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        ).wait()
-        return True
-    except FileNotFoundError:
-        return False
-    except Exception:
-        logger.exception(
-            "> Unexpected exception while checking for Aria2c, please tell the program author about this! "
-        )
-        return True
+        for stage in SEGMENT_STAGES:
+            if not stage(job):
+                state_db.fail(job.output_path, f"{stage.__name__} failed")
+                return
+    finally:
+        job.cleanup()
+
+
+def check_for_aria():
+    return tool_probe.find("aria2c", ["-v"]) is not None
 
 
 def check_for_ffmpeg():
-    try:
-        subprocess.Popen(
-            ["ffmpeg"], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-        ).wait()
-        return True
-    except FileNotFoundError:
-        return False
-    except Exception:
-        logger.exception(
-            "> Unexpected exception while checking for FFMPEG, please tell the program author about this! "
-        )
-        return True
+    return tool_probe.find("ffmpeg", ["-version"]) is not None
 
 
-def check_for_shaka():
-    try:
-        subprocess.Popen(
-            ["shaka-packager", "-version"],
-            stderr=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-        ).wait()
-        return True
-    except FileNotFoundError:
-        return False
-    except Exception:
-        logger.exception(
-            "> Unexpected exception while checking for shaka-packager, please tell the program author about this! "
+def download(url, file_dir, filename):
+    """
+    Downloads a file with the native ranged downloader, over several connections of the
+    pooled session
+    """
+    with download_budget.lease(16) as lease:
+        downloader = RangeDownloader(
+            get_session(), lease.connections, limiter=lease.limiter
         )
-        return True
+        downloader.download(url, os.path.join(file_dir, filename), desc=filename)
+    return 0
 
 
-def download(url, path, filename):
+def download_file(url, file_dir, filename):
     """
-    @author Puyodead1
+    Downloads a progressive video, caption or asset with the selected downloader
     """
-    file_size = int(requests.head(url).headers["Content-Length"])
-    if os.path.exists(path):
-        first_byte = os.path.getsize(path)
-    else:
-        first_byte = 0
-    if first_byte >= file_size:
-        return file_size
-    header = {"Range": "bytes=%s-%s" % (first_byte, file_size)}
-    pbar = tqdm(
-        total=file_size, initial=first_byte, unit="B", unit_scale=True, desc=filename
-    )
-    res = requests.get(url, headers=header, stream=True)
-    res.raise_for_status()
-    with open(path, encoding="utf8", mode="ab") as f:
-        for chunk in res.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-                pbar.update(1024)
-    pbar.close()
-    return file_size
+    if use_native_downloader:
+        return download(url, file_dir, filename)
+    return download_aria(url, file_dir, filename)
 
 
 def download_aria(url, file_dir, filename):
     """
     @author Puyodead1
     """
-    args = [
-        "aria2c",
-        url,
-        "-o",
-        filename,
-        "-d",
-        file_dir,
-        "-j16",
-        "-s20",
-        "-x16",
-        "-c",
-        "--auto-file-renaming=false",
-        "--summary-interval=0",
-        "--disable-ipv6",
-        "--follow-torrent=false",
-    ]
-    process = subprocess.Popen(args)
-    log_subprocess_output("ARIA2-STDOUT", process.stdout)
-    log_subprocess_output("ARIA2-STDERR", process.stderr)
-    ret_code = process.wait()
+    # downloaded next to the file and moved over it once complete, aria2c would take an
+    # existing file of the same name for a finished download
+    part_name = f"{filename}.part"
+    with download_budget.lease(16) as lease:
+        if aria2_daemon:
+            options = {
+                "split": lease.connections,
+                "max-connection-per-server": min(lease.connections, 16),
+            }
+            if lease.rate:
+                options["max-download-limit"] = lease.rate
+            try:
+                aria2_daemon.download(url, file_dir, part_name, options)
+            except Exception as e:
+                raise Exception(f"Download through the aria2c daemon failed: {e}")
+            os.replace(
+                os.path.join(file_dir, part_name), os.path.join(file_dir, filename)
+            )
+            return 0
+
+        args = [
+            "aria2c",
+            url,
+            "-o",
+            part_name,
+            "-d",
+            file_dir,
+            f"-j{lease.connections}",
+            f"-s{lease.connections}",
+            f"-x{min(lease.connections, 16)}",
+            "-c",
+            "--auto-file-renaming=false",
+            "--summary-interval=0",
+            "--disable-ipv6",
+            "--follow-torrent=false",
+        ]
+        if lease.rate:
+            args.append(f"--max-overall-download-limit={lease.rate}")
+        process = subprocess.Popen(args)
+        log_subprocess_output("ARIA2-STDOUT", process.stdout)
+        log_subprocess_output("ARIA2-STDERR", process.stderr)
+        ret_code = process.wait()
     if ret_code != 0:
         raise Exception("Return code from the downloader was non-0 (error)")
+    os.replace(os.path.join(file_dir, part_name), os.path.join(file_dir, filename))
     return ret_code
 
 
-def process_caption(caption, lecture_title, lecture_dir, tries=0):
+def record_download(path: str, ok: bool, error: str = "download failed"):
+    """
+    Marks a download as done in the state database if it succeeded and its file exists,
+    as failed otherwise
+    """
+    if ok and os.path.isfile(path):
+        state_db.finish(path)
+    else:
+        state_db.fail(path, error)
+
+
+def process_caption(caption, lecture_title, lecture_dir, tries=0, lecture_id=None):
     filename = f"%s_%s.%s" % (
         sanitize_filename(lecture_title),
         caption.get("language"),
@@ -1533,34 +2917,110 @@ def process_caption(caption, lecture_title, lecture_dir, tries=0):
         caption.get("language"),
     )
     filepath = os.path.join(lecture_dir, filename)
+    # vtt captions are converted, the srt file is what is kept
+    output_path = filepath
+    if caption.get("extension") == "vtt":
+        output_path = os.path.join(lecture_dir, filename_no_ext + ".srt")
 
-    if os.path.isfile(filepath):
+    if state_db.is_done(output_path, lecture_id, "caption"):
         logger.info("    > Caption '%s' already downloaded." % filename)
     else:
         logger.info(f"    >  Downloading caption: '%s'" % filename)
+        state_db.start(output_path, lecture_id, "caption")
         try:
-            ret_code = download_aria(caption.get("download_url"), lecture_dir, filename)
+            ret_code = download_file(caption.get("download_url"), lecture_dir, filename)
             logger.debug(f"      > Download return code: {ret_code}")
         except Exception as e:
             if tries >= 3:
                 logger.error(
                     f"    > Error downloading caption: {e}. Exceeded retries, skipping."
                 )
+                state_db.fail(output_path, str(e))
                 return
             else:
                 logger.error(
                     f"    > Error downloading caption: {e}. Will retry {3 - tries} more times."
                 )
-                process_caption(caption, lecture_title, lecture_dir, tries + 1)
-        if caption.get("extension") == "vtt":
-            try:
-                logger.info("    > Converting caption to SRT format...")
-                convert(lecture_dir, filename_no_ext)
-                logger.info("    > Caption conversion complete.")
-                if not keep_vtt:
-                    os.remove(filepath)
-            except Exception:
-                logger.exception(f"    > Error converting caption")
+                process_caption(
+                    caption, lecture_title, lecture_dir, tries + 1, lecture_id
+                )
+                return
+        if caption.get("extension") == "vtt":
+            try:
+                logger.info("    > Converting caption to SRT format...")
+                vtt_to_srt.convert(lecture_dir, filename_no_ext)
+                logger.info("    > Caption conversion complete.")
+                if not keep_vtt:
+                    os.remove(filepath)
+            except Exception as e:
+                logger.exception(f"    > Error converting caption")
+                state_db.fail(output_path, str(e))
+                return
+        record_download(output_path, True)
+
+
+def download_hls_native(url, lecture_path) -> int:
+    """
+    Downloads an HLS lecture with the native fragment downloader, MPEG-TS segments are
+    remuxed to mp4 once downloaded
+
+    Returns:
+        int: 0 on success, like the return code of yt-dlp
+
+    Raises:
+        UnsupportedManifest: The playlist has to be downloaded with yt-dlp
+    """
+    session = get_session()
+    fragments = hls_fragments(read_manifest(url, session), url)
+    download_path = f"{lecture_path}.download"
+    with download_budget.lease(fragment_concurrency()) as lease:
+        downloader = FragmentDownloader(
+            session, lease.connections, limiter=lease.limiter
+        )
+        started = time.monotonic()
+        try:
+            downloader.download(
+                fragments, download_path, desc=os.path.basename(lecture_path)
+            )
+        except (FragmentError, OSError) as e:
+            logger.error(f"      > HLS download failed: {e}")
+            return 1
+        finally:
+            if fragment_controller:
+                stats = downloader.stats
+                fragment_controller.record(
+                    stats.bytes,
+                    time.monotonic() - started,
+                    stats.errors,
+                    stats.throttled,
+                )
+
+    with open(download_path, "rb") as f:
+        is_ts = f.read(1) == b"\x47"
+    if not is_ts:
+        # fragmented mp4 segments, the init section comes first so the file plays as is
+        os.replace(download_path, lecture_path)
+        return 0
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        download_path,
+        "-c",
+        "copy",
+        "-bsf:a",
+        "aac_adtstoasc",
+        "-f",
+        "mp4",
+        lecture_path,
+    ]
+    process = subprocess.Popen(cmd)
+    log_subprocess_output("FFMPEG-STDOUT", process.stdout)
+    log_subprocess_output("FFMPEG-STDERR", process.stderr)
+    ret_code = process.wait()
+    if ret_code == 0:
+        os.remove(download_path)
+    return ret_code
 
 
 def process_lecture(lecture, lecture_path, chapter_dir):
@@ -1579,6 +3039,15 @@ def process_lecture(lecture, lecture_path, chapter_dir):
             logger.info(
                 f"      > Lecture '{lecture_title}' has DRM, attempting to download. Selected quality: {source.get('height')}"
             )
+            state_db.start(lecture_path, lecture_id)
+            missing = missing_keys(source)
+            if missing:
+                # it couldn't be decrypted, so don't download it at all
+                logger.error(
+                    f"      > No key for {', '.join(missing)} in the key file, skipping the lecture"
+                )
+                state_db.fail(lecture_path, f"missing key(s) {', '.join(missing)}")
+                return
             handle_segments(
                 source.get("download_url"),
                 source.get("format_id"),
@@ -1594,10 +3063,12 @@ def process_lecture(lecture, lecture_path, chapter_dir):
         sources = lecture.get("sources")
         sources = sorted(sources, key=lambda x: int(x.get("height")), reverse=True)
         if sources:
-            if not os.path.isfile(lecture_path):
+            if not state_db.is_done(lecture_path, lecture_id):
                 logger.info(
                     "      > Lecture doesn't have DRM, attempting to download..."
                 )
+                state_db.start(lecture_path, lecture_id)
+                ret_code = 1
                 source = sources[0]  # first index is the best quality
                 if isinstance(quality, int):
                     source = min(
@@ -1613,24 +3084,28 @@ def process_lecture(lecture, lecture_path, chapter_dir):
                     source_type = source.get("type")
                     if source_type == "hls":
                         temp_filepath = lecture_path.replace(".mp4", ".%(ext)s")
-                        cmd = [
-                            "yt-dlp",
-                            "--enable-file-urls",
-                            "--force-generic-extractor",
-                            "--concurrent-fragments",
-                            f"{concurrent_downloads}",
-                            "--downloader",
-                            "aria2c",
-                            "--downloader-args",
-                            'aria2c:"--disable-ipv6"',
-                            "-o",
-                            f"{temp_filepath}",
-                            f"{url}",
-                        ]
-                        process = subprocess.Popen(cmd)
-                        log_subprocess_output("YTDLP-STDOUT", process.stdout)
-                        log_subprocess_output("YTDLP-STDERR", process.stderr)
-                        ret_code = process.wait()
+                        ret_code = None
+                        if use_native_downloader:
+                            try:
+                                ret_code = download_hls_native(url, lecture_path)
+                            except UnsupportedManifest as e:
+                                logger.info(
+                                    f"      > Playlist not supported ({e}), using yt-dlp"
+                                )
+                        if ret_code is None:
+                            with download_budget.lease(fragment_concurrency()) as lease:
+                                cmd = [
+                                    "yt-dlp",
+                                    "--enable-file-urls",
+                                    "--force-generic-extractor",
+                                    # a stale lecture is still there, replace it
+                                    "--force-overwrites",
+                                    *ytdlp_downloader_args(lease),
+                                    "-o",
+                                    f"{temp_filepath}",
+                                    f"{url}",
+                                ]
+                                ret_code = run_fragment_downloader(cmd, [lecture_path])
                         if ret_code == 0:
                             tmp_file_path = lecture_path + ".tmp"
                             logger.info("      > HLS Download success")
@@ -1672,12 +3147,13 @@ def process_lecture(lecture, lecture_path, chapter_dir):
                                         "      > Encoding returned non-zero return code"
                                     )
                     else:
-                        ret_code = download_aria(
-                            url, chapter_dir, lecture_title + ".mp4"
+                        ret_code = download_file(
+                            url, chapter_dir, os.path.basename(lecture_path)
                         )
                         logger.debug(f"      > Download return code: {ret_code}")
                 except Exception:
                     logger.exception(f">        Error downloading lecture")
+                record_download(lecture_path, ret_code == 0)
             else:
                 logger.info(
                     f"      > Lecture '{lecture_title}' is already downloaded, skipping..."
@@ -1701,20 +3177,19 @@ def process_normal_quiz(quiz, lecture, chapter_dir):
     lecture_path = os.path.join(chapter_dir, lecture_file_name)
 
     logger.info(f"  > Processing quiz {lecture_index}")
-    template_path = os.path.join(MAIN_SCRIPT_PATH, "templates", "quiz_template.html")
-    with open(template_path, "r", encoding="utf-8") as f:
-        html = f.read()
-        quiz_data = {
-            "id": lecture["data"].get("id"),
-            "title": lecture["data"].get("title"),
-            "description": lecture["data"].get("description"),
-            "pass_score": lecture.get("data").get("pass_percent"),
-            "assessments": quiz["contents"],
-        }
-        html = html.replace("%%TITLE%%", lecture["data"].get("title"))
-        html = html.replace("%%QUIZ_JSON%%", json.dumps(quiz_data))
-        with open(lecture_path, "w", encoding="utf-8") as f:
-            f.write(html)
+    quiz_data = {
+        "id": lecture["data"].get("id"),
+        "title": lecture["data"].get("title"),
+        "description": lecture["data"].get("description"),
+        "pass_score": lecture.get("data").get("pass_percent"),
+        "assessments": quiz["contents"],
+    }
+    html_templates.render(
+        "quiz_template",
+        lecture_path,
+        title=lecture["data"].get("title"),
+        quiz_json=quiz_data,
+    )
 
 
 def process_coding_assignment(quiz, lecture, chapter_dir):
@@ -1725,23 +3200,16 @@ def process_coding_assignment(quiz, lecture, chapter_dir):
 
     logger.info(f"  > Processing quiz {lecture_index} (coding assignment)")
 
-    template_path = os.path.join(
-        MAIN_SCRIPT_PATH, "templates", "coding_assignment_template.html"
-    )
-    with open(template_path, "r") as f:
-        html = f.read()
-        quiz_data = {
-            "title": lecture_title,
-            "hasInstructions": quiz["hasInstructions"],
-            "hasTests": quiz["hasTests"],
-            "hasSolutions": quiz["hasSolutions"],
-            "instructions": quiz["contents"]["instructions"],
-            "tests": quiz["contents"]["tests"],
-            "solutions": quiz["contents"]["solutions"],
-        }
-        html = html.replace("__data_placeholder__", json.dumps(quiz_data))
-        with open(lecture_path, "w") as f:
-            f.write(html)
+    quiz_data = {
+        "title": lecture_title,
+        "hasInstructions": quiz["hasInstructions"],
+        "hasTests": quiz["hasTests"],
+        "hasSolutions": quiz["hasSolutions"],
+        "instructions": quiz["contents"]["instructions"],
+        "tests": quiz["contents"]["tests"],
+        "solutions": quiz["contents"]["solutions"],
+    }
+    html_templates.render("coding_assignment_template", lecture_path, data=quiz_data)
 
 
 def process_role_play(udemy: Udemy, lecture, chapter_dir):
@@ -1879,12 +3347,7 @@ def process_role_play(udemy: Udemy, lecture, chapter_dir):
         }
     }
 
-    template_path = os.path.join(MAIN_SCRIPT_PATH, "templates", "role_play_template.html")
-    with open(template_path, "r", encoding="utf-8") as f:
-        html = f.read()
-        html = html.replace("__data_placeholder__", json.dumps(clean_data))
-        with open(lecture_path, "w", encoding="utf-8") as f:
-            f.write(html)
+    html_templates.render("role_play_template", lecture_path, data=clean_data)
 
 
 def parse_new(udemy: Udemy, udemy_object: dict):
@@ -1902,11 +3365,63 @@ def parse_new(udemy: Udemy, udemy_object: dict):
     if not os.path.exists(course_dir):
         os.mkdir(course_dir)
 
+    course_id = udemy_object.get("course_id")
+    state_db.start_course(
+        course_id,
+        udemy_object.get("title"),
+        course_dir,
+        [
+            lecture
+            for chapter in udemy_object.get("chapters")
+            for lecture in chapter.get("lectures")
+        ],
+    )
+
+    skip_ids = set()
+    sync = None
+    if use_sync:
+        sync = CourseSync(course_dir, _sync_options())
+        skip_ids = sync.plan(_sync_items(udemy_object))
+    if retry_failed:
+        failed = state_db.failed_lectures(course_id)
+        logger.info(f"> Retrying {len(failed)} failed lecture(s)")
+        skip_ids.update(
+            _sync_id(lecture)
+            for lecture in _selected_lectures(udemy_object)
+            if lecture.get("id") not in failed
+        )
+
+    if not skip_lectures:
+        report_missing_keys(
+            udemy,
+            [
+                (lecture, os.path.join(course_dir, chapter.get("chapter_title")))
+                for chapter in udemy_object.get("chapters")
+                if chapter_filter is None
+                or int(chapter.get("chapter_index")) in chapter_filter
+                for lecture in chapter.get("lectures")
+                if _sync_id(lecture) not in skip_ids
+            ],
+        )
+
+    scheduler = LectureScheduler(parallel_lectures)
+    prefetcher = None
+    if prefetch_lectures:
+        prefetcher = ManifestPrefetcher(
+            udemy,
+            [
+                lecture
+                for lecture in _selected_lectures(udemy_object)
+                if _sync_id(lecture) not in skip_ids
+            ],
+            prefetch_lectures,
+        )
+
     for chapter in udemy_object.get("chapters"):
         current_chapter_index = int(chapter.get("chapter_index"))
         # Skip chapters not in the filter if a filter is provided
         if chapter_filter is not None and current_chapter_index not in chapter_filter:
-            logger.info(
+            scheduler.log(
                 "Skipping chapter %s as it is not in the specified filter",
                 current_chapter_index,
             )
@@ -1917,167 +3432,528 @@ def parse_new(udemy: Udemy, udemy_object: dict):
         chapter_dir = os.path.join(course_dir, chapter_title)
         if not os.path.exists(chapter_dir):
             os.mkdir(chapter_dir)
-        logger.info(
+        scheduler.log(
             f"======= Processing chapter {chapter_index} of {total_chapters} ======="
         )
 
         for lecture in chapter.get("lectures"):
-            clazz = lecture.get("_class")
-
-            if clazz == "quiz":
-                # skip the quiz if we dont want to download it
-                if not dl_quizzes:
-                    continue
-                process_quiz(udemy, lecture, chapter_dir)
-                continue
-            
-            if clazz == "role-play":
-                if not dl_quizzes:
-                    continue
-                process_role_play(udemy, lecture, chapter_dir)
+            if _sync_id(lecture) in skip_ids:
                 continue
+            if sync:
+                synced_lectures.track(sync, lecture)
+            scheduler.submit(
+                lecture.get("lecture_title"),
+                process_synced_item if sync else process_chapter_item,
+                udemy,
+                lecture,
+                chapter_dir,
+                total_lectures,
+                prefetcher,
+            )
 
-            index = lecture.get("index")  # this is lecture_counter
-            # lecture_index = lecture.get("lecture_index")  # this is the raw object index from udemy
+    scheduler.join()
+    if prefetcher:
+        prefetcher.shutdown()
 
-            lecture_title = lecture.get("lecture_title")
-            parsed_lecture = udemy._parse_lecture(lecture)
 
-            lecture_extension = parsed_lecture.get("extension")
-            extension = "mp4"  # video lectures dont have an extension property, so we assume its mp4
-            if lecture_extension != None:
-                # if the lecture extension property isnt none, set the extension to the lecture extension
-                extension = lecture_extension
-            lecture_file_name = sanitize_filename(lecture_title + "." + extension)
-            lecture_file_name = deEmojify(lecture_file_name)
-            lecture_path = os.path.join(chapter_dir, lecture_file_name)
-
-            if not skip_lectures:
-                logger.info(f"  > Processing lecture {index} of {total_lectures}")
-
-                # Check if the lecture is already downloaded
-                if os.path.isfile(lecture_path):
-                    logger.info(
-                        "      > Lecture '%s' is already downloaded, skipping..."
-                        % lecture_title
+class ManifestPrefetcher(object):
+    """
+    Resolves the sources of the next few lectures in the background while the current
+    one downloads, so manifest requests stay off the critical path.
+
+    Lectures are parsed in curriculum order and at most `lookahead` lectures ahead of
+    the furthest one that has been asked for.
+    """
+
+    def __init__(self, udemy: Udemy, lectures: list, lookahead: int):
+        self._udemy = udemy
+        self._lectures = [
+            lecture
+            for lecture in lectures
+            if lecture.get("_class") not in ("quiz", "role-play")
+        ]
+        self._positions = {id(lecture): i for i, lecture in enumerate(self._lectures)}
+        self._lookahead = lookahead
+        self._futures = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=lookahead, thread_name_prefix="manifest-prefetch"
+        )
+        self._fill(0)
+
+    def _fill(self, cursor: int):
+        with self._lock:
+            end = min(len(self._lectures), cursor + self._lookahead + 1)
+            while self._next < end:
+                lecture = self._lectures[self._next]
+                self._futures[self._next] = self._executor.submit(
+                    self._udemy._parse_lecture, lecture
+                )
+                self._next += 1
+
+    def get(self, lecture: dict) -> dict:
+        position = self._positions.get(id(lecture))
+        if position is None:
+            return self._udemy._parse_lecture(lecture)
+        self._fill(position)
+        with self._lock:
+            future = self._futures.pop(position, None)
+        if future is None:
+            # already handed out once, parse it again like an unknown lecture
+            return self._udemy._parse_lecture(lecture)
+        return future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _sync_id(lecture: dict) -> str:
+    # quizzes and lectures are numbered separately, so the class is part of the id
+    return f"{lecture.get('_class')}:{lecture.get('id')}"
+
+
+def _sync_options() -> dict:
+    """
+    The options that decide which files a lecture produces. When they change, every
+    lecture has to be processed again
+    """
+    return {
+        "skip_lectures": skip_lectures,
+        "skip_hls": skip_hls,
+        "quality": quality,
+        "use_h265": use_h265,
+        "dl_assets": dl_assets,
+        "dl_captions": dl_captions,
+        "caption_locale": caption_locale,
+        "dl_quizzes": dl_quizzes,
+    }
+
+
+def _sync_items(udemy_object: dict) -> list:
+    """
+    Describes every lecture of the course for CourseSync: its signature and where its
+    files are written
+    """
+    items = []
+    for chapter in udemy_object.get("chapters"):
+        for lecture in chapter.get("lectures"):
+            data = lecture.get("data") or {}
+            asset = data.get("asset") or {}
+            prefix = sanitize_filename(lecture.get("lecture_title"))
+            items.append(
+                {
+                    "id": _sync_id(lecture),
+                    "signature": [
+                        data.get("created"),
+                        asset.get("id"),
+                        asset.get("created"),
+                        sorted(
+                            a.get("id") for a in data.get("supplementary_assets") or []
+                        ),
+                    ],
+                    "dir": chapter.get("chapter_title"),
+                    # the lecture file itself has emojis removed, its captions don't
+                    "prefixes": list(dict.fromkeys([prefix, deEmojify(prefix)])),
+                    # assets are named after the lecture number and their own file name
+                    "asset_prefix": "{0:03d} ".format(lecture.get("index")),
+                }
+            )
+    return items
+
+
+def report_missing_keys(udemy: Udemy, lectures: list):
+    """
+    Reads the key ids of every DRM lecture from its manifest before anything is
+    downloaded and lists the lectures that need a key the key file doesn't have. They are
+    skipped when their turn comes, unless the selected quality only needs keys we have.
+    Lectures that are already downloaded don't need their keys and aren't checked
+
+    Args:
+        lectures (list): (lecture, chapter_dir) pairs
+    """
+    manifests = []
+    downloaded = 0
+    for lecture, chapter_dir in lectures:
+        asset = (lecture.get("data") or {}).get("asset")
+        # lectures without stream urls are the encrypted ones, see Udemy._parse_lecture
+        if not isinstance(asset, dict) or asset.get("stream_urls") is not None:
+            continue
+        source = next(
+            (
+                source
+                for source in asset.get("media_sources") or []
+                if source.get("type") == "application/dash+xml"
+            ),
+            None,
+        )
+        if source is None:
+            continue
+        lecture_path = _lecture_path(chapter_dir, lecture.get("lecture_title"), "mp4")
+        if state_db.is_done(lecture_path, lecture.get("id")):
+            downloaded += 1
+            continue
+        manifests.append((lecture, source.get("src"), asset.get("id")))
+    if downloaded:
+        logger.info(
+            f"> {downloaded} DRM lecture(s) are already downloaded, not checking their keys"
+        )
+    if not manifests:
+        return
+
+    logger.info(f"> Checking the keys of {len(manifests)} DRM lecture(s)")
+    with ThreadPoolExecutor(
+        max_workers=api_concurrency, thread_name_prefix="kid-check"
+    ) as executor:
+        results = list(
+            executor.map(lambda m: udemy._extract_mpd_kids(m[1], m[2]), manifests)
+        )
+
+    missing = []
+    for (lecture, _, _), kids in zip(manifests, results):
+        absent = sorted({kid for kid in kids.values() if kid not in keys})
+        if absent:
+            missing.append((lecture, absent))
+    if not missing:
+        logger.info("> The key file has the keys of every DRM lecture")
+        return
+
+    logger.warning(
+        f"> {len(missing)} DRM lecture(s) need keys that aren't in the key file:"
+    )
+    for lecture, absent in missing:
+        logger.warning(f"    - {lecture.get('lecture_title')}: {', '.join(absent)}")
+
+
+def _lecture_path(chapter_dir: str, lecture_title: str, extension: str) -> str:
+    lecture_file_name = sanitize_filename(lecture_title + "." + extension)
+    lecture_file_name = deEmojify(lecture_file_name)
+    return os.path.join(chapter_dir, lecture_file_name)
+
+
+def _selected_lectures(udemy_object: dict) -> list:
+    lectures = []
+    for chapter in udemy_object.get("chapters"):
+        chapter_index = int(chapter.get("chapter_index"))
+        if chapter_filter is not None and chapter_index not in chapter_filter:
+            continue
+        lectures.extend(chapter.get("lectures"))
+    return lectures
+
+
+class LectureScheduler(object):
+    """
+    Runs lectures through a bounded pool of worker threads.
+
+    Log records from each lecture are buffered and flushed in the order the lectures
+    were submitted, so the log reads the same as a sequential run. Messages logged between
+    lectures (chapter headers) go through `log` to keep their place. Only the per-worker
+    progress lines are written as they happen.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        self._pending = []
+        self._submitted = 0
+        self._finished = 0
+        self._lock = threading.Lock()
+        if workers > 1:
+            logger.info(f"> Processing up to {workers} lectures in parallel")
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="lecture-worker"
+            )
+
+    def submit(self, label: str, fn, *args):
+        if not self._executor:
+            fn(*args)
+            return
+        with self._lock:
+            self._submitted += 1
+        self._queue(self._executor.submit(self._run, label, fn, *args))
+
+    def log(self, msg: str, *args):
+        """
+        Logs a message in its place among the output of the submitted lectures
+        """
+        if not self._executor:
+            logger.info(msg, *args)
+            return
+        log_buffer.capture()
+        try:
+            logger.info(msg, *args)
+        finally:
+            records = log_buffer.release()
+        future = Future()
+        future.set_result(records)
+        self._queue(future)
+
+    def _queue(self, future: Future):
+        self._pending.append(future)
+        # flush whatever has already finished at the front of the queue
+        while self._pending and self._pending[0].done():
+            self._flush(self._pending.pop(0))
+
+    def _run(self, label: str, fn, *args):
+        worker = threading.current_thread().name
+        logger.info(f"[{worker}] Started '{label}'", extra={"unbuffered": True})
+        log_buffer.capture()
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception(f"    > Error processing '{label}'")
+        finally:
+            records = log_buffer.release()
+        with self._lock:
+            self._finished += 1
+            finished = self._finished
+            submitted = self._submitted
+        logger.info(
+            f"[{worker}] Finished '{label}' ({finished}/{submitted} done)",
+            extra={"unbuffered": True},
+        )
+        return records
+
+    def _flush(self, future):
+        for record in future.result():
+            logger.handle(record)
+
+    def join(self):
+        if not self._executor:
+            return
+        while self._pending:
+            self._flush(self._pending.pop(0))
+        self._executor.shutdown()
+
+
+class SyncedLectures(object):
+    """
+    Tells CourseSync when the lectures of a synced course are done with.
+
+    A lecture settles once it was processed and none of its files is still downloading or
+    muxing, DRM lectures handed to the segment pipeline settle when their job leaves it.
+    Lectures with a failed file are abandoned, which puts their previous version back.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def track(self, sync: CourseSync, lecture: dict):
+        with self._lock:
+            self._pending[_sync_id(lecture)] = {
+                "sync": sync,
+                "lecture_id": lecture.get("id"),
+                "started": time.time(),
+                "processed": False,
+                "failed": False,
+            }
+
+    def settle(self, item_id: str, processed=False, failed=False):
+        with self._lock:
+            pending = self._pending.get(item_id)
+            if pending is None:
+                return
+            pending["processed"] |= processed
+            pending["failed"] |= failed
+            if not pending["processed"]:
+                return
+            statuses = state_db.lecture_statuses(
+                pending["lecture_id"], pending["started"]
+            )
+            if "running" in statuses:
+                return
+            del self._pending[item_id]
+        if pending["failed"] or "failed" in statuses:
+            pending["sync"].abandon(item_id)
+        else:
+            pending["sync"].complete(item_id)
+
+
+synced_lectures = SyncedLectures()
+
+
+def process_synced_item(udemy: Udemy, lecture: dict, *args):
+    """
+    process_chapter_item for a lecture of a synced course, settling it once it returns
+    """
+    try:
+        process_chapter_item(udemy, lecture, *args)
+    except Exception:
+        synced_lectures.settle(_sync_id(lecture), processed=True, failed=True)
+        raise
+    synced_lectures.settle(_sync_id(lecture), processed=True)
+
+
+def process_chapter_item(
+    udemy: Udemy,
+    lecture: dict,
+    chapter_dir: str,
+    total_lectures: int,
+    prefetcher: "ManifestPrefetcher" = None,
+):
+    clazz = lecture.get("_class")
+
+    if clazz == "quiz":
+        # skip the quiz if we dont want to download it
+        if not dl_quizzes:
+            return
+        process_quiz(udemy, lecture, chapter_dir)
+        return
+
+    if clazz == "role-play":
+        if not dl_quizzes:
+            return
+        process_role_play(udemy, lecture, chapter_dir)
+        return
+
+    index = lecture.get("index")  # this is lecture_counter
+    # lecture_index = lecture.get("lecture_index")  # this is the raw object index from udemy
+
+    lecture_title = lecture.get("lecture_title")
+    if prefetcher:
+        parsed_lecture = prefetcher.get(lecture)
+    else:
+        parsed_lecture = udemy._parse_lecture(lecture)
+
+    lecture_extension = parsed_lecture.get("extension")
+    extension = "mp4"  # video lectures dont have an extension property, so we assume its mp4
+    if lecture_extension != None:
+        # if the lecture extension property isnt none, set the extension to the lecture extension
+        extension = lecture_extension
+    lecture_path = _lecture_path(chapter_dir, lecture_title, extension)
+
+    if not skip_lectures:
+        logger.info(f"  > Processing lecture {index} of {total_lectures}")
+
+        # Check if the lecture is already downloaded
+        if state_db.is_done(lecture_path, lecture.get("id")):
+            logger.info(
+                "      > Lecture '%s' is already downloaded, skipping..."
+                % lecture_title
+            )
+        else:
+            # Check if the file is an html file
+            if extension == "html":
+                # if the html content is None or an empty string, skip it so we dont save empty html files
+                if (
+                    parsed_lecture.get("html_content") != None
+                    and parsed_lecture.get("html_content") != ""
+                ):
+                    html_content = (
+                        parsed_lecture.get("html_content")
+                        .encode("utf8", "ignore")
+                        .decode("utf8")
                     )
-                else:
-                    # Check if the file is an html file
-                    if extension == "html":
-                        # if the html content is None or an empty string, skip it so we dont save empty html files
-                        if (
-                            parsed_lecture.get("html_content") != None
-                            and parsed_lecture.get("html_content") != ""
-                        ):
-                            html_content = (
-                                parsed_lecture.get("html_content")
-                                .encode("utf8", "ignore")
-                                .decode("utf8")
-                            )
-                            lecture_path = os.path.join(
-                                chapter_dir,
-                                "{}.html".format(sanitize_filename(lecture_title)),
-                            )
-                            try:
-                                with open(lecture_path, encoding="utf8", mode="w") as f:
-                                    f.write(html_content)
-                            except Exception:
-                                logger.exception("    > Failed to write html file")
-                    else:
-                        process_lecture(parsed_lecture, lecture_path, chapter_dir)
-
-            # download subtitles for this lecture
-            subtitles = parsed_lecture.get("subtitles")
-            if dl_captions and subtitles != None and lecture_extension == None:
-                logger.info("Processing {} caption(s)...".format(len(subtitles)))
-                for subtitle in subtitles:
-                    lang = subtitle.get("language")
-                    if lang == caption_locale or caption_locale == "all":
-                        process_caption(subtitle, lecture_title, chapter_dir)
-
-            if dl_assets:
-                assets = parsed_lecture.get("assets")
-                logger.info(
-                    "    > Processing {} asset(s) for lecture...".format(len(assets))
+                    lecture_path = os.path.join(
+                        chapter_dir,
+                        "{}.html".format(sanitize_filename(lecture_title)),
+                    )
+                    try:
+                        with open(lecture_path, encoding="utf8", mode="w") as f:
+                            f.write(html_content)
+                        record_download(lecture_path, True)
+                    except Exception:
+                        logger.exception("    > Failed to write html file")
+            else:
+                process_lecture(parsed_lecture, lecture_path, chapter_dir)
+
+    # download subtitles for this lecture
+    subtitles = parsed_lecture.get("subtitles")
+    if dl_captions and subtitles != None and lecture_extension == None:
+        logger.info("Processing {} caption(s)...".format(len(subtitles)))
+        for subtitle in subtitles:
+            lang = subtitle.get("language")
+            if lang == caption_locale or caption_locale == "all":
+                process_caption(
+                    subtitle, lecture_title, chapter_dir, lecture_id=lecture.get("id")
                 )
 
-                for asset in assets:
-                    asset_type = asset.get("type")
-                    filename = asset.get("filename")
-                    download_url = asset.get("download_url")
-
-                    if asset_type == "article":
-                        body = asset.get("body")
-                        # stip the 03d prefix
-                        lecture_path = os.path.join(
-                            chapter_dir,
-                            "{}.html".format(sanitize_filename(lecture_title)),
-                        )
-                        try:
-                            template_path = os.path.join(
-                                MAIN_SCRIPT_PATH, "templates", "article_template.html"
-                            )
-                            with open(template_path, "r") as f:
-                                content = f.read()
-                                content = content.replace(
-                                    "__title_placeholder__", lecture_title[4:]
-                                )
-                                content = content.replace("__data_placeholder__", body)
-                                with open(lecture_path, encoding="utf8", mode="w") as f:
-                                    f.write(content)
-                        except Exception as e:
-                            print("Failed to write html file: ", e)
-                            continue
-                    elif asset_type == "video":
-                        logger.warning(
-                            "If you're seeing this message, that means that you reached a secret area that I haven't finished! jk I haven't implemented handling for this asset type, please report this at https://github.com/Puyodead1/udemy-downloader/issues so I can add it. When reporting, please provide the following information: "
-                        )
-                        logger.warning("AssetType: Video; AssetData: ", asset)
-                    elif (
-                        asset_type == "audio"
-                        or asset_type == "e-book"
-                        or asset_type == "file"
-                        or asset_type == "presentation"
-                        or asset_type == "ebook"
-                        or asset_type == "source_code"
+    if dl_assets:
+        assets = parsed_lecture.get("assets")
+        logger.info("    > Processing {} asset(s) for lecture...".format(len(assets)))
+
+        for asset in assets:
+            asset_type = asset.get("type")
+            filename = asset.get("filename")
+            download_url = asset.get("download_url")
+
+            if asset_type == "article":
+                body = asset.get("body")
+                # stip the 03d prefix
+                lecture_path = os.path.join(
+                    chapter_dir,
+                    "{}.html".format(sanitize_filename(lecture_title)),
+                )
+                try:
+                    html_templates.render(
+                        "article_template",
+                        lecture_path,
+                        title=lecture_title[4:],
+                        data=body,
+                    )
+                except Exception as e:
+                    logger.error(f"    > Failed to write html file: {e}")
+                    continue
+            elif asset_type == "video":
+                logger.warning(
+                    "If you're seeing this message, that means that you reached a secret area that I haven't finished! jk I haven't implemented handling for this asset type, please report this at https://github.com/Puyodead1/udemy-downloader/issues so I can add it. When reporting, please provide the following information: "
+                )
+                logger.warning("AssetType: Video; AssetData: ", asset)
+            elif (
+                asset_type == "audio"
+                or asset_type == "e-book"
+                or asset_type == "file"
+                or asset_type == "presentation"
+                or asset_type == "ebook"
+                or asset_type == "source_code"
+            ):
+                asset_path = os.path.join(chapter_dir, filename)
+                if state_db.is_done(asset_path, lecture.get("id"), "asset"):
+                    logger.info(f"      > Asset '{filename}' is already downloaded")
+                    continue
+                state_db.start(asset_path, lecture.get("id"), "asset")
+                try:
+                    if asset_store and asset_store.materialize(
+                        asset.get("id"), asset_path
                     ):
-                        try:
-                            ret_code = download_aria(
-                                download_url, chapter_dir, filename
-                            )
-                            logger.debug(f"      > Download return code: {ret_code}")
-                        except Exception:
-                            logger.exception("> Error downloading asset")
-                    elif asset_type == "external_link":
-                        # write the external link to a shortcut file
-                        file_path = os.path.join(chapter_dir, f"{filename}.url")
-                        file = open(file_path, "w")
-                        file.write("[InternetShortcut]\n")
-                        file.write(f"URL={download_url}")
-                        file.close()
-
-                        # save all the external links to a single file
-                        savedirs, name = os.path.split(
-                            os.path.join(chapter_dir, filename)
-                        )
-                        filename = "external-links.txt"
-                        filename = os.path.join(savedirs, filename)
-                        file_data = []
-                        if os.path.isfile(filename):
-                            file_data = [
-                                i.strip().lower()
-                                for i in open(
-                                    filename, encoding="utf-8", errors="ignore"
-                                )
-                                if i
-                            ]
+                        record_download(asset_path, True)
+                        continue
+                    ret_code = download_file(download_url, chapter_dir, filename)
+                    logger.debug(f"      > Download return code: {ret_code}")
+                    if asset_store and ret_code == 0:
+                        asset_store.add(asset.get("id"), asset_path)
+                    record_download(asset_path, ret_code == 0)
+                except Exception as e:
+                    logger.exception("> Error downloading asset")
+                    state_db.fail(asset_path, str(e))
+            elif asset_type == "external_link":
+                # write the external link to a shortcut file
+                file_path = os.path.join(chapter_dir, f"{filename}.url")
+                file = open(file_path, "w")
+                file.write("[InternetShortcut]\n")
+                file.write(f"URL={download_url}")
+                file.close()
+
+                # save all the external links to a single file
+                savedirs, name = os.path.split(os.path.join(chapter_dir, filename))
+                filename = "external-links.txt"
+                filename = os.path.join(savedirs, filename)
+                with _external_links_lock:
+                    file_data = []
+                    if os.path.isfile(filename):
+                        file_data = [
+                            i.strip().lower()
+                            for i in open(filename, encoding="utf-8", errors="ignore")
+                            if i
+                        ]
 
-                        content = "\n{}\n{}\n".format(name, download_url)
-                        if name.lower() not in file_data:
-                            with open(
-                                filename, "a", encoding="utf-8", errors="ignore"
-                            ) as f:
-                                f.write(content)
+                    content = "\n{}\n{}\n".format(name, download_url)
+                    if name.lower() not in file_data:
+                        with open(
+                            filename, "a", encoding="utf-8", errors="ignore"
+                        ) as f:
+                            f.write(content)
 
 
 def _print_course_info(udemy: Udemy, udemy_object: dict):
@@ -2101,6 +3977,12 @@ def _print_course_info(udemy: Udemy, udemy_object: dict):
     logger.info("> Total Lectures: {}".format(lecture_count))
     logger.info("\n")
 
+    prefetcher = None
+    if prefetch_lectures:
+        prefetcher = ManifestPrefetcher(
+            udemy, _selected_lectures(udemy_object), prefetch_lectures
+        )
+
     chapters = udemy_object.get("chapters")
     for chapter in chapters:
         current_chapter_index = int(chapter.get("chapter_index"))
@@ -2124,7 +4006,10 @@ def _print_course_info(udemy: Udemy, udemy_object: dict):
                 "lecture_index"
             )  # this is the raw object index from udemy
             lecture_title = lecture.get("lecture_title")
-            parsed_lecture = udemy._parse_lecture(lecture)
+            if prefetcher:
+                parsed_lecture = prefetcher.get(lecture)
+            else:
+                parsed_lecture = udemy._parse_lecture(lecture)
 
             lecture_sources = parsed_lecture.get("sources")
             lecture_is_encrypted = parsed_lecture.get("is_encrypted", None)
@@ -2183,23 +4068,38 @@ def _print_course_info(udemy: Udemy, udemy_object: dict):
         if chapter_index != chapter_count:
             logger.info("==========================================")
 
+    if prefetcher:
+        prefetcher.shutdown()
+
 
 def main():
-    global bearer_token, portal_name
-    aria_ret_val = check_for_aria()
-    if not aria_ret_val:
-        logger.fatal("> Aria2c is missing from your system or path!")
-        sys.exit(1)
+    global bearer_token, portal_name, aria2_daemon, segment_pipeline, startup_ready
+    # only the tools of the stages that will run are required
+    downloads_lectures = not info and not skip_lectures
+    downloads_files = not info and (downloads_lectures or dl_assets or dl_captions)
+    if downloads_files and (use_aria2_daemon or not use_native_downloader):
+        if not check_for_aria():
+            logger.fatal("> Aria2c is missing from your system or path!")
+            sys.exit(1)
+    elif downloads_lectures and not check_for_aria():
+        logger.warning(
+            "> Aria2c is missing, lectures the native downloader hands over to yt-dlp will fail"
+        )
 
-    ffmpeg_ret_val = check_for_ffmpeg()
-    if not ffmpeg_ret_val and not skip_lectures:
-        logger.fatal("> FFMPEG is missing from your system or path!")
-        sys.exit(1)
+    if use_aria2_daemon and downloads_files:
+        aria2_daemon = Aria2RPC()
+        try:
+            aria2_daemon.start()
+        except Aria2RPCError as e:
+            logger.warning(
+                f"> Failed to start the aria2c RPC daemon, starting aria2c for every file instead: {e}"
+            )
+            aria2_daemon = None
 
-    shaka_ret_val = check_for_shaka()
-    if not shaka_ret_val and not skip_lectures:
-        logger.fatal("> Shaka Packager is missing from your system or path!")
+    if downloads_lectures and not check_for_ffmpeg():
+        logger.fatal("> FFMPEG is missing from your system or path!")
         sys.exit(1)
+    startup_ready = time.perf_counter()
 
     if load_from_file:
         logger.info(
@@ -2215,7 +4115,10 @@ def main():
         bearer_token = os.getenv("UDEMY_BEARER")
 
     udemy = Udemy(bearer_token)
-    portal_name = udemy.extract_portal_name(course_url)
+    batch_urls = read_batch_file(batch_file) if batch_file else []
+    portal_name = udemy.extract_portal_name(course_url or next(iter(batch_urls), ""))
+    if not portal_name:
+        portal_name = "www"
     visit_status = udemy.auth._session.visit(portal_name)
     if not visit_status:
         logger.fatal("> Visit request failed")
@@ -2236,16 +4139,120 @@ def main():
     #     logger.fatal("> use a bearer token")
     #     sys.exit(1)
 
+    if use_pipeline:
+        segment_pipeline = SegmentPipeline(
+            download_workers, mux_workers, finalize_workers
+        )
+
+    if batch_file or all_enrolled:
+        course_urls = batch_urls
+        if course_url:
+            course_urls.insert(0, course_url)
+        if all_enrolled:
+            course_urls.extend(udemy._enrolled_course_urls(portal_name))
+        process_batch(udemy, course_urls)
+    else:
+        try:
+            process_course(udemy, course_url)
+        except PaginationError as error:
+            logger.fatal(f"Connection error: {error}")
+            sys.exit(1)
+
+    if segment_pipeline:
+        logger.info("> Waiting for the remaining lectures to finish muxing...")
+        segment_pipeline.join()
+        segment_pipeline = None
+    state_db.finish_courses()
+    state_db.close()
+    if http_cache and (http_cache.hits or http_cache.misses):
+        logger.info(
+            f"> API response cache: {http_cache.hits} hit(s), {http_cache.misses} miss(es)"
+        )
+    if asset_store and asset_store.reused:
+        logger.info(
+            f"> Asset store: reused {asset_store.reused} asset(s), saved {asset_store.saved_bytes / 1024**2:.1f} MiB of downloads"
+        )
+
+
+def read_batch_file(path: str) -> list:
+    """
+    Reads course URLs from a file, one per line. Blank lines and lines starting with #
+    are ignored
+    """
+    with open(path, encoding="utf8", mode="r") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def process_batch(udemy: Udemy, course_urls: list):
+    """
+    Processes several courses with a pool of course workers. Every course shares the
+    authenticated session, so the login and the Cloudflare visit only happen once
+    """
+    if load_from_file or save_to_file:
+        logger.warning(
+            "> 'load_from_file' and 'save_to_file' only apply to a single course, ignoring them in batch mode"
+        )
+
+    # keep the order of the courses but drop duplicates
+    course_urls = list(dict.fromkeys(course_urls))
+    queued = []
+    for url in course_urls:
+        if udemy.extract_portal_name(url) != portal_name:
+            logger.warning(
+                f"> Skipping {url}, batch mode only supports courses from the {portal_name} portal"
+            )
+            continue
+        queued.append(url)
+
+    logger.info(f"> Batch mode: {len(queued)} course(s), {parallel_courses} at a time")
+    failed = []
+    with ThreadPoolExecutor(
+        max_workers=parallel_courses, thread_name_prefix="course-worker"
+    ) as executor:
+        futures = {
+            executor.submit(process_course, udemy.fork(), url): url for url in queued
+        }
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                future.result()
+                logger.info(f"> Finished course {url}")
+            # the course helpers exit on fatal errors, which should only end that course
+            except (Exception, SystemExit) as error:
+                logger.error(f"> Course {url} failed: {error!r}")
+                failed.append(url)
+
+    logger.info(
+        f"> Batch finished: {len(queued) - len(failed)} succeeded, {len(failed)} failed"
+    )
+    for url in failed:
+        logger.info(f"  - {url}")
+
+
+def process_course(udemy: Udemy, course_url: str):
+    global portal_name
+    # a batch shares one set of save files, so they are only used for single courses
+    use_load_from_file = load_from_file and not (batch_file or all_enrolled)
+    use_save_to_file = save_to_file and not (batch_file or all_enrolled)
+
     logger.info("> Fetching course information, this may take a minute...")
-    if not load_from_file:
-        course_id, course_info = udemy._extract_course_info(course_url)
-        logger.info("> Course information retrieved!")
+    course_json = None
+    if not use_load_from_file:
+        if use_async_api:
+            course_id, course_info, course_json = asyncio.run(
+                udemy._fetch_course_metadata_async(course_url)
+            )
+        else:
+            course_id, course_info = udemy._extract_course_info(course_url)
+            logger.info("> Course information retrieved!")
         if course_info and isinstance(course_info, dict):
             title = sanitize_filename(course_info.get("title"))
             course_title = course_info.get("published_title")
 
-    logger.info("> Fetching course curriculum, this may take a minute...")
-    if load_from_file:
+    if not course_json:
+        logger.info("> Fetching course curriculum, this may take a minute...")
+    if use_load_from_file:
         course_json = json.loads(
             open(
                 os.path.join(os.getcwd(), "saved", "course_content.json"),
@@ -2257,12 +4264,13 @@ def main():
         course_title = course_json.get("published_title")
         portal_name = course_json.get("portal_name")
     else:
-        course_json = udemy._extract_course_curriculum(
-            course_url, course_id, portal_name
-        )
+        if not course_json:
+            course_json = udemy._extract_course_curriculum(
+                course_url, course_id, portal_name
+            )
         course_json["portal_name"] = portal_name
 
-    if save_to_file:
+    if use_save_to_file:
         with open(
             os.path.join(os.getcwd(), "saved", "course_content.json"),
             encoding="utf8",
@@ -2274,7 +4282,7 @@ def main():
     course = course_json.get("results")
     resource = course_json.get("detail")
 
-    if load_from_file:
+    if use_load_from_file:
         udemy_object = json.loads(
             open(
                 os.path.join(os.getcwd(), "saved", "_udemy.json"),
@@ -2427,7 +4435,7 @@ def main():
                 ]
             )
 
-        if save_to_file:
+        if use_save_to_file:
             with open(
                 os.path.join(os.getcwd(), "saved", "_udemy.json"),
                 encoding="utf8",
@@ -2445,8 +4453,31 @@ def main():
             parse_new(udemy, udemy_object)
 
 
+def log_startup_report():
+    """
+    Logs where the startup time of the run went, like python -X importtime but only for
+    what this program controls
+    """
+    lines = [f"{(imports_done - imports_started) * 1000:8.1f} ms  imports at startup"]
+    if startup_ready:
+        lines.append(
+            f"{(startup_ready - imports_done) * 1000:8.1f} ms  setup until the run started (arguments, caches, tools)"
+        )
+    lines.append("> Tools:")
+    lines.extend(tool_probe.report() or ["    none needed"])
+    lines.append("> Imported on first use:")
+    lines.extend(import_report() or ["    none"])
+    logger.info("> Startup report:\n" + "\n".join(lines))
+
+
 if __name__ == "__main__":
     # pre run parses arguments, sets up logging, and creates directories
     pre_run()
     # run main program
-    main()
+    try:
+        main()
+    finally:
+        if aria2_daemon:
+            aria2_daemon.shutdown()
+        if startup_report:
+            log_startup_report()
@@ -0,0 +1,155 @@
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger("udemy-downloader")
+
+# dash manifests are cached by structure only, see Udemy._extract_mpd
+MPD_CACHE_TTL = 7 * 24 * 60 * 60
+
+# query parameters holding a unix timestamp the url stops working at
+EXPIRY_PARAMS = ("expires", "exp", "expiry", "e")
+# akamai style tokens pack it into a single parameter: st=...~exp=1700000000~acl=...
+TOKEN_EXPIRY_RE = re.compile(r"(?:^|[~&:])exp=(?P<exp>\d{9,})")
+
+
+def _jwt_expiry(token: str) -> Optional[int]:
+    """
+    Reads the exp claim of a JWT token without verifying it
+    """
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    payload = parts[1] + "=" * (-len(parts[1]) % 4)
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    return int(exp) if isinstance(exp, (int, float)) else None
+
+
+def url_expiry(url: str) -> Optional[int]:
+    """
+    Finds when a signed CDN url expires, from an Expires style parameter, an akamai
+    token or the exp claim of a JWT token
+
+    Returns:
+        int: The unix timestamp the url expires at, or None if it doesn't say
+    """
+    expiries = []
+    for name, values in parse_qs(urlsplit(url).query).items():
+        for value in values:
+            if name.lower() in EXPIRY_PARAMS and value.isdigit() and len(value) >= 9:
+                expiries.append(int(value))
+                continue
+            match = TOKEN_EXPIRY_RE.search(value)
+            if match:
+                expiries.append(int(match.group("exp")))
+                continue
+            exp = _jwt_expiry(value)
+            if exp:
+                expiries.append(exp)
+    return min(expiries) if expiries else None
+
+
+class ManifestCache(object):
+    """
+    Parsed lecture manifests kept on disk across runs, keyed by asset id.
+
+    An entry lives until the earliest expiry of the signed urls it depends on (minus a
+    safety margin, so the download started from it still has time to finish), or for a
+    fixed time when the urls don't say. Expired entries are refreshed the next time the
+    lecture is parsed and pruned on startup.
+    """
+
+    def __init__(
+        self, directory: str, margin: int = 30 * 60, default_ttl: int = 60 * 60
+    ):
+        self.directory = Path(directory)
+        self.margin = margin
+        self.default_ttl = default_ttl
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _index_path(self, key: str) -> Path:
+        return Path(self.directory, f"{key}.json")
+
+    def entry_dir(self, key: str) -> Path:
+        """
+        A directory for files belonging to an entry, like hls variant playlists
+        """
+        path = Path(self.directory, key)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _valid(self, entry: dict) -> bool:
+        return time.time() < entry.get("expires", 0) - self.margin
+
+    def get(self, key: str) -> Optional[list]:
+        """
+        Returns the renditions of a cached manifest, or None if there is no entry or it
+        expired
+        """
+        try:
+            with open(self._index_path(key), encoding="utf8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self._valid(entry):
+            self.remove(key)
+            return None
+        logger.debug(
+            f"Manifest cache hit for {key}, valid for another {int(entry['expires'] - time.time()) // 60} minute(s)"
+        )
+        return entry["renditions"]
+
+    def put(
+        self, key: str, renditions: list, signed_urls=(), ttl: Optional[int] = None
+    ):
+        expiries = [e for e in (url_expiry(url) for url in signed_urls) if e]
+        expires = min(expiries) if expiries else time.time() + (ttl or self.default_ttl)
+        entry = {"expires": expires, "renditions": renditions}
+        if not self._valid(entry):
+            # already too close to expiring to be of any use later
+            return
+        path = self._index_path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def remove(self, key: str):
+        self._index_path(key).unlink(missing_ok=True)
+        shutil.rmtree(Path(self.directory, key), ignore_errors=True)
+
+    def prune(self):
+        """
+        Removes expired entries, along with files of entries that were never finished
+        """
+        removed = 0
+        keys = {p.stem for p in self.directory.glob("*.json")}
+        for key in keys:
+            try:
+                with open(self._index_path(key), encoding="utf8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = {}
+            if not self._valid(entry):
+                self.remove(key)
+                removed += 1
+        for path in self.directory.iterdir():
+            if path.is_dir() and path.name not in keys:
+                shutil.rmtree(path, ignore_errors=True)
+        if removed:
+            logger.debug(f"Pruned {removed} expired manifest(s)")
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
@@ -6,11 +6,12 @@ http://download.macromedia.com/f4v/video_file_format_spec_v10_1.pdf
 
 """
 
-import bitstring
 from datetime import datetime
 from collections import namedtuple
 import logging
-import six
+import mmap
+import os
+import struct
 
 log = logging.getLogger(__name__)
 #log.addHandler(logging.NullHandler())
@@ -106,9 +107,307 @@ class MovieFragmentHeader(MixinDictRepr):
 class ProtectionSystemSpecificHeader(MixinDictRepr):
     type = "pssh"
 
+class TrackEncryptionBox(MixinDictRepr):
+    type = "tenc"
+
+class SegmentIndexBox(MixinDictRepr):
+    type = "sidx"
+
+    SegmentIndexReference = namedtuple("SegmentIndexReference", ["reference_type", "referenced_size", "subsegment_duration",
+                                                                 "starts_with_sap", "sap_type", "sap_delta_time"])
+
+
 BoxHeader = namedtuple( "BoxHeader", ["box_size", "box_type", "header_size"] )
- 
-    
+
+WIDEVINE_SYSTEM_ID = "edef8ba979d64acea3c827dcd51d21ed"
+# pssh boxes sit at the top level of a moov (init segment) or moof (fragment)
+PSSH_CONTAINERS = (MovieBox.type, MovieFragmentBox.type)
+
+# bytes between the start of a container box's payload and its first child box
+CONTAINER_OFFSETS = {
+    "moov": 0, "trak": 0, "mdia": 0, "minf": 0, "stbl": 0, "mvex": 0, "edts": 0, "dinf": 0, "udta": 0,
+    "moof": 0, "traf": 0, "mfra": 0, "sinf": 0, "schi": 0,
+    # full box with an entry count
+    "stsd": 8,
+    # sample entries, the child boxes follow the visual or audio sample entry fields
+    "encv": 78, "avc1": 78, "avc3": 78, "hvc1": 78, "hev1": 78,
+    "enca": 28, "mp4a": 28,
+}
+
+
+def read_box_header(view, pos, end):
+    """ Read the header of the box at pos of a buffer. A box with a size of 0 runs to end
+
+    :raises: ValueError if the header is cut short or its size is invalid
+    """
+    if end - pos < 8:
+        raise ValueError("Premature end of data while reading box header")
+    size, box_type = struct.unpack_from(">I4s", view, pos)
+
+    # box_type should be an ASCII string. Decode as UTF-8 in case
+    try:
+        box_type = box_type.decode('utf-8')
+    except UnicodeDecodeError:
+        # we'll leave as bytes instead
+        pass
+
+    header_size = 8
+    if size == 1:
+        # extended size, in the next 64 bits
+        if end - pos < 16:
+            raise ValueError("Premature end of data while reading box header")
+        size, = struct.unpack_from(">Q", view, pos + 8)
+        header_size = 16
+    elif size == 0:
+        # the last box, it runs to the end of the data
+        size = end - pos
+    if size < header_size:
+        raise ValueError("Invalid size %d for box %s" % (size, box_type))
+
+    return BoxHeader(box_size=size-header_size, box_type=box_type, header_size=header_size)
+
+
+def iter_boxes(view, start=0, end=None, base=0):
+    """ Yield the boxes of a buffer between start and end, in order
+
+    :param base: offset of the buffer in the file, for the offsets of the boxes
+    """
+    end = len(view) if end is None else end
+    pos = start
+    while pos < end:
+        if end - pos < 8:
+            log.warning("%d trailing byte(s) after the last box", end - pos)
+            return
+        header = read_box_header(view, pos, end)
+        box_end = pos + header.header_size + header.box_size
+        if box_end > end:
+            log.warning("Box %s runs past the end of the data", header.box_type)
+            box_end = end
+        yield Box(header, base + pos, view[pos + header.header_size:box_end])
+        pos = box_end
+
+
+def _find(boxes, names):
+    for box in boxes:
+        if names[0] in ("*", box.type):
+            if len(names) == 1:
+                yield box
+            else:
+                for child in _find(box, names[1:]):
+                    yield child
+
+
+class Box(object):
+    """ A box of an ISO BMFF file, read lazily
+
+    data is a memoryview of the payload in the underlying buffer, nothing is copied until
+    a field is decoded. Child boxes are only read while iterating a container box.
+    """
+
+    def __init__(self, header, offset, data):
+        self.header = header
+        self.offset = offset
+        self.data = data
+
+    @property
+    def type(self):
+        return self.header.box_type
+
+    @property
+    def size(self):
+        return self.header.header_size + self.header.box_size
+
+    def __iter__(self):
+        """ The child boxes of a container box, none for other boxes """
+        skip = CONTAINER_OFFSETS.get(self.type)
+        if skip is None or skip > len(self.data):
+            return iter(())
+        return iter_boxes(self.data, skip, base=self.offset + self.header.header_size)
+
+    def find(self, path):
+        """ Yield the descendants at a path of box types like "trak/mdia/minf", * matches any type """
+        return _find(self, path.split("/"))
+
+    def decode(self):
+        """ The fields of a pssh, tenc, sidx or mfhd box, None for other boxes """
+        decoder = BOX_DECODERS.get(self.type)
+        return decoder(self.data, self.header) if decoder else None
+
+    def __repr__(self, *args, **kwargs):
+        return "Box({!r}, offset={}, size={})".format(self.type, self.offset, self.size)
+
+
+def decode_pssh(data, header):
+    """ Decode the body of a pssh box, version 0 or 1 """
+    if len(data) < 24:
+        log.warning("Premature end of data in pssh box")
+        return None
+
+    pssh = ProtectionSystemSpecificHeader()
+    pssh.header = header
+    pssh.version = data[0]
+    pssh.system_id = data[4:20].hex()
+    pos = 20
+    pssh.key_ids = []
+    if pssh.version > 0:
+        kid_count, = struct.unpack_from(">I", data, pos)
+        pos += 4
+        pssh.key_ids = [data[pos + i * 16:pos + (i + 1) * 16].hex() for i in range(kid_count)]
+        pos += kid_count * 16
+    data_size, = struct.unpack_from(">I", data, pos)
+    pos += 4
+    pssh.payload = data[pos:pos + data_size].hex()
+    return pssh
+
+
+def decode_tenc(data, header):
+    """ Decode the body of a tenc box, the default key id of a protected track """
+    tenc = TrackEncryptionBox()
+    tenc.header = header
+    tenc.version = data[0]
+    if tenc.version > 0:
+        tenc.default_crypt_byte_block = data[5] >> 4
+        tenc.default_skip_byte_block = data[5] & 0x0f
+    tenc.default_is_protected = data[6]
+    tenc.default_per_sample_iv_size = data[7]
+    tenc.default_kid = data[8:24].hex()
+    tenc.default_constant_iv = None
+    if tenc.default_is_protected == 1 and tenc.default_per_sample_iv_size == 0:
+        iv_size = data[24]
+        tenc.default_constant_iv = data[25:25 + iv_size].hex()
+    return tenc
+
+
+def decode_sidx(data, header):
+    """ Decode the body of a sidx box, the index of the subsegments that follow it """
+    sidx = SegmentIndexBox()
+    sidx.header = header
+    sidx.version = data[0]
+    sidx.reference_id, sidx.timescale = struct.unpack_from(">II", data, 4)
+    if sidx.version == 0:
+        sidx.earliest_presentation_time, sidx.first_offset = struct.unpack_from(">II", data, 12)
+        pos = 20
+    else:
+        sidx.earliest_presentation_time, sidx.first_offset = struct.unpack_from(">QQ", data, 12)
+        pos = 28
+    reference_count, = struct.unpack_from(">2xH", data, pos)
+    pos += 4
+    sidx.references = [
+        SegmentIndexBox.SegmentIndexReference(reference_type=size >> 31, referenced_size=size & 0x7fffffff,
+                                              subsegment_duration=duration, starts_with_sap=sap >> 31,
+                                              sap_type=(sap >> 28) & 0x7, sap_delta_time=sap & 0x0fffffff)
+        for size, duration, sap in struct.iter_unpack(">III", data[pos:pos + reference_count * 12])
+    ]
+    return sidx
+
+
+def decode_mfhd(data, header):
+    mfhd = MovieFragmentHeader()
+    mfhd.header = header
+    mfhd.sequence_number, = struct.unpack_from(">I", data, 4)
+    return mfhd
+
+
+BOX_DECODERS = {
+    ProtectionSystemSpecificHeader.type:    decode_pssh,
+    TrackEncryptionBox.type:                decode_tenc,
+    SegmentIndexBox.type:                   decode_sidx,
+    MovieFragmentHeader.type:               decode_mfhd,
+}
+
+
+class BoxReader(object):
+    """ Reads the boxes of an MP4 file or buffer lazily
+
+    Files are mapped with mmap, so only the pages of the boxes that are looked at are read
+    from disk and skipping an mdat costs nothing. The boxes point into the mapping, use
+    them while the reader is open.
+
+    >>> with BoxReader("init.mp4") as reader:
+    ...     kids = [tenc.decode().default_kid for tenc in reader.find("moov/trak/mdia/minf/stbl/stsd/*/sinf/schi/tenc")]
+    """
+
+    def __init__(self, filename=None, bytes_input=None, file_input=None, offset_bytes=0):
+        self._file = None
+        self._mmap = None
+        if filename is not None:
+            self._file = open(filename, "rb")
+            buffer = self._map(self._file)
+        elif file_input is not None:
+            try:
+                buffer = self._map(file_input)
+            except (AttributeError, OSError, ValueError):
+                # not backed by a file that can be mapped
+                buffer = file_input.read()
+        else:
+            buffer = bytes_input
+        self.offset = offset_bytes
+        self.view = memoryview(buffer)[offset_bytes:]
+
+    def _map(self, f):
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __iter__(self):
+        return iter_boxes(self.view, base=self.offset)
+
+    def find(self, path):
+        """ Yield the boxes at a path of box types like "moov/trak", * matches any type """
+        return _find(self, path.split("/"))
+
+    def close(self):
+        self.view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # boxes still point into the mapping, it is unmapped once they are gone
+                pass
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Cursor(object):
+    """ Sequential big endian reads from a buffer, for the boxes decoded field by field """
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from(">" + fmt, self.view, self.pos)
+        self.pos += struct.calcsize(">" + fmt)
+        return values if len(values) > 1 else values[0]
+
+    def read_string(self):
+        """ read UTF8 null terminated string """
+        end = self.pos
+        while self.view[end] != 0:
+            end += 1
+        result = bytes(self.view[self.pos:end]).decode("utf-8")
+        self.pos = end + 1
+        return result if result else None
+
+    def read_count_and_string_table(self):
+        """ Read a count then return the strings in a list """
+        return [self.read_string() for _ in range(self.read("B"))]
+
+    def read_box(self):
+        """ Read a whole child box, returns its header and a cursor over its payload """
+        header = read_box_header(self.view, self.pos, len(self.view))
+        start = self.pos + header.header_size
+        self.pos = start + header.box_size
+        return header, _Cursor(self.view[start:self.pos])
+
+
 class F4VParser(object):
 
     @classmethod
@@ -116,6 +415,8 @@ class F4VParser(object):
         """
         Parse an MP4 file or bytes into boxes
 
+        Compatibility interface over BoxReader, which reads boxes lazily without copying
+        them. mdat payloads are memoryviews into the data.
 
         :param filename: filename of mp4 file.
         :type filename: str.
@@ -135,49 +436,62 @@ class F4VParser(object):
             MediaDataBox.type:                      cls._parse_mdat,
             MovieFragmentBox.type:                  cls._parse_moof,
             MovieBox.type:                          cls._parse_moov,
-            MovieFragmentHeader.type:               cls._parse_mfhd,
-            ProtectionSystemSpecificHeader.type:    cls._parse_pssh
+            MovieFragmentHeader.type:               decode_mfhd,
+            ProtectionSystemSpecificHeader.type:    decode_pssh,
         }
-        
-        if filename:
-            bs = bitstring.ConstBitStream(filename=filename, offset=offset_bytes * 8)
-        elif bytes_input:
-            bs = bitstring.ConstBitStream(bytes=bytes_input, offset=offset_bytes * 8)
-        else:
-            bs = bitstring.ConstBitStream(auto=file_input, offset=offset_bytes * 8)
-        
-        log.debug("Starting parse")
-        log.debug("Size is %d bits", bs.len)
 
-        while bs.pos < bs.len:
-            log.debug("Byte pos before header: %d relative to (%d)", bs.bytepos, offset_bytes)
-            log.debug("Reading header")
-            try:
-                header = cls._read_box_header(bs)
-            except bitstring.ReadError as e:
-                log.error("Premature end of data while reading box header")
-                raise
-            
-            log.debug("Header type: %s", header.box_type)
-            log.debug("Byte pos after header: %d relative to (%d)", bs.bytepos, offset_bytes)
-
-            if headers_only:
-                yield header
-
-                # move pointer to next header if possible
-                try:
-                    bs.bytepos += header.box_size
-                except ValueError:
-                    log.warning("Premature end of data")
-                    raise
-            else:
-                # Get parser method for header type
-                parse_function = box_lookup.get(header.box_type, cls._parse_unimplemented)
-                try:
-                    yield parse_function(bs, header)
-                except ValueError as e:
-                    log.error("Premature end of data")
-                    raise
+        with BoxReader(filename, bytes_input, file_input, offset_bytes) as reader:
+            for box in reader:
+                log.debug("Header type: %s at %d", box.type, box.offset)
+                if headers_only:
+                    yield box.header
+                else:
+                    parse_function = box_lookup.get(box.type, cls._parse_unimplemented)
+                    yield parse_function(box.data, box.header)
+
+    @classmethod
+    def iter_pssh(cls, filename, offset_bytes=0):
+        """
+        Yield the pssh boxes of an MP4 file without reading its media data
+
+        Only moov and moof boxes are descended into and everything else (mdat above all)
+        is skipped over in the mapping, so finding the pssh of a multi gigabyte file
+        touches a handful of pages.
+
+        :param filename: filename of mp4 file.
+        :type filename: str.
+        :param offset_bytes: start parsing at offset.
+        :type offset_bytes: int.
+        :return: ProtectionSystemSpecificHeader boxes, in file order
+        """
+
+        with BoxReader(filename, offset_bytes=offset_bytes) as reader:
+            for box in reader:
+                if box.type not in PSSH_CONTAINERS:
+                    continue
+                for child in box:
+                    if child.type == ProtectionSystemSpecificHeader.type:
+                        pssh = child.decode()
+                        if pssh:
+                            yield pssh
+
+    @classmethod
+    def find_pssh(cls, filename, system_id=WIDEVINE_SYSTEM_ID):
+        """
+        Return the first pssh box of a DRM system, or None. Stops reading as soon as it
+        is found
+
+        :param filename: filename of mp4 file.
+        :type filename: str.
+        :param system_id: hex system id, Widevine by default
+        :type system_id: str.
+        """
+
+        boxes = cls.iter_pssh(filename)
+        try:
+            return next((box for box in boxes if box.system_id == system_id), None)
+        finally:
+            boxes.close()
 
     @classmethod
     def _is_mp4(cls, parser):
@@ -185,7 +499,8 @@ class F4VParser(object):
             for box in parser:
                 return True
         except ValueError:
-            return False
+            pass
+        return False
 
     @classmethod
     def is_mp4_s(cls, bytes_input):
@@ -218,101 +533,55 @@ class F4VParser(object):
         return cls._is_mp4(parser)
 
     @staticmethod
-    def _read_string(bs):
-        """ read UTF8 null terminated string """
-        result = bs.readto('0x00', bytealigned=True).bytes.decode("utf-8")[:-1]
-        return result if result else None
-
-    @classmethod
-    def _read_count_and_string_table(cls, bs):
-        """ Read a count then return the strings in a list """
-        result = []
-        entry_count = bs.read("uint:8")
-        for _ in six.range(0, entry_count):
-            result.append( cls._read_string(bs) )
-        return result
-
-    @staticmethod
-    def _read_box_header(bs):
-        header_start_pos = bs.bytepos
-        size, box_type = bs.readlist("uint:32, bytes:4")
-
-        # box_type should be an ASCII string. Decode as UTF-8 in case
-        try:
-            box_type = box_type.decode('utf-8')
-        except UnicodeDecodeError:
-            # we'll leave as bytes instead
-            pass
-
-        # if size == 1, then this is an extended size type.
-        # Therefore read the next 64 bits as size
-        if size == 1:
-            size = bs.read("uint:64")
-        header_end_pos = bs.bytepos
-        header_size = header_end_pos - header_start_pos    
-        
-        return BoxHeader(box_size=size-header_size, box_type=box_type, header_size=header_size)
-
-    @staticmethod
-    def _parse_unimplemented(bs, header):
+    def _parse_unimplemented(data, header):
         ui = UnImplementedBox()
         ui.header = header
-
-        bs.bytepos += header.box_size
-        
         return ui
 
     @classmethod
-    def _parse_afra(cls, bs, header):
-    
+    def _parse_afra(cls, data, header):
+
         afra = FragmentRandomAccessBox()
         afra.header = header
-        
-        # read the entire box in case there's padding
-        afra_bs = bs.read(header.box_size * 8)
+
+        afra_bs = _Cursor(data)
         # skip Version and Flags
-        afra_bs.pos += 8 + 24
-        long_ids, long_offsets, global_entries, afra.time_scale, local_entry_count  = \
-                afra_bs.readlist("bool, bool, bool, pad:5, uint:32, uint:32")
-        
-        if long_ids:
-            id_bs_type = "uint:32"
-        else:
-            id_bs_type = "uint:16"
-                
-        if long_offsets:
-            offset_bs_type = "uint:64"
-        else:
-            offset_bs_type = "uint:32"
-        
+        afra_bs.pos += 4
+        flags = afra_bs.read("B")
+        long_ids, long_offsets, global_entries = bool(flags & 0x80), bool(flags & 0x40), bool(flags & 0x20)
+        afra.time_scale, local_entry_count = afra_bs.read("II")
+
+        id_bs_type = "I" if long_ids else "H"
+        offset_bs_type = "Q" if long_offsets else "I"
+
         log.debug("local_access_entries entry count: %s", local_entry_count)
-        afra.local_access_entries = []        
-        for _ in six.range(0, local_entry_count):
+        afra.local_access_entries = []
+        for _ in range(0, local_entry_count):
             time = cls._parse_time_field(afra_bs, afra.time_scale)
-            
+
             offset = afra_bs.read(offset_bs_type)
-            
+
             afra_entry = \
-                FragmentRandomAccessBox.FragmentRandomAccessBoxEntry(time=time, 
+                FragmentRandomAccessBox.FragmentRandomAccessBoxEntry(time=time,
                                                                      offset=offset)
             afra.local_access_entries.append(afra_entry)
-        
+
         afra.global_access_entries = []
-        
+
         if global_entries:
-            global_entry_count = afra_bs.read("uint:32")
-            
-            log.debug("global_access_entries entry count: %s", global_entry_count)  
-            
-            for _ in six.range(0, global_entry_count):
+            global_entry_count = afra_bs.read("I")
+
+            log.debug("global_access_entries entry count: %s", global_entry_count)
+
+            for _ in range(0, global_entry_count):
                 time = cls._parse_time_field(afra_bs, afra.time_scale)
-                
+
                 segment_number = afra_bs.read(id_bs_type)
                 fragment_number = afra_bs.read(id_bs_type)
-                
+
                 afra_offset = afra_bs.read(offset_bs_type)
                 sample_offset = afra_bs.read(offset_bs_type)
-                
+
                 afra_global_entry = \
                     FragmentRandomAccessBox.FragmentRandomAccessBoxGlobalEntry(
                                             time=time,
@@ -320,32 +589,28 @@ class F4VParser(object):
                                             fragment_number=fragment_number,
                                             afra_offset=afra_offset,
                                             sample_offset=sample_offset)
-    
+
                 afra.global_access_entries.append(afra_global_entry)
-       
+
         return afra
 
     @classmethod
-    def _parse_moof(cls, bootstrap_bs, header):
+    def _parse_moof(cls, data, header):
         moof = MovieFragmentBox()
         moof.header = header
 
-        box_bs = bootstrap_bs.read(moof.header.box_size * 8)
-
-        for child_box in cls.parse(bytes_input=box_bs.bytes):
+        for child_box in cls.parse(bytes_input=data):
             setattr(moof, child_box.type, child_box)
 
         return moof
 
     @classmethod
-    def _parse_moov(cls, bootstrap_bs, header):
+    def _parse_moov(cls, data, header):
         moov = MovieBox()
         moov.header = header
         psshs = []
 
-        box_bs = bootstrap_bs.read(moov.header.box_size * 8)
-
-        for child_box in cls.parse(bytes_input=box_bs.bytes):
+        for child_box in cls.parse(bytes_input=data):
             if(child_box.type == "pssh"):
                 psshs.append(child_box)
             else:
@@ -355,85 +620,63 @@ class F4VParser(object):
         return moov
 
     @classmethod
-    def _parse_mfhd(cls, bootstrap_bs, header):
-        mfhd = MovieFragmentHeader()
-        mfhd.header = header
+    def _parse_abst(cls, data, header):
 
-        box_bs = bootstrap_bs.read(mfhd.header.box_size * 8)
-        return mfhd
+        abst = BootStrapInfoBox()
+        abst.header = header
 
-    @staticmethod
-    def _parse_pssh(bootstrap_bs, header):
-        pssh = ProtectionSystemSpecificHeader()
-        pssh.header = header
+        box_bs = _Cursor(data)
+        # skip Version and Flags
+        box_bs.pos += 4
+        abst.version = box_bs.read("I")
+        flags = box_bs.read("B")
+        abst.profile_raw, abst.live, abst.update = flags >> 6, bool(flags & 0x20), bool(flags & 0x10)
+        abst.time_scale, abst.current_media_time, abst.smpte_timecode_offset = box_bs.read("IQQ")
+        abst.movie_identifier = box_bs.read_string()
 
-        box_bs = bootstrap_bs.read(pssh.header.box_size*8)
-        # Payload appears to be 8 bytes in.
-        data = box_bs.hex[8:]
-        pssh.system_id = data[:32]
-        pssh.payload = data[40:]
-        return pssh
+        abst.server_entry_table = box_bs.read_count_and_string_table()
+        abst.quality_entry_table = box_bs.read_count_and_string_table()
+
+        abst.drm_data = box_bs.read_string()
+        abst.meta_data = box_bs.read_string()
 
-    @classmethod
-    def _parse_abst(cls, bootstrap_bs, header):
-        
-        abst = BootStrapInfoBox()
-        abst.header = header
-        
-        box_bs = bootstrap_bs.read(abst.header.box_size * 8)
-        
-        abst.version, abst.profile_raw, abst.live, abst.update, \
-        abst.time_scale, abst.current_media_time, abst.smpte_timecode_offset = \
-                box_bs.readlist("""pad:8, pad:24, uint:32, uint:2, bool, bool,
-                                   pad:4,
-                                   uint:32, uint:64, uint:64""")
-        abst.movie_identifier = cls._read_string(box_bs)
-        
-        abst.server_entry_table = cls._read_count_and_string_table(box_bs)
-        abst.quality_entry_table = cls._read_count_and_string_table(box_bs)
-            
-        abst.drm_data = cls._read_string(box_bs)
-        abst.meta_data = cls._read_string(box_bs)
-                
         abst.segment_run_tables = []
-        
-        segment_count = box_bs.read("uint:8")
+
+        segment_count = box_bs.read("B")
         log.debug("segment_count: %d" % segment_count)
-        for _ in six.range(0, segment_count):
+        for _ in range(0, segment_count):
             abst.segment_run_tables.append( cls._parse_asrt(box_bs) )
 
         abst.fragment_tables = []
-        fragment_count = box_bs.read("uint:8")
+        fragment_count = box_bs.read("B")
         log.debug("fragment_count: %d" % fragment_count)
-        for _ in xrange(0, fragment_count):
+        for _ in range(0, fragment_count):
             abst.fragment_tables.append( cls._parse_afrt(box_bs) )
-        
+
         log.debug("Finished parsing abst")
-        
+
         return abst
 
     @classmethod
     def _parse_asrt(cls, box_bs):
         """ Parse asrt / Segment Run Table Box """
-        
+
         asrt = SegmentRunTable()
-        asrt.header = cls._read_box_header(box_bs)
         # read the entire box in case there's padding
-        asrt_bs_box = box_bs.read(asrt.header.box_size * 8)
-        
-        asrt_bs_box.pos += 8
-        update_flag = asrt_bs_box.read("uint:24")
+        asrt.header, asrt_bs_box = box_bs.read_box()
+
+        asrt_bs_box.pos += 1
+        update_flag = int.from_bytes(asrt_bs_box.read("3s"), "big")
         asrt.update = True if update_flag == 1 else False
-        
-        asrt.quality_segment_url_modifiers = cls._read_count_and_string_table(asrt_bs_box)
-        
+
+        asrt.quality_segment_url_modifiers = asrt_bs_box.read_count_and_string_table()
+
         asrt.segment_run_table_entries = []
-        segment_count = asrt_bs_box.read("uint:32")
-        
-        for _ in six.range(0, segment_count):
-            first_segment = asrt_bs_box.read("uint:32")
-            fragments_per_segment = asrt_bs_box.read("uint:32")
-            asrt.segment_run_table_entries.append( 
+        segment_count = asrt_bs_box.read("I")
+
+        for _ in range(0, segment_count):
+            first_segment, fragments_per_segment = asrt_bs_box.read("II")
+            asrt.segment_run_table_entries.append(
                 SegmentRunTable.SegmentRunTableEntry(first_segment=first_segment,
                                                      fragments_per_segment=fragments_per_segment) )
         return asrt
@@ -441,40 +684,38 @@ class F4VParser(object):
     @classmethod
     def _parse_afrt(cls, box_bs):
         """ Parse afrt / Fragment Run Table Box """
-        
+
         afrt = FragmentRunTable()
-        afrt.header = cls._read_box_header(box_bs)
         # read the entire box in case there's padding
-        afrt_bs_box = box_bs.read(afrt.header.box_size * 8)
-        
-        afrt_bs_box.pos += 8
-        update_flag = afrt_bs_box.read("uint:24")
+        afrt.header, afrt_bs_box = box_bs.read_box()
+
+        afrt_bs_box.pos += 1
+        update_flag = int.from_bytes(afrt_bs_box.read("3s"), "big")
         afrt.update = True if update_flag == 1 else False
- 
-        afrt.time_scale = afrt_bs_box.read("uint:32")
-        afrt.quality_fragment_url_modifiers = cls._read_count_and_string_table(afrt_bs_box)
-        
-        fragment_count = afrt_bs_box.read("uint:32")
-        
+
+        afrt.time_scale = afrt_bs_box.read("I")
+        afrt.quality_fragment_url_modifiers = afrt_bs_box.read_count_and_string_table()
+
+        fragment_count = afrt_bs_box.read("I")
+
         afrt.fragments = []
 
-        for _ in six.range(0, fragment_count):
-            first_fragment = afrt_bs_box.read("uint:32")
-            first_fragment_timestamp_raw = afrt_bs_box.read("uint:64")
-            
+        for _ in range(0, fragment_count):
+            first_fragment, first_fragment_timestamp_raw = afrt_bs_box.read("IQ")
+
             try:
                 first_fragment_timestamp = datetime.utcfromtimestamp(first_fragment_timestamp_raw/float(afrt.time_scale))
             except ValueError:
                 # Elemental sometimes create odd timestamps
                 first_fragment_timestamp = None
-                
-            fragment_duration = afrt_bs_box.read("uint:32")
-            
+
+            fragment_duration = afrt_bs_box.read("I")
+
             if fragment_duration == 0:
-                discontinuity_indicator = afrt_bs_box.read("uint:8")
+                discontinuity_indicator = afrt_bs_box.read("B")
             else:
                 discontinuity_indicator = None
-            
+
             frte = FragmentRunTable.FragmentRunTableEntry(first_fragment=first_fragment,
                                                           first_fragment_timestamp=first_fragment_timestamp,
                                                           fragment_duration=fragment_duration,
@@ -483,15 +724,15 @@ class F4VParser(object):
         return afrt
 
     @staticmethod
-    def _parse_mdat(box_bs, header):
-        """ Parse afrt / Fragment Run Table Box """
-                
+    def _parse_mdat(data, header):
+        """ Parse mdat / Media Data Box, the payload is not copied """
+
         mdat = MediaDataBox()
         mdat.header = header
-        mdat.payload = box_bs.read(mdat.header.box_size * 8).bytes
+        mdat.payload = data
         return mdat
 
     @staticmethod
     def _parse_time_field(bs, scale):
-        timestamp = bs.read("uint:64")
-        return datetime.utcfromtimestamp(timestamp / float(scale) )
\ No newline at end of file
+        timestamp = bs.read("Q")
+        return datetime.utcfromtimestamp(timestamp / float(scale) )
@@ -0,0 +1,126 @@
+import logging
+from typing import Optional
+
+from lazy_import import lazy_import
+
+logger = logging.getLogger("udemy-downloader")
+
+mpegdash_parser = lazy_import("mpegdash.parser")
+
+# the extensions yt-dlp gives dash formats, the tracks are downloaded under these names
+MIME_EXTENSIONS = {
+    "video/mp4": "mp4",
+    "audio/mp4": "m4a",
+    "video/webm": "webm",
+    "audio/webm": "webm",
+}
+AUDIO_CODECS = ("mp4a", "ac-3", "ec-3", "opus", "vorbis", "flac")
+
+
+def _kid(node) -> Optional[str]:
+    for protection in node.content_protections or []:
+        kid = (
+            protection.cenc_default_kid
+            or protection.default_key_id
+            or protection.ns2_key_id
+        )
+        if kid:
+            return kid.replace("-", "").lower()
+    return None
+
+
+def _content_type(adaptation_set, representation) -> Optional[str]:
+    mime_type = representation.mime_type or adaptation_set.mime_type or ""
+    content_type = adaptation_set.content_type or mime_type.split("/")[0]
+    if content_type in ("video", "audio"):
+        return content_type
+    codecs = representation.codecs or adaptation_set.codecs or ""
+    if codecs:
+        return "audio" if codecs.startswith(AUDIO_CODECS) else "video"
+    return None
+
+
+def parse_mpd_formats(mpd: str) -> list:
+    """
+    Lists the audio and video representations of a DASH manifest, the attributes a
+    representation doesn't have are inherited from its adaptation set
+
+    Returns:
+        list: A dict per representation with its format id (the representation id, like
+            a generic yt-dlp extraction), type, height, width, bitrate in kbps, codecs,
+            extension and key id
+    """
+    manifest = mpegdash_parser.MPEGDASHParser.parse(mpd)
+    periods = manifest.periods or []
+    if len(periods) != 1:
+        # yt-dlp prefixes the format ids with the period, leave those manifests to it
+        raise ValueError(f"Unsupported MPD with {len(periods)} periods")
+
+    formats = []
+    for adaptation_set in periods[0].adaptation_sets or []:
+        set_kid = _kid(adaptation_set)
+        for representation in adaptation_set.representations or []:
+            content_type = _content_type(adaptation_set, representation)
+            if not content_type or not representation.id:
+                continue
+            mime_type = representation.mime_type or adaptation_set.mime_type or ""
+            formats.append(
+                {
+                    "format_id": representation.id,
+                    "type": content_type,
+                    "height": representation.height or adaptation_set.height,
+                    "width": representation.width or adaptation_set.width,
+                    "tbr": (representation.bandwidth or 0) / 1000,
+                    "codecs": representation.codecs or adaptation_set.codecs,
+                    "ext": MIME_EXTENSIONS.get(mime_type, mime_type.split("/")[-1]),
+                    "kid": _kid(representation) or set_kid,
+                }
+            )
+    return formats
+
+
+def dash_sources(formats: list, url: str) -> list:
+    """
+    Picks the sources of a DASH lecture from its formats: the audio track, paired with
+    the highest bitrate video of every height
+
+    Returns:
+        list: The sources, from the lowest to the highest quality
+
+    Raises:
+        ValueError: The manifest has no audio track or no video with a height, it is
+            left to yt-dlp
+    """
+    audio = [f for f in formats if f["type"] == "audio"]
+    if not audio:
+        raise ValueError("No suitable audio format found in MPD")
+    # the first audio format yt-dlp lists, it sorts them from the lowest bitrate; the
+    # format ids are what fragment journals and cached sources are keyed on
+    audio_format = min(audio, key=lambda f: f["tbr"])
+
+    best_video = {}
+    for video in formats:
+        if video["type"] != "video" or not video["height"]:
+            continue
+        height = video["height"]
+        if height not in best_video or video["tbr"] > best_video[height]["tbr"]:
+            best_video[height] = video
+    if not best_video:
+        raise ValueError("No video format with a height found in MPD")
+
+    sources = []
+    for height in sorted(best_video):
+        video = best_video[height]
+        sources.append(
+            {
+                "type": "dash",
+                "height": str(height),
+                "width": str(video["width"]),
+                "format_id": f"{video['format_id']},{audio_format['format_id']}",
+                "extension": video["ext"],
+                "download_url": url,
+                "tbr": round(video["tbr"]),
+                "kids": sorted({f["kid"] for f in (video, audio_format) if f["kid"]}),
+            }
+        )
+    return sources
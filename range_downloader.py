@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Optional
+
+import requests
+from tqdm import tqdm
+
+from download_budget import RateLimiter
+from segment_downloader import FRAGMENT_RETRIES, TIMEOUT, DownloadStats
+
+logger = logging.getLogger("udemy-downloader")
+
+# files are split into ranges of this size, a range is the unit of resumption
+RANGE_SIZE = 8 * 1024**2
+# bytes read from the response at a time, and the buffer of each writer
+READ_SIZE = 256 * 1024
+WRITE_BUFFER = 1024**2
+# the range sidecar is brought up to date at most this often
+CHECKPOINT_INTERVAL = 1.0
+
+CONTENT_RANGE_RE = re.compile(r"bytes \d+-\d+/(?P<size>\d+)")
+
+
+class RangeError(Exception):
+    pass
+
+
+class RemoteFile(object):
+    """
+    What the server says about a file: its size, whether it serves byte ranges, and a
+    validator (ETag or Last-Modified) to tell that a partial download is of the same file
+    """
+
+    def __init__(self, size: Optional[int], ranges: bool, validator: Optional[str]):
+        self.size = size
+        self.ranges = ranges
+        self.validator = validator
+
+
+class RangeDownloader(object):
+    """
+    Downloads a file over a pooled HTTP session, split into byte ranges fetched by several
+    workers in parallel and written in place into a preallocated `.part` file.
+
+    The completed ranges are recorded in a `.part.ranges` sidecar, so an interrupted
+    download resumes with the ranges that are missing. The sidecar is keyed on the size
+    and validator of the file rather than its url, the signed urls of Udemy change on
+    every run. Servers that don't serve ranges get a single streaming request.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        connections: int,
+        rate: Optional[int] = None,
+        retries: int = FRAGMENT_RETRIES,
+        stats: Optional[DownloadStats] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.session = session
+        self.connections = max(1, connections)
+        self.limiter = limiter or (RateLimiter(rate) if rate else None)
+        self.retries = retries
+        self.stats = stats or DownloadStats()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def probe(self, url: str) -> RemoteFile:
+        """
+        Asks for the first byte of a file. Signed CDN urls don't always allow HEAD, and a
+        206 answer is the only reliable sign that ranges are served
+        """
+        with self.session.get(
+            url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+        ) as r:
+            r.raise_for_status()
+            validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+            match = CONTENT_RANGE_RE.match(r.headers.get("Content-Range", ""))
+            if r.status_code == 206 and match:
+                return RemoteFile(int(match.group("size")), True, validator)
+            size = r.headers.get("Content-Length")
+            return RemoteFile(int(size) if size else None, False, validator)
+
+    def download(self, url: str, path: str, desc: Optional[str] = None) -> int:
+        """
+        Downloads a file to `path`, resuming a previous partial download of it
+
+        Returns:
+            int: The size of the file
+
+        Raises:
+            RangeError: A range failed after every retry
+        """
+        self._cancelled.clear()
+        remote = self.probe(url)
+        if not remote.ranges or not remote.size:
+            return self._download_whole(url, path, remote, desc)
+
+        part_path = f"{path}.part"
+        sidecar_path = f"{part_path}.ranges"
+        ranges = [
+            (start, min(start + RANGE_SIZE, remote.size))
+            for start in range(0, remote.size, RANGE_SIZE)
+        ]
+        done = self._load_done(part_path, sidecar_path, remote)
+        missing = [r for r in ranges if r[0] not in done]
+        if missing and not os.path.exists(part_path):
+            self._preallocate(part_path, remote.size)
+
+        bar = tqdm(
+            total=remote.size,
+            initial=remote.size - sum(end - start for start, end in missing),
+            unit="B",
+            unit_scale=True,
+            desc=desc,
+        )
+        pending = queue.Queue()
+        for r in missing:
+            pending.put(r)
+        errors = []
+        checkpoint = [time.monotonic()]
+
+        def work():
+            try:
+                with open(part_path, "r+b", buffering=WRITE_BUFFER) as f:
+                    while not self._cancelled.is_set():
+                        try:
+                            start, end = pending.get_nowait()
+                        except queue.Empty:
+                            return
+                        self._fetch_range(url, f, start, end, bar)
+                        f.flush()
+                        with self._lock:
+                            done.add(start)
+                            if time.monotonic() - checkpoint[0] >= CHECKPOINT_INTERVAL:
+                                checkpoint[0] = time.monotonic()
+                                self._save_done(sidecar_path, remote, done)
+            except Exception as e:
+                errors.append(e)
+                self._cancelled.set()
+
+        workers = [
+            threading.Thread(target=work, daemon=True)
+            for _ in range(min(self.connections, len(missing)))
+        ]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            bar.close()
+            # also on failure, so a retry only fetches the ranges that are missing
+            with self._lock:
+                self._save_done(sidecar_path, remote, done)
+        if errors:
+            raise RangeError(f"{desc or url}: {errors[0]}") from errors[0]
+
+        if os.path.getsize(part_path) != remote.size:
+            raise RangeError(f"{desc or url}: size mismatch after download")
+        os.replace(part_path, path)
+        os.remove(sidecar_path)
+        return remote.size
+
+    def _fetch_range(self, url: str, f, start: int, end: int, bar: tqdm):
+        """
+        Writes the bytes [start, end) of a file at their offset, a retry carries on from
+        the last byte written
+        """
+        pos = start
+        error = delay = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logger.debug(f"Range {start}-{end - 1} failed ({error}), retrying")
+                if self._cancelled.wait(delay):
+                    raise RangeError("cancelled")
+            delay = min(2**attempt, 10)
+            headers = {"Range": f"bytes={pos}-{end - 1}"}
+            try:
+                with self.session.get(
+                    url, headers=headers, stream=True, timeout=TIMEOUT
+                ) as r:
+                    if r.status_code in (429, 503):
+                        error = f"HTTP {r.status_code}"
+                        self.stats.add(throttled=1)
+                        try:
+                            delay = min(float(r.headers.get("Retry-After", delay)), 30)
+                        except ValueError:
+                            pass
+                        continue
+                    if r.status_code != 206:
+                        # a 200 would be the whole file, the range is of no use
+                        error = f"HTTP {r.status_code}"
+                        self.stats.add(errors=1)
+                        continue
+                    f.seek(pos)
+                    for chunk in r.iter_content(chunk_size=READ_SIZE):
+                        if self._cancelled.is_set():
+                            raise RangeError("cancelled")
+                        chunk = chunk[: end - pos]
+                        f.write(chunk)
+                        pos += len(chunk)
+                        self._progress(bar, len(chunk))
+                        if pos >= end:
+                            return
+            except requests.RequestException as e:
+                error = e
+                self.stats.add(errors=1)
+                continue
+            error = "connection closed early"
+            self.stats.add(errors=1)
+        raise RangeError(
+            f"range {start}-{end - 1} failed after {self.retries + 1} attempt(s): {error}"
+        )
+
+    def _download_whole(
+        self, url: str, path: str, remote: RemoteFile, desc: Optional[str]
+    ) -> int:
+        """
+        One streaming request for servers that don't serve ranges, retried from the start
+        """
+        part_path = f"{path}.part"
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logger.debug(f"Download failed ({error}), retrying")
+                time.sleep(min(2**attempt, 10))
+            bar = tqdm(total=remote.size, unit="B", unit_scale=True, desc=desc)
+            try:
+                with self.session.get(url, stream=True, timeout=TIMEOUT) as r:
+                    r.raise_for_status()
+                    with open(part_path, "wb", buffering=WRITE_BUFFER) as f:
+                        for chunk in r.iter_content(chunk_size=READ_SIZE):
+                            f.write(chunk)
+                            self._progress(bar, len(chunk))
+            except requests.RequestException as e:
+                error = e
+                self.stats.add(errors=1)
+                continue
+            finally:
+                bar.close()
+            size = os.path.getsize(part_path)
+            if remote.size is not None and size != remote.size:
+                error = f"got {size} of {remote.size} bytes"
+                self.stats.add(errors=1)
+                continue
+            os.replace(part_path, path)
+            return size
+        raise RangeError(
+            f"{desc or url} failed after {self.retries + 1} attempt(s): {error}"
+        )
+
+    def _progress(self, bar: tqdm, nbytes: int):
+        if self.limiter:
+            self.limiter.consume(nbytes)
+        self.stats.add(nbytes=nbytes)
+        with self._lock:
+            bar.update(nbytes)
+
+    @staticmethod
+    def _preallocate(part_path: str, size: int):
+        with open(part_path, "wb") as f:
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                    return
+                except OSError:
+                    # not supported by the filesystem
+                    pass
+            f.truncate(size)
+
+    @staticmethod
+    def _load_done(part_path: str, sidecar_path: str, remote: RemoteFile) -> set:
+        """
+        The start offsets of the ranges a previous download completed, empty when there is
+        nothing to resume or the partial file is of another version of the file
+        """
+        try:
+            with open(sidecar_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if (
+            data.get("size") != remote.size
+            or data.get("validator") != remote.validator
+            or data.get("range_size") != RANGE_SIZE
+            or not os.path.isfile(part_path)
+            or os.path.getsize(part_path) != remote.size
+        ):
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return set()
+        done = set(data.get("done", []))
+        if done:
+            logger.info(
+                f"      > Resuming {os.path.basename(part_path)}, {len(done)} range(s) already downloaded"
+            )
+        return done
+
+    @staticmethod
+    def _save_done(sidecar_path: str, remote: RemoteFile, done: set):
+        data = {
+            "size": remote.size,
+            "validator": remote.validator,
+            "range_size": RANGE_SIZE,
+            "done": sorted(done),
+        }
+        tmp_path = f"{sidecar_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, sidecar_path)
+        except OSError as e:
+            logger.debug(f"Failed to save the ranges of {sidecar_path}: {e}")
@@ -0,0 +1,510 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import unquote, urljoin, urlsplit
+from xml.etree import ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from download_budget import RateLimiter
+from fragment_journal import FragmentJournal
+from lazy_import import lazy_import
+
+m3u8 = lazy_import("m3u8")
+
+logger = logging.getLogger("udemy-downloader")
+
+# byte_range is "start-end" (inclusive, like a Range header) or None for the whole url
+Fragment = namedtuple("Fragment", ["url", "byte_range"])
+
+FRAGMENT_RETRIES = 10
+# the output file is written through a buffer this large, fragments are a few hundred KiB
+WRITE_BUFFER = 8 * 1024**2
+# the journal and the .ytdl file are brought up to date at most this often
+CHECKPOINT_INTERVAL = 1.0
+TIMEOUT = (10, 60)
+
+ISO_DURATION_RE = re.compile(
+    r"^P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>[\d.]+)S)?)?$"
+)
+TEMPLATE_RE = re.compile(
+    r"\$(?P<name>RepresentationID|Number|Time|Bandwidth)(?:%0(?P<width>\d+)d)?\$"
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class FragmentError(Exception):
+    pass
+
+
+class UnsupportedManifest(Exception):
+    """
+    The manifest uses a feature the native downloader doesn't handle, the caller falls back
+    to yt-dlp
+    """
+
+
+def get_session() -> requests.Session:
+    """
+    The pooled session shared by every fragment download, so connections to the CDN are
+    reused across fragments, tracks and lectures
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=64)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def read_manifest(url: str, session: requests.Session) -> str:
+    if url.startswith("file://"):
+        with open(unquote(urlsplit(url).path), encoding="utf-8") as f:
+            return f.read()
+    r = session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.text
+
+
+def parse_iso_duration(value: Optional[str]) -> Optional[float]:
+    match = ISO_DURATION_RE.match(value or "")
+    if not match:
+        return None
+    parts = {k: float(v) if v else 0 for k, v in match.groupdict().items()}
+    return (
+        parts["days"] * 86400
+        + parts["hours"] * 3600
+        + parts["minutes"] * 60
+        + parts["seconds"]
+    )
+
+
+def _fill_template(template: str, rep_id: str, bandwidth, number=None, time=None):
+    def substitute(match):
+        value = {
+            "RepresentationID": rep_id,
+            "Number": number,
+            "Time": time,
+            "Bandwidth": bandwidth,
+        }[match.group("name")]
+        width = match.group("width")
+        return str(value).zfill(int(width)) if width else str(value)
+
+    return TEMPLATE_RE.sub(substitute, template).replace("$$", "$")
+
+
+def _base_url(url: str, elements) -> str:
+    for element in elements:
+        base = element.find("{*}BaseURL")
+        if base is not None and base.text:
+            url = urljoin(url, base.text.strip())
+    return url
+
+
+def _merged(elements, tag: str) -> Optional[dict]:
+    """
+    Merges the attributes of a segment element (SegmentTemplate, SegmentList) along the
+    hierarchy, the inner ones override the outer ones
+    """
+    merged = None
+    for element in elements:
+        child = element.find(f"{{*}}{tag}")
+        if child is None:
+            continue
+        merged = dict(merged or {})
+        merged.update(child.attrib)
+        if child.find("{*}SegmentTimeline") is not None:
+            merged["_timeline"] = child.find("{*}SegmentTimeline")
+        if child.find("{*}Initialization") is not None:
+            merged["_initialization"] = child.find("{*}Initialization")
+        if child.findall("{*}SegmentURL"):
+            merged["_urls"] = child.findall("{*}SegmentURL")
+    return merged
+
+
+def dash_fragments(mpd: str, mpd_url: str, rep_id: str) -> list:
+    """
+    Lists the fragments of a representation of a DASH manifest, initialization segment
+    first
+
+    Returns:
+        list: Fragment tuples, in the order they are appended to the track
+    """
+    root = ElementTree.fromstring(mpd)
+    periods = root.findall("{*}Period")
+    if len(periods) != 1:
+        raise UnsupportedManifest(f"{len(periods)} periods")
+    period = periods[0]
+    for adaptation_set in period.findall("{*}AdaptationSet"):
+        for representation in adaptation_set.findall("{*}Representation"):
+            if representation.get("id") == rep_id:
+                break
+        else:
+            continue
+        break
+    else:
+        raise FragmentError(f"Representation {rep_id} is not in the manifest")
+
+    hierarchy = (root, period, adaptation_set, representation)
+    base = _base_url(mpd_url, hierarchy)
+    bandwidth = representation.get("bandwidth")
+    duration = parse_iso_duration(period.get("duration")) or parse_iso_duration(
+        root.get("mediaPresentationDuration")
+    )
+
+    template = _merged(hierarchy[1:], "SegmentTemplate")
+    if template:
+        return _template_fragments(template, base, rep_id, bandwidth, duration)
+
+    segment_list = _merged(hierarchy[1:], "SegmentList")
+    if segment_list:
+        fragments = []
+        init = segment_list.get("_initialization")
+        if init is not None:
+            fragments.append(
+                Fragment(urljoin(base, init.get("sourceURL", "")), init.get("range"))
+            )
+        for segment in segment_list.get("_urls", []):
+            fragments.append(
+                Fragment(
+                    urljoin(base, segment.get("media", "")), segment.get("mediaRange")
+                )
+            )
+        return fragments
+
+    # a single file, SegmentBase only points at its index
+    return [Fragment(base, None)]
+
+
+def _template_fragments(template, base, rep_id, bandwidth, duration) -> list:
+    fragments = []
+    number = int(template.get("startNumber", 1))
+    if template.get("initialization"):
+        url = _fill_template(template["initialization"], rep_id, bandwidth)
+        fragments.append(Fragment(urljoin(base, url), None))
+    media = template.get("media")
+    if not media:
+        raise UnsupportedManifest("SegmentTemplate without media")
+    timescale = int(template.get("timescale", 1))
+
+    timeline = template.get("_timeline")
+    if timeline is not None:
+        time = 0
+        entries = timeline.findall("{*}S")
+        for index, entry in enumerate(entries):
+            time = int(entry.get("t", time))
+            d = int(entry.get("d"))
+            r = int(entry.get("r", 0))
+            if r < 0:
+                # repeat until the next entry or the end of the period
+                end = (
+                    int(entries[index + 1].get("t"))
+                    if index + 1 < len(entries) and entries[index + 1].get("t")
+                    else (duration or 0) * timescale
+                )
+                r = math.ceil((end - time) / d) - 1
+            for _ in range(r + 1):
+                url = _fill_template(media, rep_id, bandwidth, number, time)
+                fragments.append(Fragment(urljoin(base, url), None))
+                number += 1
+                time += d
+        return fragments
+
+    if not template.get("duration") or not duration:
+        raise UnsupportedManifest("SegmentTemplate without a timeline or duration")
+    count = math.ceil(duration * timescale / int(template["duration"]))
+    for i in range(count):
+        url = _fill_template(media, rep_id, bandwidth, number + i)
+        fragments.append(Fragment(urljoin(base, url), None))
+    return fragments
+
+
+def hls_fragments(playlist: str, uri: str) -> list:
+    """
+    Lists the fragments of an HLS media playlist, with its initialization section first
+    when it has one (fragmented MP4 segments)
+    """
+    media = m3u8.loads(playlist, uri=uri)
+    if media.is_variant:
+        raise UnsupportedManifest("master playlist")
+    fragments = []
+    init_uri = None
+    for segment in media.segments:
+        key = segment.key
+        if key is not None and (key.method or "NONE").upper() != "NONE":
+            raise UnsupportedManifest(f"{key.method} encrypted segments")
+        init = segment.init_section
+        if init is not None and init.absolute_uri != init_uri:
+            init_uri = init.absolute_uri
+            fragments.append(Fragment(init_uri, _hls_range(init.byterange)))
+        fragments.append(
+            Fragment(segment.absolute_uri, _hls_range(segment.byterange, fragments))
+        )
+    return fragments
+
+
+def _hls_range(byterange: Optional[str], previous: Optional[list] = None):
+    """
+    Turns an EXT-X-BYTERANGE (`length[@offset]`) into a Range header value, the offset
+    defaults to the end of the previous range
+    """
+    if not byterange:
+        return None
+    length, _, offset = byterange.partition("@")
+    if offset:
+        start = int(offset)
+    elif previous and previous[-1].byte_range:
+        start = int(previous[-1].byte_range.split("-")[1]) + 1
+    else:
+        start = 0
+    return f"{start}-{start + int(length) - 1}"
+
+
+class DownloadStats(object):
+    def __init__(self):
+        self.bytes = 0
+        self.errors = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes=0, errors=0, throttled=0):
+        with self._lock:
+            self.bytes += nbytes
+            self.errors += errors
+            self.throttled += throttled
+
+
+class FragmentDownloader(object):
+    """
+    Downloads the fragments of a track over a pooled HTTP session with a few workers and
+    appends them to the output in order through a large write buffer.
+
+    Only a window of fragments ahead of the one being written is in flight, so memory use
+    stays bounded. With a fragment journal, fragments are recorded as they are written
+    and a later download of the same track skips them. A .ytdl file is kept next to the
+    partial file like yt-dlp does, so yt-dlp can resume a partial track when the lecture
+    falls back to it.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        concurrency: int,
+        rate: Optional[int] = None,
+        retries: int = FRAGMENT_RETRIES,
+        stats: Optional[DownloadStats] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter or (RateLimiter(rate) if rate else None)
+        self.retries = retries
+        self.stats = stats or DownloadStats()
+        self._cancelled = threading.Event()
+
+    def _fetch(self, fragment: Fragment) -> bytes:
+        headers = (
+            {"Range": f"bytes={fragment.byte_range}"} if fragment.byte_range else {}
+        )
+        error = delay = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logger.debug(f"Fragment failed ({error}), retrying in {delay}s")
+                if self._cancelled.wait(delay):
+                    raise FragmentError("cancelled")
+            elif self._cancelled.is_set():
+                raise FragmentError("cancelled")
+            delay = min(2**attempt, 10)
+            try:
+                r = self.session.get(fragment.url, headers=headers, timeout=TIMEOUT)
+            except requests.RequestException as e:
+                error = e
+                self.stats.add(errors=1)
+                continue
+            if r.status_code in (429, 503):
+                error = f"HTTP {r.status_code}"
+                self.stats.add(throttled=1)
+                try:
+                    delay = min(float(r.headers.get("Retry-After", delay)), 30)
+                except ValueError:
+                    pass
+                continue
+            if r.status_code >= 400:
+                error = f"HTTP {r.status_code}"
+                self.stats.add(errors=1)
+                continue
+            data = r.content
+            if fragment.byte_range and r.status_code == 200:
+                # the server ignored the range and sent the whole file
+                first, last = map(int, fragment.byte_range.split("-"))
+                data = data[first : last + 1]
+            if self.limiter:
+                self.limiter.consume(len(data))
+            self.stats.add(nbytes=len(data))
+            return data
+        raise FragmentError(
+            f"{fragment.url} failed after {self.retries + 1} attempt(s): {error}"
+        )
+
+    def download(
+        self,
+        fragments: list,
+        path: str,
+        journal: Optional[FragmentJournal] = None,
+        rep_id: Optional[str] = None,
+        desc: Optional[str] = None,
+    ):
+        """
+        Downloads a track to `path`, resuming from the journal if it has the track
+
+        Raises:
+            FragmentError: A fragment failed after every retry
+        """
+        part_path = f"{path}.part"
+        ytdl_path = f"{path}.ytdl"
+        start, offset = self._resume_point(part_path, journal, rep_id)
+        if journal:
+            journal.set_total(rep_id, len(fragments))
+        if start >= len(fragments):
+            os.replace(part_path, path)
+            return
+
+        bar = self._progress_bar(len(fragments), start, desc)
+        checkpoint = time.monotonic()
+        written = []
+        fetched = self._fetch_in_order(fragments, start)
+        try:
+            with open(part_path, "ab", buffering=WRITE_BUFFER) as f:
+                try:
+                    for index, data in fetched:
+                        f.write(data)
+                        offset += len(data)
+                        written.append(index)
+                        self._update_progress(bar, offset)
+                        if time.monotonic() - checkpoint >= CHECKPOINT_INTERVAL:
+                            f.flush()
+                            self._checkpoint(
+                                journal, rep_id, written, offset, ytdl_path
+                            )
+                            written = []
+                            checkpoint = time.monotonic()
+                finally:
+                    # also on failure, so a retry resumes after the last fragment written
+                    f.flush()
+                    self._checkpoint(journal, rep_id, written, offset, ytdl_path)
+        finally:
+            fetched.close()
+            bar.close()
+
+        os.replace(part_path, path)
+        if os.path.exists(ytdl_path):
+            os.remove(ytdl_path)
+        if journal:
+            journal.mark_complete(rep_id)
+            journal.save()
+
+    def stream(self, fragments: list, f, desc: Optional[str] = None):
+        """
+        Writes every fragment of a track to a binary file object in order, like a pipe to
+        ffmpeg. Nothing is kept to resume from
+
+        Raises:
+            FragmentError: A fragment failed after every retry
+        """
+        bar = self._progress_bar(len(fragments), 0, desc)
+        offset = 0
+        fetched = self._fetch_in_order(fragments, 0)
+        try:
+            for _, data in fetched:
+                f.write(data)
+                offset += len(data)
+                self._update_progress(bar, offset)
+        finally:
+            fetched.close()
+            bar.close()
+
+    def _fetch_in_order(self, fragments: list, start: int):
+        """
+        Yields the index and content of every fragment from `start` on, in order, with a
+        window of the next ones being fetched in the background
+        """
+        pending = deque()
+        upcoming = iter(range(start, len(fragments)))
+        window = self.concurrency * 2
+        executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="fragment"
+        )
+        try:
+            while True:
+                while len(pending) < window:
+                    index = next(upcoming, None)
+                    if index is None:
+                        break
+                    pending.append(
+                        (index, executor.submit(self._fetch, fragments[index]))
+                    )
+                if not pending:
+                    break
+                index, future = pending.popleft()
+                yield index, future.result()
+        finally:
+            self._cancelled.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self._cancelled.clear()
+
+    @staticmethod
+    def _progress_bar(total: int, initial: int, desc: Optional[str]) -> tqdm:
+        return tqdm(total=total, initial=initial, unit="frag", desc=desc, leave=False)
+
+    @staticmethod
+    def _update_progress(bar: tqdm, offset: int):
+        bar.update(1)
+        bar.set_postfix_str(f"{offset / 1024**2:.1f} MiB", refresh=False)
+
+    def _resume_point(self, part_path, journal, rep_id):
+        """
+        Returns the index of the first fragment to fetch and the size of the partial file
+        it is appended to. The journal only records fragments once they are on disk, bytes
+        written after the last checkpoint are cut off
+        """
+        size = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        done = journal.done(rep_id) if journal else set()
+        start = 0
+        while start in done:
+            start += 1
+        recorded = journal.size(rep_id) if journal else None
+        if start == 0 or recorded is None or size < recorded:
+            # a partial file of yt-dlp can't be resumed, the fragment index it keeps runs
+            # ahead of the fragments in the file when it downloads several at a time
+            if size:
+                logger.info(f"> Starting {os.path.basename(part_path)} over")
+            open(part_path, "wb").close()
+            if journal:
+                journal.reset_track(rep_id)
+            return 0, 0
+        if size > recorded:
+            with open(part_path, "r+b") as f:
+                f.truncate(recorded)
+        logger.info(f"> Resuming {os.path.basename(part_path)} at fragment {start}")
+        return start, recorded
+
+    def _checkpoint(self, journal, rep_id, written, offset, ytdl_path):
+        if journal and written:
+            journal.mark_done(rep_id, *written, size=offset)
+        if written:
+            with open(ytdl_path, "w", encoding="utf-8") as f:
+                index = max(written) + 1
+                json.dump({"downloader": {"current_fragment": {"index": index}}}, f)
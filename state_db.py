@@ -0,0 +1,338 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from mp4parse import read_box_header
+
+logger = logging.getLogger("udemy-downloader")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    course_id INTEGER PRIMARY KEY,
+    title TEXT,
+    path TEXT,
+    status TEXT NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS lectures (
+    lecture_id INTEGER PRIMARY KEY,
+    course_id INTEGER,
+    title TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    lecture_id INTEGER,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    bytes INTEGER,
+    duration REAL,
+    checksum TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_lecture ON files (lecture_id);
+CREATE INDEX IF NOT EXISTS lectures_course ON lectures (course_id);
+"""
+
+# bytes hashed at each end of a file for the quick checksum
+CHECKSUM_CHUNK = 1024 * 1024
+
+
+def quick_checksum(path: str) -> str:
+    """
+    Hashes the size and the first and last MiB of a file, which is enough to tell a
+    finished download from a truncated or replaced one without reading it all
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(CHECKSUM_CHUNK))
+        if size > CHECKSUM_CHUNK:
+            f.seek(max(CHECKSUM_CHUNK, size - CHECKSUM_CHUNK))
+            digest.update(f.read(CHECKSUM_CHUNK))
+    return digest.hexdigest()
+
+
+def is_complete_mp4(path: str) -> bool:
+    """
+    Whether the top level boxes of an MP4 file have a moov and end exactly at the end of
+    the file. A download or mux that was cut short leaves a file whose last box runs past
+    the end of it
+    """
+    size = os.path.getsize(path)
+    box_types = set()
+    pos = 0
+    with open(path, "rb") as f:
+        while pos < size:
+            f.seek(pos)
+            header = f.read(16)
+            try:
+                # a box with a size of 0 runs to the end of the file
+                box = read_box_header(header, 0, size - pos)
+            except ValueError:
+                return False
+            box_types.add(box.box_type)
+            pos += box.header_size + box.box_size
+    return pos == size and "moov" in box_types
+
+
+# files that can be checked before they are adopted, other files only need to be non empty
+MP4_EXTENSIONS = (".mp4", ".m4a", ".m4v")
+
+
+class StateDB(object):
+    """
+    SQLite store of what has been downloaded, with rows for courses, lectures and every
+    output file (lecture, caption or asset).
+
+    A file only counts as downloaded once it was marked as done and still has the size and
+    checksum it was recorded with, so a file left behind by a crash halfway through a
+    download or a mux is no longer mistaken for a finished one. Rows are mirrored in memory
+    for constant time lookups; writes go through a connection per thread to a WAL journaled
+    database, so the lecture workers (and other processes sharing the download directory)
+    can write at the same time. Without a path nothing is written to disk and the rows
+    only live as long as the process.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # every connection opened by a thread, closed together at shutdown
+        self._connections = []
+        # courses started by this process, finished together once every download is done
+        self._running_courses = set()
+        # lecture id -> course id, for failed_lectures when there is no database
+        self._lecture_courses = {}
+        self._files = {}
+        if self.path is None:
+            return
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            self._files = {
+                row["path"]: dict(row) for row in conn.execute("SELECT * FROM files")
+            }
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # only used by the thread that opened it, but closed by close()
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+        Closes the connections of every thread, which also checkpoints the WAL journal
+        into the database. A later write opens a new connection
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"> Failed to close the state database: {e}")
+
+    def start_course(self, course_id: int, title: str, path: str, lectures: list):
+        now = time.time()
+        with self._lock:
+            self._running_courses.add(course_id)
+            self._lecture_courses.update(
+                (lecture.get("id"), course_id) for lecture in lectures
+            )
+        if self.path is None:
+            return
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO courses (course_id, title, path, status, started_at) VALUES (?, ?, ?, 'running', ?) "
+                "ON CONFLICT(course_id) DO UPDATE SET title=excluded.title, path=excluded.path, status='running', started_at=excluded.started_at, finished_at=NULL",
+                (course_id, title, path, now),
+            )
+            conn.executemany(
+                "INSERT INTO lectures (lecture_id, course_id, title, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(lecture_id) DO UPDATE SET course_id=excluded.course_id, title=excluded.title, updated_at=excluded.updated_at",
+                [
+                    (lecture.get("id"), course_id, lecture.get("lecture_title"), now)
+                    for lecture in lectures
+                ],
+            )
+
+    def finish_courses(self):
+        """
+        Marks the courses started by this process as done, or failed if any of their
+        files failed
+        """
+        with self._lock:
+            course_ids, self._running_courses = self._running_courses, set()
+        if self.path is None:
+            return
+        for course_id in course_ids:
+            failed = self.failed_lectures(course_id)
+            with self._connection() as conn:
+                conn.execute(
+                    "UPDATE courses SET status=?, finished_at=? WHERE course_id=?",
+                    ("failed" if failed else "done", time.time(), course_id),
+                )
+
+    def failed_lectures(self, course_id: int) -> set:
+        """
+        The ids of the lectures of a course with at least one failed file
+        """
+        if self.path is None:
+            with self._lock:
+                return {
+                    row["lecture_id"]
+                    for row in self._files.values()
+                    if row["status"] == "failed"
+                    and self._lecture_courses.get(row["lecture_id"]) == course_id
+                }
+        rows = self._connection().execute(
+            "SELECT DISTINCT files.lecture_id FROM files JOIN lectures USING (lecture_id) "
+            "WHERE lectures.course_id=? AND files.status='failed'",
+            (course_id,),
+        )
+        return {row["lecture_id"] for row in rows}
+
+    def _save(self, row: dict):
+        with self._lock:
+            self._files[row["path"]] = row
+        if self.path is None:
+            return
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, lecture_id, kind, status, bytes, duration, checksum, error, attempts, started_at, finished_at) "
+                "VALUES (:path, :lecture_id, :kind, :status, :bytes, :duration, :checksum, :error, :attempts, :started_at, :finished_at)",
+                row,
+            )
+
+    def get(self, path: str) -> Optional[dict]:
+        with self._lock:
+            row = self._files.get(path)
+        return dict(row) if row else None
+
+    def lecture_statuses(self, lecture_id, since: float) -> set:
+        """
+        The statuses of the files of a lecture whose download started after `since`
+        """
+        with self._lock:
+            return {
+                row["status"]
+                for row in self._files.values()
+                if row["lecture_id"] == lecture_id
+                and row["started_at"] is not None
+                and row["started_at"] >= since
+            }
+
+    def is_done(self, path: str, lecture_id=None, kind: str = "lecture") -> bool:
+        """
+        Whether a file was downloaded completely. Files that exist but were never
+        recorded (downloaded before the state database existed) are adopted as done if
+        they look complete. Nothing is removed: a file whose download was started but never
+        finished, or that changed since, is left in place until its new download replaces
+        it
+        """
+        row = self.get(path)
+        exists = os.path.isfile(path)
+        if row is None:
+            if not exists:
+                return False
+            if self._looks_complete(path):
+                self._save(self._new_row(path, lecture_id, kind))
+                self.finish(path)
+                return True
+            logger.info(
+                f"> {os.path.basename(path)} looks incomplete (not tracked), it will be downloaded again"
+            )
+            return False
+
+        if (
+            row["status"] == "done"
+            and exists
+            and os.path.getsize(path) == row["bytes"]
+            and row["checksum"] in (None, quick_checksum(path))
+        ):
+            return True
+        if exists:
+            state = row["status"] if row["status"] != "done" else "changed"
+            logger.info(
+                f"> {os.path.basename(path)} is incomplete ({state}), it will be downloaded again"
+            )
+        return False
+
+    @staticmethod
+    def _looks_complete(path: str) -> bool:
+        if os.path.getsize(path) == 0:
+            return False
+        if path.lower().endswith(MP4_EXTENSIONS):
+            try:
+                return is_complete_mp4(path)
+            except OSError:
+                return False
+        return True
+
+    def _new_row(self, path: str, lecture_id, kind: str) -> dict:
+        return {
+            "path": path,
+            "lecture_id": lecture_id,
+            "kind": kind,
+            "status": "pending",
+            "bytes": None,
+            "duration": None,
+            "checksum": None,
+            "error": None,
+            "attempts": 0,
+            "started_at": None,
+            "finished_at": None,
+        }
+
+    def start(self, path: str, lecture_id=None, kind: str = "lecture"):
+        row = self.get(path) or self._new_row(path, lecture_id, kind)
+        row.update(
+            lecture_id=lecture_id if lecture_id is not None else row["lecture_id"],
+            kind=kind,
+            status="running",
+            error=None,
+            attempts=row["attempts"] + 1,
+            started_at=time.time(),
+            finished_at=None,
+        )
+        self._save(row)
+
+    def finish(self, path: str):
+        row = self.get(path) or self._new_row(path, None, "lecture")
+        now = time.time()
+        row.update(
+            status="done",
+            bytes=os.path.getsize(path),
+            checksum=quick_checksum(path),
+            duration=now - row["started_at"] if row["started_at"] else None,
+            error=None,
+            finished_at=now,
+        )
+        self._save(row)
+
+    def fail(self, path: str, error: str):
+        row = self.get(path) or self._new_row(path, None, "lecture")
+        now = time.time()
+        row.update(
+            status="failed",
+            error=error,
+            duration=now - row["started_at"] if row["started_at"] else None,
+            finished_at=now,
+        )
+        self._save(row)
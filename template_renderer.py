@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger("udemy-downloader")
+
+# __title_placeholder__ style placeholders, and %%QUIZ_JSON%% style ones in the quiz template
+PLACEHOLDER_RE = re.compile(r"__(?P<name>[a-z_]+?)_placeholder__|%%(?P<NAME>[A-Z_]+)%%")
+
+
+class Template(object):
+    """
+    A template split once at its placeholders, so rendering it is a sequence of writes
+    instead of a `str.replace` pass over the whole document per placeholder.
+
+    Placeholders are named after their text in lower case: `__title_placeholder__` is
+    `title` and `%%QUIZ_JSON%%` is `quiz_json`.
+    """
+
+    def __init__(self, text: str):
+        # (literal text, name of the placeholder that follows it)
+        self.parts = []
+        pos = 0
+        for match in PLACEHOLDER_RE.finditer(text):
+            name = (match.group("name") or match.group("NAME")).lower()
+            self.parts.append((text[pos : match.start()], name))
+            pos = match.end()
+        self.tail = text[pos:]
+
+    @property
+    def placeholders(self) -> set:
+        return {name for _, name in self.parts}
+
+    def render_to(self, f, values: dict):
+        """
+        Writes the template to a text file object. String values are written as they
+        are, anything else is encoded as JSON
+        """
+        for literal, name in self.parts:
+            f.write(literal)
+            value = values[name]
+            # json.dumps runs on the C encoder, unlike json.dump which encodes piece by piece
+            f.write(value if isinstance(value, str) else json.dumps(value))
+        f.write(self.tail)
+
+
+class TemplateSet(object):
+    """
+    The HTML templates of a directory, loaded and split once at startup and rendered
+    straight into the output files
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._templates = {}
+        for name in os.listdir(directory):
+            stem, ext = os.path.splitext(name)
+            if ext == ".html":
+                with open(os.path.join(directory, name), encoding="utf-8") as f:
+                    self._templates[stem] = Template(f.read())
+        logger.debug(f"Loaded {len(self._templates)} HTML template(s)")
+
+    def get(self, name: str) -> Template:
+        return self._templates[name]
+
+    def render(self, name: str, path: str, **values):
+        """
+        Renders a template to a file, through a temporary file so an error halfway
+        doesn't leave a truncated page behind
+        """
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                self.get(name).render_to(f, values)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def pytest_configure(config):
+    # main and constants put logs/ and saved/ in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="udemy-downloader-tests-"))
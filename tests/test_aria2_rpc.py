@@ -0,0 +1,94 @@
+import json
+import os
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from aria2_rpc import Aria2RPC, Aria2RPCError
+
+
+class FakeAria2(BaseHTTPRequestHandler):
+    """Answers aria2 JSON-RPC calls like the daemon does"""
+
+    statuses = []
+    calls = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        token, *params = request["params"]
+        self.calls.append((request["method"], params))
+        if token != f"token:{self.server.secret}":
+            self._reply(400, {"error": {"code": 1, "message": "Unauthorized"}})
+        elif request["method"] == "aria2.getVersion":
+            self._reply(200, {"result": {"version": "1.37.0"}})
+        elif request["method"] == "aria2.addUri":
+            self._reply(200, {"result": "0123456789abcdef"})
+        elif request["method"] == "aria2.tellStatus":
+            self._reply(200, {"result": self.statuses.pop(0)})
+        else:
+            self._reply(400, {"error": {"code": 1, "message": "No such method"}})
+
+    def _reply(self, code, body):
+        data = json.dumps({"jsonrpc": "2.0", "id": 1, **body}).encode()
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def rpc():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAria2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Aria2RPC()
+    server.secret = client._secret
+    client.port = server.server_address[1]
+    FakeAria2.calls.clear()
+    yield client
+    server.shutdown()
+
+
+def test_calls_skip_the_proxy(rpc, monkeypatch):
+    # a proxy that doesn't exist, the call only works if it goes straight to aria2c
+    monkeypatch.setenv("HTTP_PROXY", "http://127.0.0.1:9")
+    monkeypatch.setenv("http_proxy", "http://127.0.0.1:9")
+    assert rpc.call("getVersion") == {"version": "1.37.0"}
+
+
+def test_rpc_errors_are_raised(rpc):
+    with pytest.raises(Aria2RPCError, match="No such method"):
+        rpc.call("nope")
+
+
+def test_download_waits_for_completion(rpc):
+    FakeAria2.statuses = [{"status": "active"}, {"status": "complete"}]
+    status = rpc.download("http://example.com/a.pdf", "/tmp", "a.pdf", {"split": 4})
+    assert status["status"] == "complete"
+    method, params = FakeAria2.calls[0]
+    assert method == "aria2.addUri"
+    assert params == [
+        ["http://example.com/a.pdf"],
+        {"dir": "/tmp", "out": "a.pdf", "split": "4"},
+    ]
+
+
+def test_failed_download_raises(rpc):
+    FakeAria2.statuses = [
+        {"status": "error", "errorCode": "3", "errorMessage": "Not found"}
+    ]
+    with pytest.raises(Aria2RPCError, match="Not found"):
+        rpc.download("http://example.com/a.pdf", "/tmp", "a.pdf")
+
+
+def test_start_fails_when_aria2c_exits(tmp_path, monkeypatch):
+    fake = tmp_path / "aria2c"
+    fake.write_text("#!/bin/sh\nexit 1\n")
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    with pytest.raises(Aria2RPCError, match="exited with code 1"):
+        Aria2RPC().start(timeout=5)
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from asset_store import AssetStore
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AssetStore(str(tmp_path / "store"))
+
+
+def test_copies_are_independent(store, tmp_path):
+    first = write(tmp_path / "001 slides.pdf", b"slides")
+    store.add(7, first)
+    second = str(tmp_path / "014 slides.pdf")
+    assert store.materialize(7, second)
+
+    for path in (first, second):
+        assert os.stat(path).st_nlink == 1
+    with open(first, "ab") as f:
+        f.write(b" with notes")
+    assert read(second) == b"slides"
+
+    third = str(tmp_path / "020 slides.pdf")
+    assert store.materialize(7, third)
+    assert read(third) == b"slides"
+    assert store.reused == 2
+
+
+def test_changed_objects_are_not_reused(store, tmp_path):
+    store.add(7, write(tmp_path / "001 slides.pdf", b"slides"))
+    (obj,) = store.objects.glob("*/*")
+    write(obj, b"edited")
+
+    path = str(tmp_path / "014 slides.pdf")
+    assert not store.materialize(7, path)
+    assert not os.path.exists(path)
+    assert not obj.exists()
+
+
+def test_prune_detaches_hard_linked_objects(store, tmp_path):
+    path = write(tmp_path / "001 slides.pdf", b"slides")
+    store.add(7, path)
+    (obj,) = store.objects.glob("*/*")
+    # how older versions stored a download
+    os.remove(obj)
+    os.link(path, obj)
+    write(obj.with_name("0" * 64), b"no asset maps to this")
+
+    store.prune()
+    assert [p.name for p in store.objects.glob("*/*")] == [obj.name]
+    assert os.stat(path).st_nlink == 1
+    with open(path, "ab") as f:
+        f.write(b" with notes")
+    assert store.materialize(7, str(tmp_path / "014 slides.pdf"))
+    assert read(tmp_path / "014 slides.pdf") == b"slides"
@@ -0,0 +1,156 @@
+import json
+import os
+
+import pytest
+
+import main
+from course_sync import CourseSync
+from state_db import StateDB
+
+OPTIONS = {"quality": None}
+
+
+def item(lecture_id, number, title, signature="v1", chapter="01 Chapter"):
+    prefix = f"{number:03d} {title}"
+    return {
+        "id": f"lecture:{lecture_id}",
+        "signature": [signature],
+        "dir": chapter,
+        "prefixes": [prefix],
+        "asset_prefix": f"{number:03d} ",
+    }
+
+
+def write(course_dir, *names):
+    for name in names:
+        path = os.path.join(course_dir, "01 Chapter", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(name)
+
+
+def files(course_dir):
+    return sorted(os.listdir(os.path.join(course_dir, "01 Chapter")))
+
+
+def snapshot(course_dir):
+    with open(os.path.join(course_dir, CourseSync.SNAPSHOT_FILE)) as f:
+        return json.load(f)["lectures"]
+
+
+def synced(course_dir, items):
+    sync = CourseSync(course_dir, OPTIONS)
+    skip = sync.plan(items)
+    for entry in items:
+        sync.complete(entry["id"])
+    return skip
+
+
+@pytest.fixture
+def course_dir(tmp_path):
+    return str(tmp_path)
+
+
+def test_renumbered_lecture_takes_its_assets_along(course_dir):
+    write(course_dir, "001 Intro.mp4", "001 Intro_en.srt", "001 slides.pdf")
+    write(course_dir, "002 Setup.mp4", "002 code.zip")
+    synced(course_dir, [item(1, 1, "Intro"), item(2, 2, "Setup")])
+
+    # a lecture was inserted before them
+    sync = CourseSync(course_dir, OPTIONS)
+    skip = sync.plan([item(3, 1, "New"), item(1, 2, "Intro"), item(2, 3, "Setup")])
+
+    assert files(course_dir) == [
+        "002 Intro.mp4",
+        "002 Intro_en.srt",
+        "002 slides.pdf",
+        "003 Setup.mp4",
+        "003 code.zip",
+    ]
+    assert skip == {"lecture:1", "lecture:2"}
+
+
+def test_changed_lecture_is_replaced_once_it_completes(course_dir):
+    write(course_dir, "001 Intro.mp4", "001 slides.pdf")
+    synced(course_dir, [item(1, 1, "Intro")])
+
+    sync = CourseSync(course_dir, OPTIONS)
+    assert sync.plan([item(1, 1, "Intro", signature="v2")]) == set()
+    # moved aside, and the snapshot still describes the old version
+    assert files(course_dir) == []
+    assert snapshot(course_dir)["lecture:1"]["signature"] == ["v1"]
+
+    write(course_dir, "001 Intro.mp4")
+    sync.complete("lecture:1")
+    assert files(course_dir) == ["001 Intro.mp4"]
+    assert not os.path.exists(os.path.join(course_dir, CourseSync.SUPERSEDED_DIR))
+    assert snapshot(course_dir)["lecture:1"]["signature"] == ["v2"]
+
+
+def test_failed_replacement_puts_the_old_version_back(course_dir):
+    write(course_dir, "001 Intro.mp4", "001 slides.pdf")
+    synced(course_dir, [item(1, 1, "Intro")])
+
+    sync = CourseSync(course_dir, OPTIONS)
+    sync.plan([item(1, 1, "Intro", signature="v2")])
+    write(course_dir, "001 Intro.mp4.part")
+    sync.abandon("lecture:1")
+
+    assert "001 Intro.mp4" in files(course_dir)
+    assert "001 slides.pdf" in files(course_dir)
+    assert snapshot(course_dir)["lecture:1"]["signature"] == ["v1"]
+
+
+def test_interrupted_run_is_picked_up_again(course_dir):
+    write(course_dir, "001 Intro.mp4")
+    synced(course_dir, [item(1, 1, "Intro")])
+
+    # the run stops before the changed and the new lecture complete
+    CourseSync(course_dir, OPTIONS).plan(
+        [item(1, 1, "Intro", signature="v2"), item(2, 2, "Setup")]
+    )
+    assert "lecture:2" not in snapshot(course_dir)
+
+    sync = CourseSync(course_dir, OPTIONS)
+    assert (
+        sync.plan([item(1, 1, "Intro", signature="v2"), item(2, 2, "Setup")]) == set()
+    )
+    assert os.listdir(
+        os.path.join(course_dir, CourseSync.SUPERSEDED_DIR, "lecture-1", "01 Chapter")
+    ) == ["001 Intro.mp4"]
+
+
+def test_changed_options_are_kept_per_lecture(course_dir):
+    write(course_dir, "001 Intro.mp4", "002 Setup.mp4")
+    synced(course_dir, [item(1, 1, "Intro"), item(2, 2, "Setup")])
+
+    sync = CourseSync(course_dir, {"quality": 720})
+    items = [item(1, 1, "Intro"), item(2, 2, "Setup")]
+    assert sync.plan(items) == set()
+    sync.complete("lecture:1")
+
+    # only the lecture that was downloaded with the new options is up to date
+    assert CourseSync(course_dir, {"quality": 720}).plan(items) == {"lecture:1"}
+
+
+def test_pipeline_lectures_settle_when_their_job_is_done(
+    course_dir, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(main, "state_db", StateDB(str(tmp_path / "state.db")))
+    write(course_dir, "001 Intro.mp4")
+    synced(course_dir, [item(1, 1, "Intro")])
+    sync = CourseSync(course_dir, OPTIONS)
+    sync.plan([item(1, 1, "Intro", signature="v2")])
+
+    lectures = main.SyncedLectures()
+    lectures.track(sync, {"_class": "lecture", "id": 1})
+    path = os.path.join(course_dir, "01 Chapter", "001 Intro.mp4")
+    main.state_db.start(path, 1)
+    lectures.settle("lecture:1", processed=True)
+    # still muxing
+    assert snapshot(course_dir)["lecture:1"]["signature"] == ["v1"]
+
+    write(course_dir, "001 Intro.mp4")
+    main.state_db.finish(path)
+    lectures.settle("lecture:1")
+    assert snapshot(course_dir)["lecture:1"]["signature"] == ["v2"]
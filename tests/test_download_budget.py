@@ -0,0 +1,63 @@
+import threading
+import time
+
+from download_budget import DownloadBudget, parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate("500K") == 500 * 1024
+    assert parse_rate("1.5M") == int(1.5 * 1024**2)
+
+
+def test_a_download_running_alone_gets_the_whole_limit():
+    budget = DownloadBudget(max_rate=1000)
+    with budget.lease(10) as lease:
+        assert lease.rate == 1000
+
+
+def test_the_limit_is_divided_among_the_running_leases():
+    budget = DownloadBudget(max_rate=1000)
+    with budget.lease(10) as first:
+        with budget.lease(20) as second:
+            assert first.rate == 1000
+            assert second.rate == 1000 * 20 // 30
+        with budget.lease(10) as third:
+            assert third.rate == 500
+    with budget.lease(4) as alone:
+        assert alone.rate == 1000
+
+
+def test_in_process_downloads_share_one_limiter():
+    budget = DownloadBudget(max_rate=200 * 1024)
+    with budget.lease(4) as first, budget.lease(4) as second:
+        assert first.limiter is second.limiter is budget.limiter
+
+    def consume():
+        for _ in range(5):
+            budget.limiter.consume(10 * 1024)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 200 KiB through a 200 KiB/s limiter, whichever thread asks for it
+    assert time.monotonic() - started >= 0.9
+
+
+def test_connections_block_until_released():
+    budget = DownloadBudget(max_connections=4)
+    lease = budget.acquire(4)
+    acquired = threading.Event()
+
+    def wait():
+        with budget.lease(2):
+            acquired.set()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(lease)
+    assert acquired.wait(1)
+    thread.join()
@@ -0,0 +1,59 @@
+import struct
+
+import pytest
+
+import mp4parse
+import widevine_pssh_data_pb2
+from utils import extract_kid
+
+KID = "0123456789abcdef0123456789abcdef"
+PLAYREADY_SYSTEM_ID = "9a04f07998404286ab92e65be0885f95"
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def pssh(system_id, data):
+    payload = bytes(4) + bytes.fromhex(system_id) + struct.pack(">I", len(data)) + data
+    return box(b"pssh", payload)
+
+
+def widevine_pssh(kid=KID):
+    data = widevine_pssh_data_pb2.WidevinePsshData()
+    data.key_id.append(bytes.fromhex(kid))
+    return pssh(mp4parse.WIDEVINE_SYSTEM_ID, data.SerializeToString())
+
+
+def track(path, *psshs):
+    moov = box(b"moov", box(b"mvhd", bytes(100)) + b"".join(psshs))
+    path.write_bytes(
+        box(b"ftyp", b"isom" + bytes(4)) + moov + box(b"mdat", bytes(4096))
+    )
+    return str(path)
+
+
+def test_kid_of_the_widevine_pssh(tmp_path):
+    path = track(tmp_path / "video.mp4", widevine_pssh())
+    assert extract_kid(path) == KID
+
+
+def test_other_systems_are_skipped(tmp_path):
+    path = track(
+        tmp_path / "video.mp4", pssh(PLAYREADY_SYSTEM_ID, b"playready"), widevine_pssh()
+    )
+    assert extract_kid(path) == KID
+
+
+@pytest.mark.parametrize(
+    "psshs", [(), (pssh(PLAYREADY_SYSTEM_ID, b"playready"),)], ids=["none", "playready"]
+)
+def test_no_widevine_pssh(tmp_path, psshs):
+    # None, like the original extraction gave for a moov without pssh boxes (it raised
+    # StopIteration when they were all of other systems)
+    assert extract_kid(track(tmp_path / "video.mp4", *psshs)) is None
+
+
+def test_missing_file(tmp_path):
+    with pytest.raises(Exception, match="File does not exist"):
+        extract_kid(str(tmp_path / "missing.mp4"))
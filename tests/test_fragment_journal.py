@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from fragment_journal import JOURNAL_FILE, FragmentJournal, _from_ranges, _to_ranges
+
+
+@pytest.mark.parametrize(
+    "indexes, ranges",
+    [
+        ([], []),
+        ([0], [[0, 1]]),
+        ([5, 0, 1, 2, 7, 6, 9], [[0, 3], [5, 8], [9, 10]]),
+        (range(1000), [[0, 1000]]),
+    ],
+)
+def test_ranges_round_trip(indexes, ranges):
+    assert _to_ranges(indexes) == ranges
+    assert _from_ranges(ranges) == set(indexes)
+
+
+def test_fragments_are_kept_across_runs(tmp_path):
+    journal = FragmentJournal(str(tmp_path), "video,audio")
+    assert not journal.matches
+    journal.reset()
+    journal.set_total("video", 10)
+    journal.mark_done("video", 0, 1, 2, 5, size=4000)
+    journal.mark_done("audio", 0)
+    journal.save()
+
+    reopened = FragmentJournal(str(tmp_path), "video,audio")
+    assert reopened.matches
+    assert reopened.done("video") == {0, 1, 2, 5}
+    assert reopened.missing("video") == [3, 4, 6, 7, 8, 9]
+    assert reopened.size("video") == 4000
+    # the number of audio fragments isn't known yet
+    assert reopened.missing("audio") is None
+    assert reopened.missing("audio", total=3) == [1, 2]
+
+
+def test_size_is_kept_when_a_call_has_none(tmp_path):
+    journal = FragmentJournal(str(tmp_path), "video,audio")
+    journal.mark_done("video", 0, 1, size=2048)
+    journal.mark_done("video", 2)
+    assert journal.size("video") == 2048
+    journal.mark_done("video", 3, size=4096)
+    assert journal.size("video") == 4096
+
+
+def test_complete_tracks_have_nothing_missing(tmp_path):
+    journal = FragmentJournal(str(tmp_path), "video,audio")
+    journal.set_total("video", 3)
+    journal.mark_done("video", 0, 1)
+    assert not journal.is_complete("video")
+    journal.mark_done("video", 2)
+    assert journal.is_complete("video")
+    assert journal.missing("video") == []
+
+    journal.mark_complete("audio")
+    assert journal.missing("audio") == []
+
+
+def test_another_format_starts_over(tmp_path):
+    journal = FragmentJournal(str(tmp_path), "video-720,audio")
+    journal.mark_done("video-720", 0, 1, size=100)
+    journal.save()
+
+    other = FragmentJournal(str(tmp_path), "video-1080,audio")
+    assert not other.matches
+    assert other.done("video-720") == set()
+    other.reset()
+    with open(tmp_path / JOURNAL_FILE) as f:
+        assert json.load(f) == {"format_id": "video-1080,audio", "tracks": {}}
+
+
+def test_unreadable_journal_is_ignored(tmp_path):
+    (tmp_path / JOURNAL_FILE).write_text("{not json")
+    journal = FragmentJournal(str(tmp_path), "video,audio")
+    assert not journal.matches
+    assert journal.describe() == "nothing downloaded yet"
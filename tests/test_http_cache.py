@@ -0,0 +1,66 @@
+import pytest
+
+import main
+from http_cache import HttpCache
+
+URL = "https://www.udemy.com/api-2.0/courses/1234/"
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, text):
+        self.text = text
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = HttpCache(str(tmp_path / "http_cache"))
+    monkeypatch.setattr(main, "http_cache", cache)
+    return cache
+
+
+def logged_in(token=None, cookie=None):
+    """
+    A session authenticated like Udemy.authenticate does, which drops the Authorization
+    header, whose requests answer with the token they were made with
+    """
+    if token:
+        session = main.UdemyAuth().authenticate(bearer_token=token)
+    else:
+        session = main.Session()
+        session._session.cookies.set("access_token", cookie, domain="www.udemy.com")
+    del session._session.headers["authorization"]
+    session.requests = []
+
+    def get(url, **kwargs):
+        session.requests.append(url)
+        return FakeResponse(token or cookie)
+
+    session._thread_session = lambda: type("Fake", (), {"get": staticmethod(get)})
+    return session
+
+
+def test_tokens_do_not_share_entries(cache):
+    first, second = logged_in("token-a"), logged_in("token-b")
+    assert first._get(URL).text == "token-a"
+    assert second._get(URL).text == "token-b"
+    assert first._get(URL).text == "token-a"
+    assert second._get(URL).text == "token-b"
+    assert len(first.requests) == len(second.requests) == 1
+    assert cache.hits == 2
+
+
+def test_cookie_logins_do_not_share_entries(cache):
+    first, second = logged_in(cookie="cookie-a"), logged_in(cookie="cookie-b")
+    assert first._get(URL).text == "cookie-a"
+    assert second._get(URL).text == "cookie-b"
+    assert first._get(URL).text == "cookie-a"
+    assert len(first.requests) == len(second.requests) == 1
+
+
+def test_identity_is_not_the_token(cache):
+    identity = logged_in("token-a")._cache_identity()
+    assert identity and "token-a" not in identity
+    assert logged_in(cookie="token-a")._cache_identity() != ""
@@ -0,0 +1,51 @@
+import logging
+import random
+import time
+
+import pytest
+
+import main
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def log():
+    logger = logging.getLogger("udemy-downloader")
+    handler = ListHandler()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    logger.addFilter(main.log_buffer)
+    main.logger = logger
+    yield handler.messages
+    logger.removeHandler(handler)
+    logger.removeFilter(main.log_buffer)
+
+
+def lecture(name):
+    time.sleep(random.uniform(0, 0.02))
+    main.logger.info(f"lecture {name}")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_output_reads_like_a_sequential_run(log, workers):
+    scheduler = main.LectureScheduler(workers)
+    for chapter in range(3):
+        scheduler.log(f"chapter {chapter}")
+        for i in range(5):
+            scheduler.submit(f"{chapter}.{i}", lecture, f"{chapter}.{i}")
+    scheduler.join()
+
+    ordered = [m for m in log if m.startswith(("chapter", "lecture"))]
+    expected = []
+    for chapter in range(3):
+        expected.append(f"chapter {chapter}")
+        expected.extend(f"lecture {chapter}.{i}" for i in range(5))
+    assert ordered == expected
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+import main
+
+
+class FakeUdemy(object):
+    def __init__(self):
+        self.parsed = []
+        self._lock = threading.Lock()
+
+    def _parse_lecture(self, lecture):
+        with self._lock:
+            self.parsed.append(lecture["id"])
+        return {"id": lecture["id"]}
+
+
+def lectures(count):
+    return [{"_class": "lecture", "id": i} for i in range(count)]
+
+
+@pytest.fixture
+def udemy():
+    return FakeUdemy()
+
+
+def test_lectures_are_parsed_at_most_lookahead_ahead(udemy):
+    course = lectures(8)
+    prefetcher = main.ManifestPrefetcher(udemy, course, lookahead=2)
+    try:
+        for i, lecture in enumerate(course):
+            assert prefetcher.get(lecture) == {"id": i}
+            assert max(udemy.parsed) <= i + 2
+        assert sorted(udemy.parsed) == list(range(8))
+    finally:
+        prefetcher.shutdown()
+
+
+def test_quizzes_are_not_prefetched(udemy):
+    course = lectures(3)
+    quiz = {"_class": "quiz", "id": 100}
+    prefetcher = main.ManifestPrefetcher(udemy, course[:1] + [quiz] + course[1:], 1)
+    try:
+        assert prefetcher.get(course[0]) == {"id": 0}
+        assert prefetcher.get(course[1]) == {"id": 1}
+        assert 100 not in udemy.parsed
+        assert prefetcher.get(quiz) == {"id": 100}
+    finally:
+        prefetcher.shutdown()
+
+
+def test_a_lecture_can_be_looked_up_twice(udemy):
+    course = lectures(3)
+    prefetcher = main.ManifestPrefetcher(udemy, course, lookahead=1)
+    try:
+        assert prefetcher.get(course[0]) == {"id": 0}
+        assert prefetcher.get(course[0]) == {"id": 0}
+        assert udemy.parsed.count(0) == 2
+        assert prefetcher.get(course[1]) == {"id": 1}
+    finally:
+        prefetcher.shutdown()
@@ -0,0 +1,124 @@
+import logging
+
+import pytest
+
+import main
+from manifest_cache import ManifestCache
+from state_db import StateDB
+
+
+def drm_lecture(lecture_id, title):
+    return {
+        "id": lecture_id,
+        "lecture_title": title,
+        "data": {
+            "asset": {
+                "id": lecture_id * 10,
+                "stream_urls": None,
+                "media_sources": [
+                    {
+                        "type": "application/dash+xml",
+                        "src": f"https://example.com/{lecture_id}.mpd",
+                    }
+                ],
+            }
+        },
+    }
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch):
+    # set up by pre_run in a real run
+    monkeypatch.setattr(main, "logger", logging.getLogger("udemy-downloader"))
+
+
+class FakeUdemy(object):
+    def __init__(self):
+        self.fetched = []
+
+    def _extract_mpd_kids(self, url, asset_id):
+        self.fetched.append(url)
+        return {"video": "0" * 32}
+
+
+def test_downloaded_lectures_are_not_checked(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "state_db", StateDB(str(tmp_path / "state.db")))
+    monkeypatch.setattr(main, "keys", {})
+    chapter_dir = str(tmp_path / "01 Chapter")
+    done_path = main._lecture_path(chapter_dir, "Intro", "mp4")
+    (tmp_path / "01 Chapter").mkdir()
+    with open(done_path, "wb") as f:
+        f.write(b"muxed")
+    main.state_db.start(done_path, 1)
+    main.state_db.finish(done_path)
+
+    udemy = FakeUdemy()
+    main.report_missing_keys(
+        udemy,
+        [
+            (drm_lecture(1, "Intro"), chapter_dir),
+            (drm_lecture(2, "Setup"), chapter_dir),
+        ],
+    )
+    assert udemy.fetched == ["https://example.com/2.mpd"]
+
+
+MPD = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" type="static" mediaPresentationDuration="PT8S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+<Period>
+<AdaptationSet mimeType="video/mp4" contentType="video">
+<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="11111111-2222-3333-4444-555555555555"/>
+<Representation id="video-720" bandwidth="2000000" width="1280" height="720" codecs="avc1.4d401f"/>
+</AdaptationSet>
+<AdaptationSet mimeType="audio/mp4" contentType="audio">
+<Representation id="audio" bandwidth="128000" codecs="mp4a.40.2"/>
+</AdaptationSet>
+</Period>
+</MPD>
+"""
+
+
+class ManifestSession(object):
+    def __init__(self):
+        self.fetched = []
+
+    def _get(self, url):
+        self.fetched.append(url)
+        return type("Response", (), {"text": MPD, "raise_for_status": lambda r: None})()
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_key_check_and_sources_share_one_fetch(cached, tmp_path, monkeypatch):
+    cache = ManifestCache(str(tmp_path / "manifests")) if cached else None
+    monkeypatch.setattr(main, "manifest_cache", cache)
+    udemy = main.Udemy("token")
+    udemy.session = ManifestSession()
+    url = "https://example.com/1.mpd"
+
+    kids = udemy._extract_mpd_kids(url, 10)
+    assert kids == {"video-720": "11111111222233334444555555555555"}
+    sources = udemy._extract_mpd(url, 10)
+    assert [s["format_id"] for s in sources] == ["video-720,audio"]
+    assert sources[0]["kids"] == ["11111111222233334444555555555555"]
+    assert udemy.session.fetched == [url]
+
+
+def test_key_check_leaves_changed_lectures_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "state_db", StateDB(str(tmp_path / "state.db")))
+    monkeypatch.setattr(main, "keys", {})
+    chapter_dir = str(tmp_path / "01 Chapter")
+    (tmp_path / "01 Chapter").mkdir()
+    path = main._lecture_path(chapter_dir, "Intro", "mp4")
+    with open(path, "wb") as f:
+        f.write(b"muxed")
+    main.state_db.start(path, 1)
+    main.state_db.finish(path)
+    # re-encoded by the user since
+    with open(path, "wb") as f:
+        f.write(b"x265!")
+
+    udemy = FakeUdemy()
+    main.report_missing_keys(udemy, [(drm_lecture(1, "Intro"), chapter_dir)])
+    assert udemy.fetched == ["https://example.com/1.mpd"]
+    with open(path, "rb") as f:
+        assert f.read() == b"x265!"
@@ -0,0 +1,206 @@
+import struct
+
+import mp4parse
+from mp4parse import BoxReader, F4VParser
+
+WIDEVINE = bytes.fromhex(mp4parse.WIDEVINE_SYSTEM_ID)
+KID = bytes.fromhex("0123456789abcdef0123456789abcdef")
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def large_box(box_type, payload=b""):
+    # size 1, the real size follows the type as 64 bits
+    return struct.pack(">I4sQ", 1, box_type, 16 + len(payload)) + payload
+
+
+def full_box(box_type, version, payload, flags=0):
+    return box(box_type, struct.pack(">I", version << 24 | flags) + payload)
+
+
+def pssh(system_id=WIDEVINE, data=b"widevine data", kids=None):
+    if kids is None:
+        return full_box(b"pssh", 0, system_id + struct.pack(">I", len(data)) + data)
+    return full_box(
+        b"pssh",
+        1,
+        system_id
+        + struct.pack(">I", len(kids))
+        + b"".join(kids)
+        + struct.pack(">I", len(data))
+        + data,
+    )
+
+
+def tenc(kid=KID, iv_size=8):
+    return full_box(b"tenc", 0, bytes([0, 0, 1, iv_size]) + kid)
+
+
+def init_segment(*moov_children):
+    sinf = box(b"sinf", box(b"frma", b"avc1") + box(b"schi", tenc()))
+    encv = box(b"encv", bytes(78) + sinf)
+    stsd = full_box(b"stsd", 0, struct.pack(">I", 1) + encv)
+    trak = box(
+        b"trak", box(b"mdia", box(b"minf", box(b"stbl", stsd + box(b"stts", bytes(8)))))
+    )
+    return box(b"ftyp", b"isom" + bytes(4)) + box(
+        b"moov", box(b"mvhd", bytes(100)) + trak + b"".join(moov_children)
+    )
+
+
+def moof(sequence):
+    return box(b"moof", full_box(b"mfhd", 0, struct.pack(">I", sequence)))
+
+
+def types(reader):
+    return [b.type for b in reader]
+
+
+def test_nested_offsets_point_into_the_file():
+    data = init_segment()
+    with BoxReader(bytes_input=data) as reader:
+        (found,) = reader.find("moov/trak/mdia/minf/stbl/stsd/*/sinf/schi/tenc")
+        assert found.offset == data.index(b"tenc") - 4
+        assert found.size == 32
+        assert found.decode().default_kid == KID.hex()
+        (entry,) = reader.find("moov/trak/mdia/minf/stbl/stsd/*")
+        assert entry.type == "encv"
+        assert entry.offset == data.index(b"encv") - 4
+        assert types(entry) == ["sinf"]
+
+
+def test_offset_bytes_are_added_to_the_offsets():
+    data = b"junk" + init_segment()
+    with BoxReader(bytes_input=data, offset_bytes=4) as reader:
+        assert [(b.type, b.offset) for b in reader] == [
+            ("ftyp", 4),
+            ("moov", 4 + 16),
+        ]
+
+
+def test_largesize_and_to_the_end_boxes():
+    data = (
+        box(b"ftyp", bytes(8))
+        + large_box(b"mdat", b"x" * 100)
+        + box(b"free", bytes(4))
+        + struct.pack(">I4s", 0, b"mdat")
+        + b"y" * 50
+    )
+    with BoxReader(bytes_input=data) as reader:
+        boxes = list(reader)
+        assert types(boxes) == ["ftyp", "mdat", "free", "mdat"]
+        assert boxes[1].header.header_size == 16
+        assert bytes(boxes[1].data) == b"x" * 100
+        assert boxes[2].offset == 16 + 116
+        assert boxes[3].size == 58
+        assert bytes(boxes[3].data) == b"y" * 50
+
+
+def test_headers_only_lands_on_the_next_sibling():
+    data = (
+        init_segment()
+        + large_box(b"mdat", bytes(300))
+        + moof(1)
+        + box(b"mdat", bytes(200))
+        + moof(2)
+    )
+    headers = list(F4VParser.parse(bytes_input=data, headers_only=True))
+    assert [h.box_type for h in headers] == [
+        "ftyp",
+        "moov",
+        "mdat",
+        "moof",
+        "mdat",
+        "moof",
+    ]
+    assert sum(h.header_size + h.box_size for h in headers) == len(data)
+    assert headers[2].header_size == 16 and headers[2].box_size == 300
+
+
+def test_parse_shim_decodes_moov_and_moof():
+    data = (
+        init_segment(pssh(), pssh(system_id=bytes(16)))
+        + moof(7)
+        + box(b"mdat", b"media")
+    )
+    ftyp, moov, fragment, mdat = F4VParser.parse(bytes_input=data)
+    assert ftyp.header.box_type == "ftyp"
+    assert [p.system_id for p in moov.pssh] == [mp4parse.WIDEVINE_SYSTEM_ID, "00" * 16]
+    assert moov.header.box_size == len(init_segment(pssh(), pssh(bytes(16)))) - 24
+    assert fragment.mfhd.sequence_number == 7
+    assert bytes(mdat.payload) == b"media"
+
+
+def test_find_pssh_stops_at_the_widevine_box(tmp_path):
+    path = tmp_path / "track.mp4"
+    path.write_bytes(
+        init_segment(pssh(system_id=bytes(16)), pssh(data=b"payload"))
+        + box(b"mdat", bytes(64))
+    )
+    found = F4VParser.find_pssh(str(path))
+    assert found.system_id == mp4parse.WIDEVINE_SYSTEM_ID
+    assert found.payload == b"payload".hex()
+    assert F4VParser.find_pssh(str(path), system_id="11" * 16) is None
+
+
+def decoded(data):
+    with BoxReader(bytes_input=data) as reader:
+        (only,) = reader
+        return only.decode()
+
+
+def test_decode_pssh():
+    v0 = decoded(pssh(data=b"abc"))
+    assert (v0.version, v0.system_id, v0.key_ids, v0.payload) == (
+        0,
+        mp4parse.WIDEVINE_SYSTEM_ID,
+        [],
+        b"abc".hex(),
+    )
+    v1 = decoded(pssh(data=b"abc", kids=[KID, bytes(16)]))
+    assert v1.version == 1
+    assert v1.key_ids == [KID.hex(), "00" * 16]
+    assert v1.payload == b"abc".hex()
+    assert decoded(full_box(b"pssh", 0, bytes(10))) is None
+
+
+def test_decode_tenc():
+    v0 = decoded(tenc(iv_size=16))
+    assert (v0.default_is_protected, v0.default_per_sample_iv_size) == (1, 16)
+    assert v0.default_kid == KID.hex()
+    assert v0.default_constant_iv is None
+
+    # cbcs: pattern encryption and a constant iv
+    iv = bytes(range(16))
+    v1 = decoded(full_box(b"tenc", 1, bytes([0, 0x19, 1, 0]) + KID + bytes([16]) + iv))
+    assert (v1.default_crypt_byte_block, v1.default_skip_byte_block) == (1, 9)
+    assert v1.default_constant_iv == iv.hex()
+
+
+def test_decode_sidx():
+    reference = struct.pack(">III", 1 << 31 | 1000, 6000, 1 << 31 | 1 << 28 | 5)
+    v0 = decoded(
+        full_box(
+            b"sidx", 0, struct.pack(">IIIIHH", 1, 1000, 42, 64, 0, 2) + reference * 2
+        )
+    )
+    assert (v0.reference_id, v0.timescale) == (1, 1000)
+    assert (v0.earliest_presentation_time, v0.first_offset) == (42, 64)
+    assert len(v0.references) == 2
+    ref = v0.references[0]
+    assert (ref.reference_type, ref.referenced_size, ref.subsegment_duration) == (
+        1,
+        1000,
+        6000,
+    )
+    assert (ref.starts_with_sap, ref.sap_type, ref.sap_delta_time) == (1, 1, 5)
+
+    v1 = decoded(
+        full_box(
+            b"sidx", 1, struct.pack(">IIQQHH", 1, 1000, 2**40, 2**33, 0, 1) + reference
+        )
+    )
+    assert (v1.earliest_presentation_time, v1.first_offset) == (2**40, 2**33)
+    assert len(v1.references) == 1
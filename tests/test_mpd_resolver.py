@@ -0,0 +1,109 @@
+import functools
+import logging
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import main
+
+# two audio tracks, the higher bitrate one first
+MPD = """<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" type="static" mediaPresentationDuration="PT60S" minBufferTime="PT10S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+<Period id="1" start="PT0S">
+<AdaptationSet contentType="audio" lang="en" mimeType="audio/mp4" codecs="mp4a.40.2">
+<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="aaaaaaaa-0000-0000-0000-000000000001"/>
+<SegmentTemplate timescale="1000" initialization="a-$RepresentationID$.dash" media="a-$RepresentationID$-$Number$.dash" startNumber="1" duration="6000"/>
+<Representation id="audio_eng=128000" bandwidth="128000"/>
+<Representation id="audio_eng=64000" bandwidth="64000"/>
+</AdaptationSet>
+<AdaptationSet contentType="video" mimeType="video/mp4" codecs="avc1.64001f">
+<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="bbbbbbbb-0000-0000-0000-000000000002"/>
+<SegmentTemplate timescale="1000" initialization="v-$RepresentationID$.dash" media="v-$RepresentationID$-$Number$.dash" startNumber="1" duration="6000"/>
+<Representation id="video=400000" bandwidth="400000" width="640" height="360"/>
+<Representation id="video=1500000" bandwidth="1500000" width="1280" height="720"/>
+<Representation id="video=2500000" bandwidth="2500000" width="1280" height="720"/>
+<Representation id="video=4000000" bandwidth="4000000" width="1920" height="1080"/>
+</AdaptationSet>
+</Period>
+</MPD>
+"""
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Session(object):
+    def _get(self, url):
+        return requests.get(url)
+
+
+class Response(object):
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class StaticSession(object):
+    def __init__(self, text):
+        self.text = text
+
+    def _get(self, url):
+        return Response(self.text)
+
+
+@pytest.fixture
+def mpd_url(tmp_path):
+    (tmp_path / "index.mpd").write_text(MPD)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(Handler, directory=str(tmp_path))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/index.mpd"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def udemy(monkeypatch):
+    monkeypatch.setattr(main, "logger", logging.getLogger("udemy-downloader"))
+    monkeypatch.setattr(main, "manifest_cache", None)
+    udemy = main.Udemy(None)
+    udemy.session = Session()
+    return udemy
+
+
+def sources(udemy, url, native):
+    udemy._mpd_kids.clear()
+    udemy._mpd_sources.clear()
+    if native:
+        return udemy._extract_mpd(url, 1)
+    return udemy._extract_mpd_ytdlp(url, 1)
+
+
+def test_resolver_matches_ytdlp(udemy, mpd_url):
+    expected = sources(udemy, mpd_url, native=False)
+    assert expected
+    assert sorted(sources(udemy, mpd_url, native=True), key=str) == sorted(
+        expected, key=str
+    )
+
+
+def test_manifests_without_sources_fall_back_to_ytdlp(udemy, monkeypatch):
+    # no video representation has a height
+    mpd = MPD.replace(' height="360"', "").replace(' height="720"', "")
+    mpd = mpd.replace(' height="1080"', "")
+    udemy.session = StaticSession(mpd)
+    monkeypatch.setattr(
+        udemy, "_extract_mpd_ytdlp", lambda url, asset_id: [{"format_id": "ytdlp"}]
+    )
+    assert udemy._extract_mpd_kids("https://example.com/1.mpd", 1)
+    assert udemy._extract_mpd("https://example.com/1.mpd", 1) == [
+        {"format_id": "ytdlp"}
+    ]
@@ -0,0 +1,102 @@
+import asyncio
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import main
+
+URL = "https://www.udemy.com/api-2.0/items/"
+PAGE_SIZE = 10
+COUNT = 45
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200):
+        self._data = data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+
+    def json(self):
+        return self._data
+
+
+class FakeSession(object):
+    """Serves COUNT items in pages of PAGE_SIZE, failing some pages a number of times"""
+
+    def __init__(self, failures=None):
+        self.failures = Counter(failures or {})
+        self.requests = Counter()
+
+    def _respond(self, url):
+        page = int(parse_qs(urlsplit(url).query).get("page", ["1"])[0])
+        self.requests[page] += 1
+        if self.failures[page]:
+            self.failures[page] -= 1
+            return FakeResponse({}, 503)
+        start = (page - 1) * PAGE_SIZE
+        results = list(range(start, min(start + PAGE_SIZE, COUNT)))
+        last = start + PAGE_SIZE >= COUNT
+        return FakeResponse(
+            {
+                "count": COUNT,
+                "next": None if last else f"{URL}?page={page + 1}",
+                "results": results,
+            }
+        )
+
+    def _get(self, url, params=None):
+        return self._respond(url)
+
+
+class FakeAsyncSession(FakeSession):
+    async def _get(self, url, params=None):
+        return self._respond(url)
+
+
+@pytest.fixture
+def udemy(monkeypatch):
+    monkeypatch.setattr(main, "page_retries", 2)
+    monkeypatch.setattr(main, "retry", 3)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    return main.Udemy(None)
+
+
+def test_all_pages_in_order(udemy):
+    udemy.session = FakeSession()
+    data = udemy._handle_pagination(URL)
+    assert data["results"] == list(range(COUNT))
+    assert udemy._pages == {}
+
+
+def test_a_failing_page_is_resumed_without_refetching_the_others(udemy):
+    # page 3 fails both attempts of the first round, then works
+    udemy.session = FakeSession({3: 2})
+    data = udemy._handle_pagination(URL)
+    assert data["results"] == list(range(COUNT))
+    assert udemy.session.requests[3] == 3
+    assert all(udemy.session.requests[page] == 1 for page in (1, 2, 4, 5))
+
+
+def test_pagination_error_after_every_round(udemy):
+    udemy.session = FakeSession({4: 100})
+    with pytest.raises(main.PaginationError) as error:
+        udemy._handle_pagination(URL)
+    assert error.value.page == 4
+    # the pages that worked are kept for the caller's next attempt
+    udemy.session.failures.clear()
+    data = udemy._handle_pagination(URL)
+    assert data["results"] == list(range(COUNT))
+    assert udemy.session.requests[1] == 1
+
+
+def test_async_pagination_resumes(udemy, monkeypatch):
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(main.asyncio, "sleep", no_sleep)
+    udemy.async_session = FakeAsyncSession({2: 2, 5: 1})
+    data = asyncio.run(udemy._handle_pagination_async(URL))
+    assert data["results"] == list(range(COUNT))
+    assert udemy.async_session.requests[3] == 1
@@ -0,0 +1,137 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import range_downloader
+from range_downloader import RangeDownloader, RangeError
+
+BODY = bytes(range(256)) * 40  # 10240 bytes
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves BODY, with byte ranges unless `ranges` is False. Ranges starting at or after
+    `fail_from` are answered with a 500
+    """
+
+    protocol_version = "HTTP/1.1"
+    ranges = True
+    etag = '"v1"'
+    fail_from = None
+    requests = None
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        self.requests.append(header)
+        match = RANGE_RE.match(header or "")
+        if not self.ranges or not match:
+            return self._send(200, BODY)
+        start, end = int(match.group(1)), int(match.group(2))
+        if self.fail_from is not None and start >= self.fail_from and start > 0:
+            return self._send(500, b"")
+        self._send(
+            206,
+            BODY[start : end + 1],
+            {"Content-Range": f"bytes {start}-{end}/{len(BODY)}"},
+        )
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def small_ranges(monkeypatch):
+    monkeypatch.setattr(range_downloader, "RANGE_SIZE", 1024)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**attributes):
+        handler = type("TestHandler", (Handler,), {"requests": [], **attributes})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/file.pdf", handler
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def download(url, path, connections=4, retries=2):
+    with requests.Session() as session:
+        return RangeDownloader(session, connections, retries=retries).download(
+            url, str(path)
+        )
+
+
+def ranges(handler):
+    return sorted(r for r in handler.requests if r != "bytes=0-0")
+
+
+def test_ranges_are_fetched_in_parallel(serve, tmp_path):
+    url, handler = serve()
+    path = tmp_path / "file.pdf"
+    assert download(url, path) == len(BODY)
+
+    assert path.read_bytes() == BODY
+    assert handler.requests[0] == "bytes=0-0"
+    assert len(ranges(handler)) == 10
+    assert os.listdir(tmp_path) == ["file.pdf"]
+
+
+def test_resume_only_fetches_the_missing_ranges(serve, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, _ = serve(fail_from=6 * 1024)
+    with pytest.raises(RangeError):
+        download(url, path, connections=1, retries=0)
+    assert os.path.exists(f"{path}.part.ranges")
+    assert not path.exists()
+
+    url, handler = serve()
+    download(url, path)
+    assert path.read_bytes() == BODY
+    assert ranges(handler) == [
+        f"bytes={start}-{start + 1023}" for start in range(6 * 1024, 10 * 1024, 1024)
+    ]
+    assert os.listdir(tmp_path) == ["file.pdf"]
+
+
+def test_another_version_of_the_file_starts_over(serve, tmp_path):
+    path = tmp_path / "file.pdf"
+    url, _ = serve(fail_from=6 * 1024)
+    with pytest.raises(RangeError):
+        download(url, path, connections=1, retries=0)
+
+    url, handler = serve(etag='"v2"')
+    download(url, path)
+    assert path.read_bytes() == BODY
+    assert len(ranges(handler)) == 10
+
+
+def test_servers_ignoring_ranges_get_one_request(serve, tmp_path):
+    url, handler = serve(ranges=False)
+    path = tmp_path / "file.pdf"
+    assert download(url, path) == len(BODY)
+
+    assert path.read_bytes() == BODY
+    # the probe, then the whole file
+    assert handler.requests == ["bytes=0-0", None]
+    assert os.listdir(tmp_path) == ["file.pdf"]
@@ -0,0 +1,121 @@
+import os
+import threading
+
+import pytest
+
+import main
+from state_db import StateDB
+
+LECTURES = 48
+
+
+@pytest.fixture
+def segments(tmp_path, monkeypatch):
+    """
+    Runs the segment stages with the network and ffmpeg replaced: the tracks of a lecture
+    are files holding its id, and muxing concatenates them
+    """
+    monkeypatch.setattr(main, "state_db", StateDB(str(tmp_path / "state.db")))
+    monkeypatch.setattr(main, "stream_mux", False)
+    monkeypatch.setattr(main, "use_native_downloader", True)
+    monkeypatch.setattr(main, "segment_retries", 0)
+    monkeypatch.setattr(main, "fragment_controller", None)
+    monkeypatch.setattr(main, "download_budget", main.DownloadBudget())
+    monkeypatch.setattr(main, "keys", {})
+    cwds = set()
+
+    def fetch_tracks_native(job, journal, lease):
+        cwds.add(os.getcwd())
+        for path, rep_id in job.tracks:
+            with open(path, "w") as f:
+                f.write(f"{job.lecture_id}:{rep_id}\n")
+            journal.mark_complete(rep_id)
+        journal.save()
+        return True
+
+    def extract_kid(path):
+        with open(path) as f:
+            kid = f.read().strip().replace(":", "-")
+        main.keys.setdefault(kid, f"key-{kid}")
+        return kid
+
+    def mux_process(video, audio, title, output_path, audio_key, video_key):
+        cwds.add(os.getcwd())
+        with open(output_path, "w") as out:
+            for path, key in ((video, video_key), (audio, audio_key)):
+                with open(path) as f:
+                    out.write(f"{key} {f.read()}")
+
+    monkeypatch.setattr(main, "fetch_tracks_native", fetch_tracks_native)
+    monkeypatch.setattr(main, "extract_kid", extract_kid)
+    monkeypatch.setattr(main, "mux_process", mux_process)
+    return cwds
+
+
+def submit_lectures(tmp_path, handle):
+    jobs = []
+    for i in range(LECTURES):
+        chapter_dir = tmp_path / f"{i % 4:02d} chapter"
+        chapter_dir.mkdir(exist_ok=True)
+        lecture_id = str(1000 + i)
+        output_path = str(chapter_dir / f"{i:03d} lecture.mp4")
+        main.state_db.start(output_path, lecture_id)
+        handle(
+            f"https://example.com/{lecture_id}.mpd",
+            f"v{i},a{i}",
+            lecture_id,
+            f"Lecture {i}",
+            output_path,
+            str(chapter_dir),
+        )
+        jobs.append((lecture_id, i, output_path, str(chapter_dir)))
+    return jobs
+
+
+def check_outputs(jobs):
+    for lecture_id, i, output_path, chapter_dir in jobs:
+        with open(output_path) as f:
+            assert f.read() == (
+                f"key-{lecture_id}-v{i} {lecture_id}:v{i}\n"
+                f"key-{lecture_id}-a{i} {lecture_id}:a{i}\n"
+            )
+        assert main.state_db.is_done(output_path, lecture_id)
+        assert not os.path.exists(os.path.join(chapter_dir, f".{lecture_id}.work"))
+
+
+def test_lectures_in_threads(tmp_path, segments):
+    cwd = os.getcwd()
+    barrier = threading.Barrier(8)
+    calls = []
+
+    def handle(*args):
+        calls.append(args)
+
+    jobs = submit_lectures(tmp_path, handle)
+
+    def worker(offset):
+        barrier.wait()
+        for args in calls[offset::8]:
+            main.handle_segments(*args)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    check_outputs(jobs)
+    assert segments == {cwd}
+    assert os.getcwd() == cwd
+
+
+def test_lectures_through_the_pipeline(tmp_path, segments, monkeypatch):
+    cwd = os.getcwd()
+    pipeline = main.SegmentPipeline(4, 2, 2)
+    monkeypatch.setattr(main, "segment_pipeline", pipeline)
+    jobs = submit_lectures(tmp_path, main.handle_segments)
+    pipeline.join()
+
+    check_outputs(jobs)
+    assert segments == {cwd}
+    assert os.getcwd() == cwd
@@ -0,0 +1,105 @@
+import os
+import struct
+import threading
+
+import pytest
+
+from state_db import StateDB
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+MP4 = (
+    box(b"ftyp", b"isom" * 4)
+    + box(b"moov", box(b"mvhd", bytes(100)))
+    + box(b"mdat", bytes(4096))
+)
+
+
+@pytest.fixture
+def db(tmp_path):
+    return StateDB(str(tmp_path / "state.db"))
+
+
+def test_untracked_files_are_only_adopted_when_complete(db, tmp_path):
+    complete = write(tmp_path / "001 Intro.mp4", MP4)
+    # the old downloader wrote straight to the final name
+    partial = write(tmp_path / "002 Setup.mp4", MP4[:-100])
+    empty = write(tmp_path / "003 slides.pdf", b"")
+
+    assert db.is_done(complete, 1)
+    assert db.get(complete)["status"] == "done"
+    assert not db.is_done(partial, 2)
+    assert not db.is_done(empty, 3, "asset")
+    # left for the download to replace, and not adopted on a second look
+    assert os.path.exists(partial)
+    assert not db.is_done(partial, 2)
+
+
+def test_files_changed_since_they_were_downloaded_are_not_done(db, tmp_path):
+    path = write(tmp_path / "001 Intro.mp4", MP4)
+    db.start(path, 1)
+    db.finish(path)
+    assert db.is_done(path, 1)
+
+    # same size, different content
+    edited = MP4[:-10] + b"x" * 10
+    write(path, edited)
+    assert not db.is_done(path, 1)
+    # a status query, the edited file is still there
+    with open(path, "rb") as f:
+        assert f.read() == edited
+
+
+def test_connections_of_every_thread_are_closed(db, tmp_path):
+    def worker(index):
+        path = write(tmp_path / f"{index:03d}.pdf", b"pdf")
+        db.start(path, index, "asset")
+        db.finish(path)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connections = list(db._connections)
+    assert len(connections) >= 4
+
+    db.close()
+    assert db._connections == []
+    # the journal was checkpointed into the database
+    assert not os.path.exists(db.path + "-wal")
+    reopened = StateDB(db.path)
+    assert reopened.get(str(tmp_path / "003.pdf"))["status"] == "done"
+    reopened.close()
+
+    # still usable, on a new connection
+    db.fail(str(tmp_path / "000.pdf"), "gone")
+    assert db._connections and db._connections[0] not in connections
+    db.close()
+
+
+def test_without_a_path_nothing_is_written(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = StateDB(None)
+    db.start_course(10, "Course", str(tmp_path), [{"id": 1}, {"id": 2}])
+    path = write(tmp_path / "001 Intro.mp4", MP4)
+    db.start(path, 1)
+    db.fail(path, "missing key")
+    db.start(str(tmp_path / "002 Setup.mp4"), 2)
+    db.finish(path)
+    db.fail(str(tmp_path / "002 Setup.mp4"), "missing key")
+
+    assert db.is_done(path, 1)
+    assert db.failed_lectures(10) == {2}
+    db.finish_courses()
+    db.close()
+    assert os.listdir(tmp_path) == ["001 Intro.mp4"]
@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+import main
+from template_renderer import Template, TemplateSet
+
+TEMPLATES = os.path.join(main.MAIN_SCRIPT_PATH, "templates")
+
+QUIZ = {
+    "id": 1,
+    "title": "Quiz 1 – «ünïcode»",
+    "assessments": [{"question": "<b>2 + 2</b>?", "answers": ["4", "5"]}],
+}
+
+
+def read(name):
+    with open(os.path.join(TEMPLATES, f"{name}.html"), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_both_placeholder_styles():
+    template = Template(
+        "<t>__title_placeholder__</t>%%QUIZ_JSON%%|__title_placeholder__"
+    )
+    assert template.placeholders == {"title", "quiz_json"}
+
+    class Out(list):
+        write = list.append
+
+    out = Out()
+    template.render_to(out, {"title": "T", "quiz_json": {"a": [1, 2]}})
+    assert "".join(out) == '<t>T</t>{"a": [1, 2]}|T'
+
+
+# (template, values for Template, the str.replace calls the templates were rendered with)
+CASES = [
+    (
+        "article_template",
+        {"title": "Intro – «ünïcode»", "data": "<p>Some <b>article</b> body</p>"},
+        [
+            ("__title_placeholder__", "Intro – «ünïcode»"),
+            ("__data_placeholder__", "<p>Some <b>article</b> body</p>"),
+        ],
+    ),
+    (
+        "quiz_template",
+        {"title": QUIZ["title"], "quiz_json": QUIZ},
+        [("%%TITLE%%", QUIZ["title"]), ("%%QUIZ_JSON%%", json.dumps(QUIZ))],
+    ),
+    (
+        "coding_assignment_template",
+        {"data": QUIZ},
+        [("__data_placeholder__", json.dumps(QUIZ))],
+    ),
+    (
+        "role_play_template",
+        {"data": QUIZ},
+        [("__data_placeholder__", json.dumps(QUIZ))],
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "name, values, replacements", CASES, ids=[case[0] for case in CASES]
+)
+def test_output_matches_str_replace(tmp_path, name, values, replacements):
+    expected = read(name)
+    for placeholder, value in replacements:
+        expected = expected.replace(placeholder, value)
+    expected_path = tmp_path / "expected.html"
+    with open(expected_path, "w", encoding="utf-8") as f:
+        f.write(expected)
+
+    path = tmp_path / "rendered.html"
+    TemplateSet(TEMPLATES).render(name, str(path), **values)
+    assert path.read_bytes() == expected_path.read_bytes()
+    assert sorted(os.listdir(tmp_path)) == ["expected.html", "rendered.html"]
+
+
+def test_failed_render_leaves_no_file(tmp_path):
+    path = tmp_path / "article.html"
+    with pytest.raises(KeyError):
+        # data is missing
+        TemplateSet(TEMPLATES).render("article_template", str(path), title="Intro")
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from typing import Optional
+
+logger = logging.getLogger("udemy-downloader")
+
+PROBE_TIMEOUT = 10
+
+
+class ToolProbe(object):
+    """
+    Finds the external tools (aria2c, ffmpeg...) on the path and their versions.
+
+    A tool is only run to read its version the first time it is seen. The path and version
+    are cached in a json file keyed by the mtime of the executable, so later runs find it
+    with a `stat` instead of starting a process, and an upgraded tool is probed again.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        # name: (seconds spent finding the tool, cached, probed or missing)
+        self.timings = {}
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                self._tools = json.load(f)
+        except (OSError, ValueError):
+            self._tools = {}
+
+    def find(self, name: str, version_args: list) -> Optional[dict]:
+        """
+        Returns:
+            dict: The path and version (the first line it prints) of the tool, None if it
+                isn't installed
+        """
+        started = time.perf_counter()
+        path = shutil.which(name)
+        if path is None:
+            self.timings[name] = (time.perf_counter() - started, "missing")
+            return None
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        entry = self._tools.get(name)
+        cached = bool(entry and entry["path"] == path and entry["mtime"] == mtime)
+        if not cached:
+            entry = {
+                "path": path,
+                "mtime": mtime,
+                "version": self._version(path, version_args),
+            }
+            self._tools[name] = entry
+            self._save()
+        self.timings[name] = (
+            time.perf_counter() - started,
+            "cached" if cached else "probed",
+        )
+        return entry
+
+    @staticmethod
+    def _version(path: str, version_args: list) -> Optional[str]:
+        try:
+            result = subprocess.run(
+                [path, *version_args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=PROBE_TIMEOUT,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f"Failed to get the version of {path}: {e}")
+            return None
+        for line in result.stdout.decode("utf-8", "replace").splitlines():
+            if line.strip():
+                return line.strip()
+        return None
+
+    def _save(self):
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._tools, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.debug(f"Failed to save the tool cache: {e}")
+
+    def report(self) -> list:
+        return [
+            f"{seconds * 1000:8.1f} ms  {name} ({status})"
+            for name, (seconds, status) in self.timings.items()
+        ]
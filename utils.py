@@ -1,9 +1,13 @@
 import base64
 import codecs
 import os
+from xml.etree import ElementTree
 
 import mp4parse
-import widevine_pssh_data_pb2
+from lazy_import import lazy_import
+
+# protobuf is only needed once a downloaded track is looked at
+widevine_pssh_data_pb2 = lazy_import("widevine_pssh_data_pb2")
 
 
 def extract_kid(mp4_file):
@@ -20,20 +24,52 @@ def extract_kid(mp4_file):
 
     """
 
-    boxes = mp4parse.F4VParser.parse(filename=mp4_file)
     if not os.path.exists(mp4_file):
         raise Exception("File does not exist")
-    for box in boxes:
-        if box.header.box_type == "moov" and box.pssh:
-            pssh_box = next(
-                x for x in box.pssh if x.system_id == "edef8ba979d64acea3c827dcd51d21ed"
-            )
-            hex = codecs.decode(pssh_box.payload, "hex")
-
-            pssh = widevine_pssh_data_pb2.WidevinePsshData()
-            pssh.ParseFromString(hex)
-            key_id = base64.b16encode(pssh.key_id[0]).lower()
-            return key_id.decode("utf-8")
-
-    # No Moof or PSSH header found
+    # only reads box headers, the media data is skipped over
+    pssh_box = mp4parse.F4VParser.find_pssh(mp4_file, mp4parse.WIDEVINE_SYSTEM_ID)
+    if pssh_box:
+        hex = codecs.decode(pssh_box.payload, "hex")
+
+        pssh = widevine_pssh_data_pb2.WidevinePsshData()
+        pssh.ParseFromString(hex)
+        key_id = base64.b16encode(pssh.key_id[0]).lower()
+        return key_id.decode("utf-8")
+
+    # No PSSH header found
     return None
+
+
+def _default_kid(element):
+    for protection in element.findall("{*}ContentProtection"):
+        kid = protection.get("{urn:mpeg:cenc:2013}default_KID")
+        if kid:
+            return kid.replace("-", "").lower()
+    return None
+
+
+def extract_mpd_kids(mpd):
+    """
+    Parameters
+    ----------
+    mpd : str
+        DASH manifest with cenc:default_KID attributes
+
+
+    Returns
+    -------
+    dict
+        The KID of every representation by representation id, in the same
+        format as extract_kid and the key file
+
+    """
+
+    root = ElementTree.fromstring(mpd)
+    kids = {}
+    for adaptation_set in root.findall(".//{*}AdaptationSet"):
+        set_kid = _default_kid(adaptation_set)
+        for representation in adaptation_set.findall("{*}Representation"):
+            kid = _default_kid(representation) or set_kid
+            if kid and representation.get("id") is not None:
+                kids[representation.get("id")] = kid
+    return kids